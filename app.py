@@ -7,26 +7,51 @@
 # AGORA, importe todo o resto
 import os
 from dotenv import load_dotenv
-from flask import Flask, Response, render_template, request, redirect, url_for, send_from_directory, flash, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, send_file, flash, jsonify, abort
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 from datetime import datetime
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.pool import NullPool
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_bcrypt import Bcrypt
-from sqlalchemy import or_, cast
+from sqlalchemy import or_, cast, event, func, inspect
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.engine import make_url
 from functools import wraps
 import click
+import csv
 import io
 import openpyxl
 from getpass import getpass
 # from flask_socketio import SocketIO
-import fitz
 import re
+import urllib.parse
 import io
 import openpyxl
 import time
+import base64
+import copy
+import json
+import uuid
+import hashlib
+import threading
+from eventos import criar_broker
+from busca import criar_indice_busca, normalizar
+from indice_clientes import IndiceClientes
+from conexoes import TelemetriaPool, opcoes_engine, instrumentar_engine, estado_pool
+from exportacao import MIMETYPES, gerar_exportacao, ler_em_lotes
+from tarefas import CONCLUIDA, GestorTarefas, LimiteTarefas
+from imagens import (TAMANHOS as TAMANHOS_IMAGEM, RESOLUCAO_PDF_PADRAO, gerar_derivados, obter_derivado,
+                     obter_pagina_pdf, resolucao_pdf, total_paginas_pdf)
+from armazenamento import apagar_ficheiro, guardar_caminho, guardar_ficheiro, hash_do_nome
+from envios import ErroEnvio, GestorEnvios, HashDiferente, TamanhoExcedido
+from cache_relatorios import CacheRelatorios
+from romaneio import CAMPOS_PEDIDO, CAMPOS_PRODUTO, VERSAO_LEITOR, analisar_romaneio, analisar_varios
+from romaneio import totais as totais_romaneio
+from relatorio_pdf import VERSAO_DESENHO, gerar_relatorio_pdf
+from importacao import ADICIONADA, IGNORADA, INVALIDA, RelatorioImportacao, ler_planilha, texto_celula
 
 # --- INÍCIO DA CORREÇÃO ESTRUTURAL ---
 
@@ -71,9 +96,65 @@ else:
 
 app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'uploads')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': NullPool}
+# Pool de ligações (ver conexoes.py): 'fila' (QueuePool, padrão), 'pgbouncer' (pooler em modo
+# transação) ou 'nenhum' (NullPool, uma ligação nova por pedido). Tamanho, excedente, timeout,
+# reciclagem e pre-ping vêm de DB_POOL_TAMANHO, DB_POOL_EXCEDENTE, DB_POOL_TIMEOUT,
+# DB_POOL_RECICLAR e DB_POOL_PRE_PING.
+app.config['DB_POOL_MODO'] = os.environ.get('DB_POOL_MODO', 'fila')
+telemetria_pool = TelemetriaPool()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opcoes_engine(app.config['DB_POOL_MODO'], os.environ, telemetria_pool)
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Canal de eventos em tempo real do painel (SSE). Backends: 'local' (um único processo),
+# 'sondagem' (consulta a versão no banco; funciona entre workers com qualquer banco) e
+# 'postgres' (LISTEN/NOTIFY; PAINEL_PUSH_DSN deve ser uma ligação de sessão, não o pooler em modo transação).
+# Cada ligação SSE ocupa uma thread durante PAINEL_PUSH_DURACAO: com workers síncronos (o
+# padrão do gunicorn) poucos separadores abertos ocupam todos os workers. Por isso vem
+# desligado; ative-o só com workers com threads ou assíncronos (ex.: gunicorn -k gthread
+# --threads 16, ou -k gevent). Desligado, o painel fica na sondagem periódica.
+app.config['PAINEL_PUSH_ATIVO'] = os.environ.get('PAINEL_PUSH_ATIVO', '0') == '1'
+app.config['PAINEL_PUSH_BACKEND'] = os.environ.get('PAINEL_PUSH_BACKEND', 'sondagem')
+app.config['PAINEL_PUSH_DSN'] = os.environ.get('PAINEL_PUSH_DSN', database_url)
+# Duração máxima de cada ligação SSE (segundos); o navegador volta a ligar automaticamente
+app.config['PAINEL_PUSH_DURACAO'] = int(os.environ.get('PAINEL_PUSH_DURACAO', '120'))
+
+# Exportações em segundo plano (ver tarefas.py): pasta dos ficheiros, threads por worker,
+# tarefas ativas por utilizador e tempo (segundos) durante o qual um ficheiro pronto é reutilizado
+app.config['TAREFAS_PASTA'] = os.environ.get('TAREFAS_PASTA', os.path.join(basedir, 'exportacoes'))
+app.config['TAREFAS_THREADS'] = int(os.environ.get('TAREFAS_THREADS', '2'))
+app.config['TAREFAS_POR_UTILIZADOR'] = int(os.environ.get('TAREFAS_POR_UTILIZADOR', '1'))
+app.config['TAREFAS_RETENCAO'] = int(os.environ.get('TAREFAS_RETENCAO', '3600'))
+
+# Leitura dos romaneios em PDF (ver romaneio.py): processos que extraem o texto das páginas
+# em paralelo e número mínimo de páginas para usar o pool (abaixo disso lê no próprio pedido)
+app.config['ROMANEIO_PROCESSOS'] = int(os.environ.get('ROMANEIO_PROCESSOS', str(min(os.cpu_count() or 1, 4))))
+app.config['ROMANEIO_PAGINAS_PARALELO'] = int(os.environ.get('ROMANEIO_PAGINAS_PARALELO', '40'))
+
+# Tamanho máximo (bytes) do corpo de qualquer pedido; os formulários com anexos enviam o
+# ficheiro inteiro num pedido, por isso ficheiros maiores devem ir pelo envio em blocos
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', str(100 * 1024 * 1024)))
+# Envio de anexos em blocos (ver envios.py): tamanho máximo de cada anexo e de cada bloco,
+# pasta dos envios em curso (no mesmo disco dos uploads, para a conclusão só mover o
+# ficheiro) e tempo (segundos) sem blocos novos ao fim do qual um envio é apagado
+app.config['ANEXO_TAMANHO_MAXIMO'] = int(os.environ.get('ANEXO_TAMANHO_MAXIMO', str(500 * 1024 * 1024)))
+app.config['ENVIO_BLOCO_MAXIMO'] = int(os.environ.get('ENVIO_BLOCO_MAXIMO', str(8 * 1024 * 1024)))
+app.config['ENVIOS_PASTA'] = os.environ.get('ENVIOS_PASTA', os.path.join(app.config['UPLOAD_FOLDER'], '.envios'))
+app.config['ENVIOS_RETENCAO'] = int(os.environ.get('ENVIOS_RETENCAO', '86400'))
+
+# PDFs dos relatórios já gerados, reutilizados enquanto o relatório não muda (ver cache_relatorios.py)
+app.config['RELATORIOS_PASTA'] = os.environ.get('RELATORIOS_PASTA', os.path.join(basedir, 'relatorios'))
+
+# Entrega dos anexos (/uploads): 'flask' (o worker envia o ficheiro), 'nginx' (o worker só
+# verifica o login e responde com X-Accel-Redirect para ANEXOS_ACCEL_PREFIXO, uma location
+# "internal" do nginx com alias para a pasta de uploads) ou 'sendfile' (X-Sendfile, para o
+# Apache com mod_xsendfile ou o lighttpd). Nos modos com proxy é ele que responde aos Range.
+app.config['ANEXOS_ENTREGA'] = os.environ.get('ANEXOS_ENTREGA', 'flask')
+app.config['ANEXOS_ACCEL_PREFIXO'] = os.environ.get('ANEXOS_ACCEL_PREFIXO', '/_uploads/')
+
+# Linhas por janela das tabelas do painel (paginação keyset por número do pedido)
+app.config['PAINEL_JANELA'] = int(os.environ.get('PAINEL_JANELA', '100'))
+PAINEL_JANELA_MAXIMA = 500
+
 # --- FIM DO BLOCO CORRIGIDO ---
 
 # 5. INICIALIZE as extensões COM o app
@@ -82,6 +163,9 @@ bcrypt.init_app(app)
 login_manager.init_app(app)
 # socketio.init_app(app, async_mode='eventlet')
 
+with app.app_context():
+    instrumentar_engine(db.engine, telemetria_pool)
+
 # 6. Configure o LoginManager
 login_manager.login_view = 'login'
 login_manager.login_message = "Por favor, faça login para aceder a esta página."
@@ -123,7 +207,11 @@ class Cliente(db.Model):
 
 class Anexo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(200), nullable=False)
+    # Nome do ficheiro na pasta de uploads: <sha256><extensão> (ver armazenamento.py), partilhado
+    # pelos anexos com o mesmo conteúdo; anexos antigos mantêm o nome com que foram enviados
+    filename = db.Column(db.String(200), nullable=False, index=True)
+    nome_original = db.Column(db.String(255), nullable=True)
+    hash_sha256 = db.Column(db.String(64), nullable=True)
     entrada_id = db.Column(db.Integer, db.ForeignKey('entrada.id'), nullable=False)
     
     # Campos para posicionamento editado
@@ -132,6 +220,11 @@ class Anexo(db.Model):
     width = db.Column(db.Float, nullable=True)
     height = db.Column(db.Float, nullable=True)
 
+    @property
+    def nome(self):
+        """Nome a mostrar ao utilizador (o do ficheiro enviado)."""
+        return self.nome_original or self.filename
+
 class TextoPersonalizado(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     entrada_id = db.Column(db.Integer, db.ForeignKey('entrada.id'), nullable=False)
@@ -163,9 +256,80 @@ class Entrada(db.Model):
     observacoes = db.Column(db.Text, nullable=True)
     observacoes_pedido = db.Column(db.String(200), nullable=True)  # Campo para observações específicas do pedido
     arquivado = db.Column(db.Boolean, default=False, nullable=False)
+    # Incrementada a cada alteração do que aparece no relatório (chave dos PDFs guardados)
+    versao_relatorio = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     anexos = db.relationship('Anexo', backref='entrada', lazy=True, cascade="all, delete-orphan")
     textos_personalizados = db.relationship('TextoPersonalizado', backref='entrada', lazy=True, cascade="all, delete-orphan")
 
+class ControleVersao(db.Model):
+    """Contadores persistentes de alterações, partilhados por todos os processos do servidor."""
+    chave = db.Column(db.String(50), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+    atualizado_em = db.Column(db.DateTime, nullable=True)
+
+class AlteracaoEntrada(db.Model):
+    """Registo das entradas alteradas em cada versão do painel, usado pela sincronização incremental."""
+    id = db.Column(db.Integer, primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, index=True)
+    # Sem chave estrangeira: o registo tem de sobreviver à exclusão da entrada (tombstone)
+    entrada_id = db.Column(db.Integer, nullable=False)
+
+class Romaneio(db.Model):
+    """PDF de romaneio já lido; o SHA-256 do ficheiro identifica-o quando é enviado de novo."""
+    __table_args__ = (db.UniqueConstraint('hash_sha256', 'versao_leitor'),)
+    id = db.Column(db.Integer, primary_key=True)
+    hash_sha256 = db.Column(db.String(64), nullable=False)
+    # Versão do leitor (romaneio.VERSAO_LEITOR) que produziu os pedidos guardados
+    versao_leitor = db.Column(db.Integer, nullable=False)
+    nome_ficheiro = db.Column(db.String(255), nullable=False)
+    tamanho = db.Column(db.Integer, nullable=False)
+    total_pedidos = db.Column(db.Integer, nullable=False)
+    utilizador_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    data_registro = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    pedidos = db.relationship('PedidoRomaneio', backref='romaneio', lazy=True, cascade="all, delete-orphan",
+                              order_by='PedidoRomaneio.posicao')
+
+    def relatorios(self):
+        """Pedidos no mesmo formato devolvido por romaneio.analisar_romaneio()."""
+        return [{'cabecalho': pedido.cabecalho(), 'produtos': [produto.dados() for produto in pedido.produtos]}
+                for pedido in self.pedidos]
+
+class PedidoRomaneio(db.Model):
+    """Cabeçalho de um pedido lido de um romaneio (valores tal como aparecem no PDF)."""
+    id = db.Column(db.Integer, primary_key=True)
+    romaneio_id = db.Column(db.Integer, db.ForeignKey('romaneio.id'), nullable=False, index=True)
+    posicao = db.Column(db.Integer, nullable=False)
+    pedido = db.Column(db.String(50), nullable=True, index=True)
+    pedido_cli = db.Column(db.String(50), nullable=True)
+    tipo = db.Column(db.String(100), nullable=True)
+    funcionario = db.Column(db.String(150), nullable=True)
+    data_pedido = db.Column(db.String(50), nullable=True)
+    data_entrega = db.Column(db.String(50), nullable=True)
+    peso = db.Column(db.String(50), nullable=True)
+    m2 = db.Column(db.String(50), nullable=True)
+    total = db.Column(db.String(50), nullable=True)
+    cliente = db.Column(db.String(200), nullable=True)
+    produtos = db.relationship('ProdutoRomaneio', backref='pedido_romaneio', lazy=True,
+                               cascade="all, delete-orphan", order_by='ProdutoRomaneio.posicao')
+
+    def cabecalho(self):
+        return {campo: getattr(self, campo) for campo in CAMPOS_PEDIDO}
+
+class ProdutoRomaneio(db.Model):
+    """Linha da tabela de produtos de um pedido do romaneio."""
+    id = db.Column(db.Integer, primary_key=True)
+    pedido_romaneio_id = db.Column(db.Integer, db.ForeignKey('pedido_romaneio.id'), nullable=False, index=True)
+    posicao = db.Column(db.Integer, nullable=False)
+    cod = db.Column(db.String(50), nullable=True)
+    produto = db.Column(db.Text, nullable=True)
+    os = db.Column(db.String(50), nullable=True)
+    dimensoes = db.Column(db.String(50), nullable=True)
+    qtde = db.Column(db.String(50), nullable=True)
+    m2 = db.Column(db.String(50), nullable=True)
+
+    def dados(self):
+        return {campo: getattr(self, campo) for campo in CAMPOS_PRODUTO}
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -180,67 +344,681 @@ def admin_required(f):
     return decorated_function
 
 
-def get_dashboard_data():
-    pedidos_query = Entrada.query.filter_by(tipo='Pedido', arquivado=False)
-    pedidos_dashboard = {
-        'total': pedidos_query.count(),
-        'nao_iniciado': pedidos_query.filter_by(status='Não iniciado').count(),
-        'em_andamento': pedidos_query.filter_by(status='Em andamento').count(),
-        'concluido': pedidos_query.filter_by(status='Concluído').count()
+# --- VERSÃO PERSISTENTE DOS DADOS ---
+
+# Chave do contador que muda sempre que algo exibido no painel (entradas, anexos, clientes) é alterado
+VERSAO_PAINEL = 'painel'
+MODELOS_PAINEL = (Entrada, Anexo, Cliente)
+# Contador próprio do cadastro de clientes (não muda com entradas nem anexos)
+VERSAO_CLIENTES = 'clientes'
+
+
+def obter_versao(chave):
+    """Retorna (versao, atualizado_em) do contador persistente `chave`; (0, None) se ainda não existir."""
+    registro = db.session.get(ControleVersao, chave)
+    if registro is None:
+        return 0, None
+    return registro.versao, registro.atualizado_em
+
+
+def _incrementar_versao(session, chave):
+    """Incrementa o contador `chave` dentro da transação corrente, no máximo uma vez por transação."""
+    versoes = session.info.setdefault('versoes_transacao', {})
+    if chave in versoes:
+        return versoes[chave]
+
+    tabela = ControleVersao.__table__
+    conexao = session.connection()
+    agora = datetime.now()
+    resultado = conexao.execute(
+        tabela.update().where(tabela.c.chave == chave).values(versao=tabela.c.versao + 1, atualizado_em=agora)
+    )
+    if resultado.rowcount == 0:
+        conexao.execute(tabela.insert().values(chave=chave, versao=1, atualizado_em=agora))
+    versoes[chave] = conexao.execute(
+        db.select(tabela.c.versao).where(tabela.c.chave == chave)
+    ).scalar_one()
+    return versoes[chave]
+
+
+def _ler_versao_painel():
+    """Lê a versão do painel fora de um pedido (usada pela thread do broker de sondagem)."""
+    with app.app_context():
+        return obter_versao(VERSAO_PAINEL)[0]
+
+
+# Sem o canal SSE ninguém assina os eventos: o broker local não faz nada (nem pg_notify nem sondagem)
+broker_eventos = criar_broker(
+    app.config['PAINEL_PUSH_BACKEND'] if app.config['PAINEL_PUSH_ATIVO'] else 'local',
+    ler_versao=_ler_versao_painel,
+    dsn=app.config['PAINEL_PUSH_DSN']
+)
+
+
+# Quantas versões do registo de alterações são mantidas; clientes mais atrasados recebem a carga completa
+ALTERACOES_RETIDAS = int(os.environ.get('ALTERACOES_RETIDAS', '5000'))
+
+
+def _entradas_afetadas(session, alterados):
+    """Identifica os ids de Entrada cuja linha no painel muda por causa dos objetos alterados."""
+    ids = set()
+    clientes_alterados = []
+    for obj in alterados:
+        if isinstance(obj, Entrada) and obj.id is not None:
+            ids.add(obj.id)
+        elif isinstance(obj, Anexo) and obj.entrada_id is not None:
+            ids.add(obj.entrada_id)
+        elif isinstance(obj, Cliente) and obj.id is not None and obj not in session.new:
+            clientes_alterados.append(obj.id)
+    if clientes_alterados:
+        # Nome e número do cliente aparecem nas linhas das suas entradas ativas
+        ids.update(session.connection().execute(
+            db.select(Entrada.id).where(Entrada.cliente_id.in_(clientes_alterados), Entrada.arquivado == False)
+        ).scalars())
+    return ids
+
+
+# Qualquer escrita passa por um flush da sessão, por isso a versão é incrementada aqui
+# e não depende de cada rota lembrar-se disso (ex.: bulk_action e bulk_action_archived).
+@event.listens_for(Session, 'after_flush')
+def _registrar_alteracoes(session, flush_context):
+    alterados = list(session.new) + list(session.deleted)
+    alterados += [obj for obj in session.dirty if session.is_modified(obj)]
+    if not any(isinstance(obj, MODELOS_PAINEL) for obj in alterados):
+        return
+
+    if any(isinstance(obj, Cliente) for obj in alterados):
+        _incrementar_versao(session, VERSAO_CLIENTES)
+    registrar_alteracoes_painel(session, _entradas_afetadas(session, alterados))
+
+
+def registrar_alteracoes_painel(session, entrada_ids):
+    """Incrementa a versão do painel, avisa o broker e regista as entradas alteradas nessa versão.
+
+    Chamada pelo listener de flush e diretamente pelas gravações em lote, que não passam pelo flush.
+    """
+    versao = _incrementar_versao(session, VERSAO_PAINEL)
+    broker_eventos.notificar(session.connection(), {'versao': versao})
+    if entrada_ids:
+        conexao = session.connection()
+        conexao.execute(
+            AlteracaoEntrada.__table__.insert(),
+            [{'versao': versao, 'entrada_id': entrada_id} for entrada_id in entrada_ids]
+        )
+        # Poda ocasional do registo; versões mais antigas deixam de aceitar sincronização incremental
+        if versao % 200 == 0:
+            conexao.execute(
+                AlteracaoEntrada.__table__.delete().where(AlteracaoEntrada.versao <= versao - ALTERACOES_RETIDAS)
+            )
+    return versao
+
+
+# --- ÍNDICE DE BUSCA ---
+
+# pg_trgm/unaccent no PostgreSQL, tabela-sombra FTS5 no SQLite (ver busca.py); criado pela migração 1 (migracoes.py)
+indice_busca = criar_indice_busca(
+    make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name(),
+    Entrada.__table__,
+    Cliente.__table__
+)
+
+
+@event.listens_for(Session, 'after_flush')
+def _sincronizar_indice_busca(session, flush_context):
+    if not indice_busca.mantido_pela_aplicacao:
+        return
+    entradas, removidas, clientes = set(), set(), set()
+    for obj in list(session.new) + [obj for obj in session.dirty if session.is_modified(obj)]:
+        if isinstance(obj, Entrada):
+            entradas.add(obj.id)
+        elif isinstance(obj, Cliente) and obj not in session.new:
+            clientes.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Entrada):
+            removidas.add(obj.id)
+        elif isinstance(obj, Cliente):
+            clientes.add(obj.id)
+    if entradas or removidas or clientes:
+        indice_busca.sincronizar(session.connection(), entradas, removidas, clientes)
+
+
+def condicao_busca(termo, campos):
+    """Condição de busca textual sobre Entrada para os campos indicados ('numero', 'descricao', 'obra', 'cliente').
+
+    Usa o índice de busca quando já foi criado; caso contrário recorre ao ILIKE (exige o
+    OUTER JOIN com Cliente na consulta, como nas listagens).
+    """
+    if indice_busca.disponivel(db.session.connection()):
+        return indice_busca.condicao(termo, campos)
+
+    search_term = f"%{termo}%"
+    colunas = {
+        'numero': [cast(Entrada.numero_pedido, db.String)],
+        'descricao': [Entrada.descricao],
+        'obra': [Entrada.obra],
+        'cliente': [Cliente.nome, Entrada.cliente_nome_temp],
     }
-    orcamentos_query = Entrada.query.filter_by(tipo='Orçamento', arquivado=False)
-    orcamentos_dashboard = {
-        'total': orcamentos_query.count(),
-        'nao_iniciado': orcamentos_query.filter_by(status='Não iniciado').count(),
-        'em_andamento': orcamentos_query.filter_by(status='Em andamento').count(),
-        'concluido': orcamentos_query.filter_by(status='Concluído').count()
+    return or_(*[coluna.ilike(search_term) for campo in campos for coluna in colunas[campo]])
+
+
+# --- ÍNDICE DE CLIENTES (AUTOCOMPLETE) ---
+
+# Índice em memória de cada worker (ver indice_clientes.py); a versão dos clientes é
+# conferida no máximo a cada CLIENTES_INDICE_INTERVALO segundos
+indice_clientes = IndiceClientes(
+    carregar=lambda: db.session.execute(db.select(Cliente.id, Cliente.nome, Cliente.numero_cliente)).all(),
+    ler_versao=lambda: obter_versao(VERSAO_CLIENTES)[0],
+    intervalo=float(os.environ.get('CLIENTES_INDICE_INTERVALO', '5'))
+)
+
+
+@event.listens_for(Session, 'after_flush')
+def _registrar_clientes_alterados(session, flush_context):
+    alteracoes = session.info.setdefault('clientes_alterados', {})
+    for obj in list(session.new) + [obj for obj in session.dirty if session.is_modified(obj)]:
+        if isinstance(obj, Cliente):
+            alteracoes[obj.id] = (obj.nome, obj.numero_cliente)
+    for obj in session.deleted:
+        if isinstance(obj, Cliente):
+            alteracoes[obj.id] = None
+    if not alteracoes:
+        session.info.pop('clientes_alterados')
+
+
+@event.listens_for(Session, 'after_commit')
+def _finalizar_transacao(session):
+    versoes = session.info.pop('versoes_transacao', None)
+    alteracoes = session.info.pop('clientes_alterados', None)
+    if versoes and VERSAO_PAINEL in versoes:
+        broker_eventos.publicar({'versao': versoes[VERSAO_PAINEL]})
+    if alteracoes and versoes and VERSAO_CLIENTES in versoes:
+        indice_clientes.aplicar(alteracoes, versoes[VERSAO_CLIENTES])
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _descartar_transacao(session, previous_transaction):
+    session.info.pop('versoes_transacao', None)
+    session.info.pop('clientes_alterados', None)
+
+
+# --- VERSÃO DOS RELATÓRIOS ---
+
+cache_relatorios = CacheRelatorios(app.config['RELATORIOS_PASTA'])
+
+# Colunas da entrada que aparecem no relatório (mudar o status ou arquivar não o invalida)
+CAMPOS_RELATORIO = ('numero_pedido', 'data_registro', 'cliente_id', 'cliente_nome_temp', 'obra',
+                    'descricao', 'observacoes', 'observacoes_pedido')
+
+
+def _altera_relatorio(entrada):
+    estado = inspect(entrada)
+    return any(estado.attrs[campo].history.has_changes() for campo in CAMPOS_RELATORIO)
+
+
+@event.listens_for(Session, 'after_flush')
+def _incrementar_versoes_relatorio(session, flush_context):
+    ids, clientes = set(), set()
+    alterados = [obj for obj in session.dirty if session.is_modified(obj)]
+    for obj in list(session.new) + list(session.deleted) + alterados:
+        if isinstance(obj, (Anexo, TextoPersonalizado)) and obj.entrada_id is not None:
+            ids.add(obj.entrada_id)
+    for obj in alterados:
+        if isinstance(obj, Entrada) and _altera_relatorio(obj):
+            ids.add(obj.id)
+        elif isinstance(obj, Cliente):
+            clientes.add(obj.id)
+    removidas = {obj.id for obj in session.deleted if isinstance(obj, Entrada)}
+    if removidas:
+        session.info.setdefault('relatorios_removidos', set()).update(removidas)
+
+    condicoes = []
+    if ids - removidas:
+        condicoes.append(Entrada.id.in_(ids - removidas))
+    if clientes:
+        condicoes.append(Entrada.cliente_id.in_(clientes))
+    if condicoes:
+        # UPDATE direto: não volta a sujar os objetos da sessão nem provoca outro flush
+        session.connection().execute(
+            Entrada.__table__.update().where(or_(*condicoes))
+            .values(versao_relatorio=Entrada.__table__.c.versao_relatorio + 1)
+        )
+
+
+@event.listens_for(Session, 'after_commit')
+def _remover_relatorios(session):
+    for entrada_id in session.info.pop('relatorios_removidos', ()):
+        cache_relatorios.remover(entrada_id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _manter_relatorios(session, previous_transaction):
+    session.info.pop('relatorios_removidos', None)
+
+
+# --- AGREGAÇÃO DO DASHBOARD ---
+
+# Mapeia os valores gravados no banco para as chaves usadas pelos templates e pela API
+DASHBOARD_TIPOS = {'Pedido': 'pedidos', 'Orçamento': 'orcamentos'}
+DASHBOARD_STATUS = {'Não iniciado': 'nao_iniciado', 'Em andamento': 'em_andamento', 'Concluído': 'concluido'}
+
+# Cache do processo, indexado pela versão persistente: qualquer worker que veja
+# uma versão diferente da guardada recalcula, por isso não há leituras obsoletas.
+_dashboard_cache = {'dados': None, 'versao': None}
+_dashboard_lock = threading.Lock()
+
+
+def calcular_dashboard():
+    """Calcula todos os contadores do dashboard numa única consulta agrupada por (tipo, status)."""
+    dados = {
+        chave: {'total': 0, 'nao_iniciado': 0, 'em_andamento': 0, 'concluido': 0}
+        for chave in DASHBOARD_TIPOS.values()
     }
-    return {'pedidos': pedidos_dashboard, 'orcamentos': orcamentos_dashboard}
+    linhas = db.session.query(Entrada.tipo, Entrada.status, func.count(Entrada.id)).filter(
+        Entrada.arquivado == False,
+        Entrada.tipo.in_(DASHBOARD_TIPOS.keys())
+    ).group_by(Entrada.tipo, Entrada.status).all()
+
+    for tipo, status, quantidade in linhas:
+        contadores = dados[DASHBOARD_TIPOS[tipo]]
+        contadores['total'] += quantidade
+        if status in DASHBOARD_STATUS:
+            contadores[DASHBOARD_STATUS[status]] += quantidade
+    return dados
+
+
+def get_dashboard_data(versao=None):
+    """Retorna os contadores do dashboard, reutilizando o cache enquanto a versão do painel não mudar."""
+    if versao is None:
+        versao = obter_versao(VERSAO_PAINEL)[0]
+
+    with _dashboard_lock:
+        if _dashboard_cache['dados'] is not None and _dashboard_cache['versao'] == versao:
+            return copy.deepcopy(_dashboard_cache['dados'])
+
+    dados = calcular_dashboard()
+    with _dashboard_lock:
+        _dashboard_cache['dados'] = dados
+        _dashboard_cache['versao'] = versao
+    return copy.deepcopy(dados)
+
+# --- CAMADA DE PROJEÇÃO DAS LISTAGENS ---
+# As listagens (painel, API de tabelas, exportações) não precisam de entidades ORM completas:
+# buscam só as colunas usadas, com o cliente por JOIN e a contagem de anexos por subconsulta,
+# numa única instrução SQL, por isso o número de consultas não cresce com o número de linhas.
+
+CAMPOS_CLIENTE_DETALHADO = (
+    'telefone', 'tipo_pessoa', 'cpf_cnpj', 'como_conheceu', 'rua', 'numero_endereco',
+    'complemento', 'bairro', 'cidade', 'uf', 'cep', 'observacoes'
+)
+
+
+class LinhaCliente:
+    """Dados do cliente associados a uma linha de listagem (somente leitura)."""
+    __slots__ = ('id', 'numero_cliente', 'nome') + CAMPOS_CLIENTE_DETALHADO
+
+    def __init__(self, **campos):
+        for nome in self.__slots__:
+            setattr(self, nome, campos.get(nome))
+
+
+class LinhaAnexo:
+    """Anexo de uma linha de listagem (somente leitura)."""
+    __slots__ = ('id', 'filename', 'nome_original', 'entrada_id')
+
+    def __init__(self, id, filename, nome_original, entrada_id):
+        self.id = id
+        self.filename = filename
+        self.nome_original = nome_original
+        self.entrada_id = entrada_id
+
+    @property
+    def nome(self):
+        return self.nome_original or self.filename
+
+
+class LinhaEntrada:
+    """Linha de listagem de uma Entrada, com os mesmos nomes de atributos usados pelos templates."""
+    __slots__ = (
+        'id', 'tipo', 'numero_pedido', 'data_registro', 'cliente_nome_temp', 'obra', 'status',
+        'descricao', 'observacoes', 'arquivado', 'cliente', 'anexos_count', 'anexos'
+    )
+
+    def __init__(self, linha, cliente, anexos=None):
+        self.id = linha.id
+        self.tipo = linha.tipo
+        self.numero_pedido = linha.numero_pedido
+        self.data_registro = linha.data_registro
+        self.cliente_nome_temp = linha.cliente_nome_temp
+        self.obra = linha.obra
+        self.status = linha.status
+        self.descricao = linha.descricao
+        self.observacoes = linha.observacoes
+        self.arquivado = linha.arquivado
+        self.cliente = cliente
+        self.anexos_count = linha.anexos_count
+        self.anexos = anexos
+
+    @property
+    def nome_cliente(self):
+        return self.cliente.nome if self.cliente else self.cliente_nome_temp
+
+
+def consulta_projecao_entradas(detalhado=False):
+    """Monta o SELECT de projeção (Entrada + Cliente por OUTER JOIN + contagem de anexos).
+
+    Retorna um Select ao qual se podem acrescentar filtros (inclusive sobre Cliente) e ordenação.
+    """
+    contagem_anexos = db.select(func.count(Anexo.id)).where(
+        Anexo.entrada_id == Entrada.id
+    ).correlate(Entrada).scalar_subquery()
+
+    colunas = [
+        Entrada.id, Entrada.tipo, Entrada.numero_pedido, Entrada.data_registro,
+        Entrada.cliente_nome_temp, Entrada.obra, Entrada.status, Entrada.descricao,
+        Entrada.observacoes, Entrada.arquivado,
+        Cliente.id.label('cliente_id'), Cliente.numero_cliente.label('cliente_numero'),
+        Cliente.nome.label('cliente_nome'),
+        contagem_anexos.label('anexos_count')
+    ]
+    if detalhado:
+        colunas += [getattr(Cliente, campo).label(f'cliente_{campo}') for campo in CAMPOS_CLIENTE_DETALHADO]
+
+    return db.select(*colunas).select_from(Entrada).outerjoin(Cliente, Entrada.cliente_id == Cliente.id)
+
+
+def projetar_entradas(consulta, detalhado=False, com_anexos=False):
+    """Executa uma consulta de projeção e retorna objetos LinhaEntrada.
+
+    `com_anexos` carrega a lista de anexos de todas as linhas numa consulta adicional
+    (usada pelos modais do painel), em vez de uma consulta por entrada.
+    """
+    linhas = db.session.execute(consulta).all()
+
+    anexos_por_entrada = {}
+    if com_anexos:
+        ids_com_anexos = [linha.id for linha in linhas if linha.anexos_count]
+        if ids_com_anexos:
+            consulta_anexos = db.select(Anexo.id, Anexo.filename, Anexo.nome_original, Anexo.entrada_id).where(
+                Anexo.entrada_id.in_(ids_com_anexos)
+            ).order_by(Anexo.id)
+            for anexo in db.session.execute(consulta_anexos):
+                anexos_por_entrada.setdefault(anexo.entrada_id, []).append(
+                    LinhaAnexo(anexo.id, anexo.filename, anexo.nome_original, anexo.entrada_id)
+                )
+
+    resultado = []
+    for linha in linhas:
+        cliente = None
+        if linha.cliente_id is not None:
+            campos = {'id': linha.cliente_id, 'numero_cliente': linha.cliente_numero, 'nome': linha.cliente_nome}
+            if detalhado:
+                campos.update({campo: getattr(linha, f'cliente_{campo}') for campo in CAMPOS_CLIENTE_DETALHADO})
+            cliente = LinhaCliente(**campos)
+        anexos = anexos_por_entrada.get(linha.id, []) if com_anexos else None
+        resultado.append(LinhaEntrada(linha, cliente, anexos))
+    return resultado
+
+
+def _serializar_linha_painel(entrada):
+    """Converte uma LinhaEntrada no dicionário usado pelas tabelas do painel."""
+    cliente = entrada.cliente
+    dados = {
+        'id': entrada.id,
+        'tipo': entrada.tipo,
+        'data_cadastro': entrada.data_registro.strftime('%d/%m/%Y'),
+        'numero_pedido': entrada.numero_pedido,
+        'numero_cliente': cliente.numero_cliente if cliente else None,
+        'cliente_id': cliente.id if cliente else None,
+        'nome_cliente': entrada.nome_cliente,
+        'obra': entrada.obra,
+        'status': entrada.status,
+        'descricao': entrada.descricao[:50] + '...' if entrada.descricao and len(entrada.descricao) > 50 else entrada.descricao,
+        'observacoes': entrada.observacoes,
+        'anexos_count': entrada.anexos_count
+    }
+    if entrada.tipo == 'Orçamento':
+        dados['numero_orcamento'] = entrada.numero_pedido
+    return dados
+
+
+def _separar_por_tipo(entradas):
+    pedidos_data = [_serializar_linha_painel(e) for e in entradas if e.tipo == 'Pedido']
+    orcamentos_data = [_serializar_linha_painel(e) for e in entradas if e.tipo == 'Orçamento']
+    return pedidos_data, orcamentos_data
+
+
+# --- PAGINAÇÃO POR CURSOR (KEYSET) ---
+# Em vez de OFFSET, cada página começa depois (ou antes) da chave de ordenação da última
+# linha vista, por isso a página N custa o mesmo que a página 1. O cursor é opaco para o
+# navegador: base64 de {'k': chave, 'd': direção, 'p': posição da primeira linha}; a posição
+# serve apenas para o texto "Mostrando X a Y".
+
+class PaginaKeyset:
+    """Página de resultados com cursores para a página anterior e seguinte."""
+
+    def __init__(self, items, total, per_page, inicio, prev_cursor, next_cursor):
+        self.items = items
+        self.total = total
+        self.per_page = per_page
+        self.inicio = inicio
+        self.fim = inicio + len(items) - 1 if items else 0
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.has_prev = prev_cursor is not None
+        self.has_next = next_cursor is not None
+        self.page = (inicio - 1) // per_page + 1
+        self.pages = max(1, -(-total // per_page))
+
+
+def _codificar_cursor(chave, direcao, posicao):
+    valores = [valor.isoformat() if isinstance(valor, datetime) else valor for valor in chave]
+    dados = json.dumps({'k': valores, 'd': direcao, 'p': posicao}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(dados.encode()).decode().rstrip('=')
+
+
+# Limites de um BIGINT: valores fora deles num cursor alterado fariam a consulta falhar
+_INTEIRO_MINIMO, _INTEIRO_MAXIMO = -2 ** 63, 2 ** 63 - 1
+
+
+def _valor_cursor(coluna, valor):
+    """Valor da chave do cursor convertido para o tipo da coluna; ValueError se não corresponder."""
+    if isinstance(coluna.type, db.DateTime):
+        data = datetime.fromisoformat(valor)
+        if data.tzinfo is not None:
+            raise ValueError(valor)
+        return data
+    if isinstance(coluna.type, db.Integer):
+        if type(valor) is not int or not _INTEIRO_MINIMO <= valor <= _INTEIRO_MAXIMO:
+            raise ValueError(valor)
+        return valor
+    if not isinstance(valor, str):
+        raise ValueError(valor)
+    return valor
+
+
+def _decodificar_cursor(cursor, ordem):
+    """Retorna (chave, direcao, posicao) ou None se o cursor for inválido (volta à primeira página).
+
+    O cursor vem do navegador e pode ter sido alterado: cada valor da chave tem de ter o tipo
+    da sua coluna, para nunca chegar ao banco uma comparação que faça a consulta falhar.
+    """
+    try:
+        dados = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        chave = [_valor_cursor(coluna, valor) for (coluna, _), valor in zip(ordem, dados['k'], strict=True)]
+        if dados['d'] not in ('n', 'p') or type(dados['p']) is not int:
+            return None
+        return chave, dados['d'], min(max(1, dados['p']), _INTEIRO_MAXIMO)
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def _condicao_apos(ordem, chave, para_tras):
+    """Condição "linha vem depois da chave" na ordem dada ((coluna, descendente), ...), expandida em OR/AND."""
+    alternativas = []
+    for i, (coluna, descendente) in enumerate(ordem):
+        depois = descendente != para_tras
+        comparacao = coluna < chave[i] if depois else coluna > chave[i]
+        iguais = [ordem[j][0] == chave[j] for j in range(i)]
+        alternativas.append(db.and_(*iguais, comparacao))
+    return or_(*alternativas)
+
+
+def paginar_keyset(consulta, ordem, cursor, per_page, total, executar):
+    """Pagina uma instrução SELECT por keyset.
+
+    `ordem` é uma sequência de (coluna, descendente) que identifica cada linha de forma única;
+    `executar` recebe o SELECT e retorna a lista de objetos, que expõem os atributos das colunas.
+    """
+    decodificado = _decodificar_cursor(cursor, ordem) if cursor else None
+    chave, direcao, posicao = decodificado or (None, 'n', 1)
+    para_tras = direcao == 'p'
+
+    def ordenar(consulta_base, invertida):
+        return consulta_base.order_by(*[
+            (coluna.asc() if descendente == invertida else coluna.desc()) for coluna, descendente in ordem
+        ])
+
+    if chave is not None:
+        consulta_pagina = consulta.where(_condicao_apos(ordem, chave, para_tras))
+    else:
+        consulta_pagina = consulta
+    items = executar(ordenar(consulta_pagina, para_tras).limit(per_page + 1))
+    mais = len(items) > per_page
+    items = items[:per_page]
+
+    if para_tras:
+        items.reverse()
+        if not mais:
+            # Chegou ao início: mostra a primeira página completa
+            items = executar(ordenar(consulta, False).limit(per_page + 1))
+            mais_frente = len(items) > per_page
+            items = items[:per_page]
+            posicao = 1
+        else:
+            mais_frente = True
+        tem_anterior = posicao > 1
+    else:
+        mais_frente = mais
+        tem_anterior = chave is not None
+
+    def chave_de(item):
+        return [getattr(item, coluna.key) for coluna, _ in ordem]
+
+    prev_cursor = next_cursor = None
+    if items and tem_anterior:
+        prev_cursor = _codificar_cursor(chave_de(items[0]), 'p', max(1, posicao - per_page))
+    if items and mais_frente:
+        next_cursor = _codificar_cursor(chave_de(items[-1]), 'n', posicao + len(items))
+    return PaginaKeyset(items, total, per_page, posicao, prev_cursor, next_cursor)
+
+
+# Totais por combinação de filtros, válidos enquanto a versão persistente não mudar
+_contagens_cache = {}
+_contagens_lock = threading.Lock()
+CONTAGENS_MAXIMAS = 256
+
+
+def contar_com_cache(chave_versao, filtros, consulta):
+    """COUNT(*) de `consulta`, guardado por (chave_versao, filtros) e invalidado quando a versão muda."""
+    versao = obter_versao(chave_versao)[0]
+    chave = (chave_versao, filtros)
+    with _contagens_lock:
+        guardado = _contagens_cache.get(chave)
+        if guardado is not None and guardado[0] == versao:
+            return guardado[1]
+
+    total = db.session.execute(
+        consulta.with_only_columns(func.count(), maintain_column_froms=True).order_by(None)
+    ).scalar_one()
+
+    with _contagens_lock:
+        if len(_contagens_cache) >= CONTAGENS_MAXIMAS:
+            _contagens_cache.clear()
+        _contagens_cache[chave] = (versao, total)
+    return total
+
+
+def filtros_painel(search_query='', selected_status=''):
+    """Condições das tabelas do painel: entradas ativas, mais busca e status opcionais."""
+    filtros = [Entrada.arquivado == False]
+
+    if search_query:
+        # O filtro de busca procura no número, na descrição e no nome do cliente (cadastrado ou temporário)
+        filtros.append(condicao_busca(search_query, ('numero', 'descricao', 'cliente')))
+
+    if selected_status:
+        filtros.append(Entrada.status == selected_status)
+
+    return filtros
+
+
+def buscar_janela_painel(tipo, apos=None, limite=None, filtros=None, detalhado=False):
+    """Retorna (linhas, proximo_cursor) de uma janela de entradas do tipo indicado.
+
+    Paginação keyset: as linhas seguem `numero_pedido` crescente a partir de `apos`
+    (exclusivo), sem OFFSET. `proximo_cursor` é o número do pedido da última linha
+    da janela, ou None quando não há mais linhas.
+    """
+    limite = limite or app.config['PAINEL_JANELA']
+    consulta = consulta_projecao_entradas(detalhado=detalhado).where(
+        Entrada.tipo == tipo, *(filtros if filtros is not None else filtros_painel())
+    )
+    if apos is not None:
+        consulta = consulta.where(Entrada.numero_pedido > apos)
+
+    # Uma linha a mais indica se existe uma próxima janela
+    linhas = projetar_entradas(consulta.order_by(Entrada.numero_pedido.asc()).limit(limite + 1), detalhado=detalhado)
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        return linhas, linhas[-1].numero_pedido
+    return linhas, None
+
 
 def get_table_data():
-    """Retorna dados completos das tabelas para atualizações em tempo real"""
-    pedidos = Entrada.query.filter_by(tipo='Pedido', arquivado=False).order_by(Entrada.numero_pedido.asc()).all()
-    orcamentos = Entrada.query.filter_by(tipo='Orçamento', arquivado=False).order_by(Entrada.numero_pedido.asc()).all()
-    
-    pedidos_data = []
-    for pedido in pedidos:
-        cliente_nome = pedido.cliente.nome if pedido.cliente else pedido.cliente_nome_temp
-        numero_cliente = pedido.cliente.numero_cliente if pedido.cliente else None
-        cliente_id = pedido.cliente.id if pedido.cliente else None
-        pedidos_data.append({
-            'id': pedido.id,
-            'data_cadastro': pedido.data_registro.strftime('%d/%m/%Y'),
-            'numero_pedido': pedido.numero_pedido,
-            'numero_cliente': numero_cliente,
-            'cliente_id': cliente_id,
-            'nome_cliente': cliente_nome,
-            'obra': pedido.obra,
-            'status': pedido.status,
-            'descricao': pedido.descricao[:50] + '...' if pedido.descricao and len(pedido.descricao) > 50 else pedido.descricao,
-            'observacoes': pedido.observacoes,
-            'anexos_count': len(pedido.anexos)
-        })
-    
-    orcamentos_data = []
-    for orcamento in orcamentos:
-        cliente_nome = orcamento.cliente.nome if orcamento.cliente else orcamento.cliente_nome_temp
-        numero_cliente = orcamento.cliente.numero_cliente if orcamento.cliente else None
-        cliente_id = orcamento.cliente.id if orcamento.cliente else None
-        orcamentos_data.append({
-            'id': orcamento.id,
-            'data_cadastro': orcamento.data_registro.strftime('%d/%m/%Y'),
-            'numero_orcamento': orcamento.numero_pedido,
-            'numero_cliente': numero_cliente,
-            'cliente_id': cliente_id,
-            'nome_cliente': cliente_nome,
-            'obra': orcamento.obra,
-            'status': orcamento.status,
-            'descricao': orcamento.descricao[:50] + '...' if orcamento.descricao and len(orcamento.descricao) > 50 else orcamento.descricao,
-            'observacoes': orcamento.observacoes,
-            'anexos_count': len(orcamento.anexos)
-        })
-    
-    return {'pedidos_data': pedidos_data, 'orcamentos_data': orcamentos_data}
+    """Retorna a primeira janela de cada tabela para atualizações em tempo real"""
+    pedidos, cursor_pedidos = buscar_janela_painel('Pedido')
+    orcamentos, cursor_orcamentos = buscar_janela_painel('Orçamento')
+    return {
+        'modo': 'completo',
+        'pedidos_data': [_serializar_linha_painel(e) for e in pedidos],
+        'orcamentos_data': [_serializar_linha_painel(e) for e in orcamentos],
+        'pedidos_cursor': cursor_pedidos,
+        'orcamentos_cursor': cursor_orcamentos
+    }
+
+
+def get_table_delta(desde, versao_atual):
+    """Retorna apenas as linhas alteradas depois da versão `desde`, mais os ids removidos do painel.
+
+    Retorna None quando `desde` já não pode ser servido pelo registo de alterações
+    (versão futura ou mais antiga do que o registo retido); nesse caso usa-se a carga completa.
+    """
+    if desde > versao_atual or desde < versao_atual - ALTERACOES_RETIDAS:
+        return None
+
+    alterados = {
+        entrada_id for (entrada_id,) in db.session.query(AlteracaoEntrada.entrada_id)
+        .filter(AlteracaoEntrada.versao > desde, AlteracaoEntrada.versao <= versao_atual)
+        .distinct()
+    }
+    entradas = []
+    if alterados:
+        entradas = projetar_entradas(consulta_projecao_entradas().where(
+            Entrada.id.in_(alterados),
+            Entrada.tipo.in_(DASHBOARD_TIPOS.keys()),
+            Entrada.arquivado == False
+        ).order_by(Entrada.numero_pedido.asc()))
+
+    pedidos_data, orcamentos_data = _separar_por_tipo(entradas)
+    # Tombstones: entradas alteradas que já não pertencem ao painel (excluídas ou arquivadas)
+    removidos = sorted(alterados - {e.id for e in entradas})
+    return {
+        'modo': 'delta',
+        'desde': desde,
+        'pedidos_data': pedidos_data,
+        'orcamentos_data': orcamentos_data,
+        'removidos': removidos
+    }
 
 @app.template_filter('format_phone')
 def format_phone_filter(s):
@@ -249,6 +1027,23 @@ def format_phone_filter(s):
         return s # Retorna o original se não for um número de 11 dígitos
     return f"({s[0:2]}) {s[2]} {s[3:7]}-{s[7:11]}"
 
+@app.template_filter('numero_br')
+def numero_br_filter(valor, casas=2):
+    """Formata um número como 1.234,56."""
+    if valor is None:
+        return ''
+    return f"{valor:,.{casas}f}".replace(',', '_').replace('.', ',').replace('_', '.')
+
+@app.errorhandler(RequestEntityTooLarge)
+def pedido_demasiado_grande(erro):
+    """Corpo acima de MAX_CONTENT_LENGTH: JSON para os pedidos via fetch, flash nos formulários."""
+    limite = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    mensagem = f'O envio excede o tamanho máximo de {limite} MB por pedido.'
+    if request.accept_mimetypes.best != 'text/html':
+        return jsonify({'success': False, 'message': mensagem}), 413
+    flash(mensagem, 'danger')
+    return redirect(request.referrer or url_for('inicio'))
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
@@ -283,39 +1078,23 @@ def inicio():
 def painel_controle():
     search_query = request.args.get('q', '')
     selected_status = request.args.get('status', '')
+    # Lida antes das linhas: o cliente sincroniza a partir desta versão sem perder alterações
+    versao_painel = obter_versao(VERSAO_PAINEL)[0]
 
-    # Usamos outerjoin para incluir entradas mesmo que não tenham cliente_id
-    pedidos_base_query = Entrada.query.outerjoin(Cliente).filter(
-        Entrada.tipo == 'Pedido', 
-        Entrada.arquivado == False
-    )
-    orcamentos_base_query = Entrada.query.outerjoin(Cliente).filter(
-        Entrada.tipo == 'Orçamento', 
-        Entrada.arquivado == False
-    )
-
-    if search_query:
-        search_term = f"%{search_query}%"
-        # O filtro de busca agora procura em 4 lugares diferentes
-        search_filter = or_(
-            cast(Entrada.numero_pedido, db.String).ilike(search_term),
-            Entrada.descricao.ilike(search_term),
-            Cliente.nome.ilike(search_term),
-            Entrada.cliente_nome_temp.ilike(search_term)
-        )
-        pedidos_base_query = pedidos_base_query.filter(search_filter)
-        orcamentos_base_query = orcamentos_base_query.filter(search_filter)
-    
-    if selected_status:
-        pedidos_base_query = pedidos_base_query.filter(Entrada.status == selected_status)
-        orcamentos_base_query = orcamentos_base_query.filter(Entrada.status == selected_status)
-        
-    pedidos = pedidos_base_query.order_by(Entrada.numero_pedido).all()
-    orcamentos = orcamentos_base_query.order_by(Entrada.numero_pedido).all()
+    # Apenas a primeira janela de cada tabela; as seguintes chegam por /api/painel/linhas
+    filtros = filtros_painel(search_query, selected_status)
+    pedidos, cursor_pedidos = buscar_janela_painel('Pedido', filtros=filtros)
+    orcamentos, cursor_orcamentos = buscar_janela_painel('Orçamento', filtros=filtros)
     
-    dashboard_data = get_dashboard_data()
+    dashboard_data = get_dashboard_data(versao_painel)
     
-    return render_template('painel_controle.html', dashboard=dashboard_data, pedidos=pedidos, orcamentos=orcamentos, search_query=search_query, selected_status=selected_status)
+    return render_template(
+        'painel_controle.html', dashboard=dashboard_data, pedidos=pedidos, orcamentos=orcamentos,
+        pedidos_data=[_serializar_linha_painel(e) for e in pedidos],
+        orcamentos_data=[_serializar_linha_painel(e) for e in orcamentos],
+        cursor_pedidos=cursor_pedidos, cursor_orcamentos=cursor_orcamentos,
+        search_query=search_query, selected_status=selected_status, versao_painel=versao_painel
+    )
 
 @app.route('/novo', methods=['GET', 'POST'])
 @login_required
@@ -360,16 +1139,12 @@ def nova_entrada():
         # --- FIM DA LÓGICA ---
 
         db.session.add(nova_entrada_obj)
-        uploaded_files = request.files.getlist('anexos')
-        for ficheiro in uploaded_files:
-            if ficheiro and ficheiro.filename != '':
-                anexo_filename = secure_filename(ficheiro.filename)
-                ficheiro.save(os.path.join(app.config['UPLOAD_FOLDER'], anexo_filename))
-                novo_anexo = Anexo(filename=anexo_filename, entrada=nova_entrada_obj)
-                db.session.add(novo_anexo)
-        db.session.commit()
-        global last_update_time
-        last_update_time = datetime.now()
+        try:
+            guardar_anexos(request.files.getlist('anexos'), nova_entrada_obj)
+            db.session.commit()
+        except Exception:
+            desfazer_anexos()
+            raise
         flash(f"{nova_entrada_obj.tipo} criado com sucesso!", 'success')
         return redirect(url_for('painel_controle'))
 
@@ -403,17 +1178,12 @@ def editar_entrada(id):
         # --- FIM DA NOVA LÓGICA ---
 
         # Lógica para adicionar novos anexos (se houver)
-        uploaded_files = request.files.getlist('anexos')
-        for ficheiro in uploaded_files:
-            if ficheiro and ficheiro.filename != '':
-                anexo_filename = secure_filename(ficheiro.filename)
-                ficheiro.save(os.path.join(app.config['UPLOAD_FOLDER'], anexo_filename))
-                novo_anexo = Anexo(filename=anexo_filename, entrada=entrada)
-                db.session.add(novo_anexo)
-                
-        db.session.commit()
-        global last_update_time
-        last_update_time = datetime.now()
+        try:
+            guardar_anexos(request.files.getlist('anexos'), entrada)
+            db.session.commit()
+        except Exception:
+            desfazer_anexos()
+            raise
         flash(f'{entrada.tipo} atualizado com sucesso!', 'success')
         return redirect(url_for('painel_controle'))
         
@@ -424,12 +1194,10 @@ def editar_entrada(id):
 def excluir_anexo(anexo_id):
     anexo = Anexo.query.get_or_404(anexo_id)
     entrada_id = anexo.entrada_id
-    try:
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], anexo.filename))
-    except FileNotFoundError:
-        pass
+    ficheiro = anexo.filename
     db.session.delete(anexo)
     db.session.commit()
+    remover_ficheiros_orfaos([ficheiro])
     # socketio.emit('update_data')
     flash('Anexo excluído com sucesso.', 'success')
     return redirect(url_for('editar_entrada', id=entrada_id))
@@ -437,17 +1205,12 @@ def excluir_anexo(anexo_id):
 @app.route('/excluir/<int:id>', methods=['POST'])
 @login_required
 def excluir_entrada(id):
-    global last_update_time
     entrada_a_excluir = Entrada.query.get_or_404(id)
-    for anexo in entrada_a_excluir.anexos:
-        try:
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], anexo.filename))
-        except FileNotFoundError:
-            pass
+    ficheiros = [anexo.filename for anexo in entrada_a_excluir.anexos]
     db.session.delete(entrada_a_excluir)
     db.session.commit()
+    remover_ficheiros_orfaos(ficheiros)
     # socketio.emit('update_data')
-    last_update_time = datetime.now()
     tipo_entrada = entrada_a_excluir.tipo
     if entrada_a_excluir.arquivado:
         flash(f'{tipo_entrada} arquivado foi excluído permanentemente!', 'danger')
@@ -455,46 +1218,130 @@ def excluir_entrada(id):
     flash(f'{tipo_entrada} foi excluído com sucesso!', 'danger')
     return redirect(url_for('painel_controle'))
 
-# Variável global para controlar atualizações
-last_update_time = datetime.now()
-
 @app.route('/atualizar-status/<int:id>', methods=['POST'])
 @login_required
 def atualizar_status(id):
-    global last_update_time
     entrada = Entrada.query.get_or_404(id)
     data = request.get_json()
     novo_status = data.get('status')
     if novo_status in ['Não iniciado', 'Em andamento', 'Concluído']:
         entrada.status = novo_status
         db.session.commit()
-        last_update_time = datetime.now()
         novos_dados_dashboard = get_dashboard_data()
         return jsonify({'success': True, 'message': 'Status atualizado com sucesso!', 'dashboard': novos_dados_dashboard})
     return jsonify({'success': False, 'message': 'Status inválido.'}), 400
 
-# Rota SSE removida - não é mais necessária
+@app.route('/api/eventos')
+@login_required
+def api_eventos():
+    """Canal Server-Sent Events: envia a versão do painel sempre que os dados mudam."""
+    if not app.config['PAINEL_PUSH_ATIVO']:
+        return jsonify({'success': False, 'message': 'Atualização em tempo real desativada'}), 404
+
+    versao_inicial = obter_versao(VERSAO_PAINEL)[0]
+    # Liberta a ligação ao banco: o fluxo pode ficar aberto durante minutos
+    db.session.remove()
+    assinatura = broker_eventos.assinar()
+    duracao = app.config['PAINEL_PUSH_DURACAO']
+
+    def gerar():
+        try:
+            yield 'retry: 3000\n\n'
+            yield f"event: painel\ndata: {json.dumps({'versao': versao_inicial})}\n\n"
+            limite = time.monotonic() + duracao
+            while time.monotonic() < limite:
+                evento = assinatura.obter(timeout=15)
+                if evento is None:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f"event: painel\ndata: {json.dumps(evento)}\n\n"
+        finally:
+            assinatura.cancelar()
+
+    return Response(gerar(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 
 @app.route('/api/dashboard_data')
 @login_required
 def api_dashboard_data():
-    """API para fornecer dados completos do dashboard e tabelas para atualização automática"""
+    """API para fornecer dados completos do dashboard e tabelas para atualização automática.
+
+    A resposta leva um ETag forte derivado da versão persistente do painel; um pedido
+    com If-None-Match igual recebe 304 sem que as tabelas sejam consultadas.
+    Com `since=<versao>` as tabelas vêm em modo delta (linhas alteradas e ids removidos).
+    """
     try:
-        dashboard_data = get_dashboard_data()
-        table_data = get_table_data()
+        versao, atualizado_em = obter_versao(VERSAO_PAINEL)
+        etag = f'painel-v{versao}'
+        desde = request.args.get('since', type=int)
+        if request.if_none_match.contains(etag):
+            resposta = Response(status=304)
+        else:
+            dashboard_data = get_dashboard_data(versao)
+            table_data = get_table_delta(desde, versao) if desde is not None else None
+            if table_data is None:
+                table_data = get_table_data()
+            resposta = jsonify({
+                'success': True,
+                'versao': versao,
+                'dashboard': dashboard_data,
+                'tables': table_data,
+                'timestamp': atualizado_em.isoformat() if atualizado_em else None,
+                'server_time': atualizado_em.strftime('%H:%M:%S') if atualizado_em else None
+            })
+        resposta.set_etag(etag)
+        # Permite guardar a resposta, mas obriga a revalidar em cada atualização
+        resposta.headers['Cache-Control'] = 'private, no-cache'
+        return resposta
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Erro ao obter dados: {str(e)}'
+        }), 500
+
+@app.route('/api/painel/linhas')
+@login_required
+def api_painel_linhas():
+    """Próxima janela de uma tabela do painel (paginação keyset por número do pedido).
+
+    Parâmetros: `tipo` ('Pedido' ou 'Orçamento'), `apos` (cursor devolvido pela janela
+    anterior), `limite`, e os mesmos filtros da página (`q` e `status`).
+    """
+    tipo = request.args.get('tipo', 'Pedido')
+    if tipo not in DASHBOARD_TIPOS:
+        return jsonify({'success': False, 'message': 'Tipo inválido.'}), 400
+    apos = request.args.get('apos', type=int)
+    limite = min(request.args.get('limite', app.config['PAINEL_JANELA'], type=int), PAINEL_JANELA_MAXIMA)
+    try:
+        filtros = filtros_painel(request.args.get('q', ''), request.args.get('status', ''))
+        linhas, proximo_cursor = buscar_janela_painel(tipo, apos=apos, limite=max(limite, 1), filtros=filtros)
         return jsonify({
             'success': True,
-            'dashboard': dashboard_data,
-            'tables': table_data,
-            'timestamp': datetime.now().isoformat(),
-            'server_time': datetime.now().strftime('%H:%M:%S')
+            'linhas': [_serializar_linha_painel(e) for e in linhas],
+            'proximo_cursor': proximo_cursor
         })
     except Exception as e:
         return jsonify({
             'success': False,
-            'message': f'Erro ao obter dados: {str(e)}'
+            'message': f'Erro ao obter linhas: {str(e)}'
         }), 500
 
+@app.route('/api/entrada/<int:entrada_id>/modais')
+@login_required
+def api_entrada_modais(entrada_id):
+    """Fragmento HTML com os modais de uma entrada (cliente, detalhes, anexos), carregado sob demanda pelo painel."""
+    entradas = projetar_entradas(
+        consulta_projecao_entradas(detalhado=True).where(Entrada.id == entrada_id),
+        detalhado=True,
+        com_anexos=True
+    )
+    if not entradas:
+        abort(404)
+    return render_template('painel_modais_entrada.html', entrada=entradas[0])
+
 @app.route('/api/entrada/<int:entrada_id>/anexos')
 @login_required
 def api_entrada_anexos(entrada_id):
@@ -506,7 +1353,7 @@ def api_entrada_anexos(entrada_id):
             anexos_data.append({
                 'id': anexo.id,
                 'filename': anexo.filename,
-                'original_filename': anexo.filename  # Usar filename como original_filename
+                'original_filename': anexo.nome
             })
         return jsonify({
             'success': True,
@@ -526,8 +1373,6 @@ def converter_para_pedido(id):
         orcamento.tipo = 'Pedido'
         orcamento.status = 'Não iniciado'
         db.session.commit()
-        global last_update_time
-        last_update_time = datetime.now()
         flash(f"Orçamento #{orcamento.numero_pedido} foi convertido em Pedido com sucesso!", 'success')
     else:
         flash('Esta entrada já é um Pedido.', 'warning')
@@ -539,8 +1384,6 @@ def arquivar_entrada(id):
     entrada = Entrada.query.get_or_404(id)
     entrada.arquivado = True
     db.session.commit()
-    global last_update_time
-    last_update_time = datetime.now()
     flash(f'{entrada.tipo} #{entrada.numero_pedido} foi arquivado com sucesso.', 'success')
     return redirect(url_for('painel_controle'))
 
@@ -582,19 +1425,15 @@ def bulk_action():
             
         elif action == 'delete':
             # Exclui as entradas selecionadas
+            ficheiros = []
             for entrada in entradas:
-                # Remove anexos físicos
-                for anexo in entrada.anexos:
-                    try:
-                        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], anexo.filename))
-                    except FileNotFoundError:
-                        pass
+                ficheiros.extend(anexo.filename for anexo in entrada.anexos)
                 # Remove a entrada do banco
                 db.session.delete(entrada)
             
             db.session.commit()
-            global last_update_time
-            last_update_time = datetime.now()
+            # Remove os anexos físicos que deixaram de ser usados
+            remover_ficheiros_orfaos(ficheiros)
             return jsonify({
                 'success': True, 
                 'message': f'{len(entradas)} entrada(s) excluída(s) com sucesso'
@@ -643,17 +1482,15 @@ def bulk_action_archived():
             
         elif action == 'delete':
             # Exclui permanentemente as entradas selecionadas
+            ficheiros = []
             for entrada in entradas:
-                # Remove anexos físicos
-                for anexo in entrada.anexos:
-                    try:
-                        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], anexo.filename))
-                    except FileNotFoundError:
-                        pass
+                ficheiros.extend(anexo.filename for anexo in entrada.anexos)
                 # Remove a entrada do banco
                 db.session.delete(entrada)
             
             db.session.commit()
+            # Remove os anexos físicos que deixaram de ser usados
+            remover_ficheiros_orfaos(ficheiros)
             return jsonify({
                 'success': True, 
                 'message': f'{len(entradas)} entrada(s) excluída(s) permanentemente com sucesso'
@@ -726,102 +1563,56 @@ def desarquivar_entrada(id):
     entrada = Entrada.query.get_or_404(id)
     entrada.arquivado = False
     db.session.commit()
-    global last_update_time
-    last_update_time = datetime.now()
     flash(f'{entrada.tipo} #{entrada.numero_pedido} foi restaurado com sucesso.', 'success')
     return redirect(url_for('pedidos_arquivados'))
 
 @app.route('/arquivados')
 @login_required
 def pedidos_arquivados():
-    """Exibe a página de pedidos e orçamentos arquivados com paginação e filtros (30 itens por página)."""
+    """Exibe a página de pedidos e orçamentos arquivados com paginação por cursor e filtros (30 itens por página)."""
     # Parâmetros de filtro
     search_numero = request.args.get('search_numero', '').strip()
     search_cliente = request.args.get('search_cliente', '').strip()
     search_descricao = request.args.get('search_descricao', '').strip()
     filter_status = request.args.get('filter_status', '')
     filter_tipo = request.args.get('filter_tipo', '')
-    page_pedidos = request.args.get('pedidos_page', 1, type=int)
-    page_orcamentos = request.args.get('orcamentos_page', 1, type=int)
+    cursor_pedidos = request.args.get('pedidos_cursor', '')
+    cursor_orcamentos = request.args.get('orcamentos_cursor', '')
     per_page = 30  # Limite de 30 itens por página
 
-    # Query base para entradas arquivadas
-    base_query = Entrada.query.filter_by(arquivado=True)
-    
-    # Aplicar filtro por tipo se especificado
-    if filter_tipo:
-        base_query = base_query.filter(Entrada.tipo == filter_tipo)
-    
-    # Aplicar filtro por número se especificado
+    # Filtros comuns às duas tabelas (a projeção já faz OUTER JOIN com Cliente)
+    filtros = [Entrada.arquivado == True]
     if search_numero:
-        base_query = base_query.filter(Entrada.numero_pedido.ilike(f'%{search_numero}%'))
-    
-    # Aplicar filtro por cliente se especificado
+        filtros.append(condicao_busca(search_numero, ('numero',)))
     if search_cliente:
-        base_query = base_query.join(Cliente, Entrada.cliente_id == Cliente.id, isouter=True).filter(
-            db.or_(
-                Cliente.nome.ilike(f'%{search_cliente}%'),
-                Entrada.cliente_nome_temp.ilike(f'%{search_cliente}%')
-            )
-        )
-    
-    # Aplicar filtro por descrição se especificado
+        filtros.append(condicao_busca(search_cliente, ('cliente',)))
     if search_descricao:
-        base_query = base_query.filter(Entrada.obra.ilike(f'%{search_descricao}%'))
-    
-    # Aplicar filtro por status se especificado
+        filtros.append(condicao_busca(search_descricao, ('obra',)))
     if filter_status:
-        base_query = base_query.filter(Entrada.status == filter_status)
-    
-    # Query para pedidos arquivados - criar uma nova query baseada na base_query
-    if not filter_tipo or filter_tipo == 'Pedido':
-        pedidos_query = Entrada.query.filter_by(arquivado=True).filter(Entrada.tipo == 'Pedido')
-        # Aplicar os mesmos filtros da base_query
-        if search_numero:
-            pedidos_query = pedidos_query.filter(Entrada.numero_pedido.ilike(f'%{search_numero}%'))
-        if search_cliente:
-            pedidos_query = pedidos_query.join(Cliente, Entrada.cliente_id == Cliente.id, isouter=True).filter(
-                db.or_(
-                    Cliente.nome.ilike(f'%{search_cliente}%'),
-                    Entrada.cliente_nome_temp.ilike(f'%{search_cliente}%')
-                )
-            )
-        if search_descricao:
-            pedidos_query = pedidos_query.filter(Entrada.obra.ilike(f'%{search_descricao}%'))
-        if filter_status:
-            pedidos_query = pedidos_query.filter(Entrada.status == filter_status)
-    else:
-        pedidos_query = Entrada.query.filter_by(id=-1)  # Query vazia se filtro não for Pedido
-    
-    # Query para orçamentos arquivados - criar uma nova query baseada na base_query
-    if not filter_tipo or filter_tipo == 'Orçamento':
-        orcamentos_query = Entrada.query.filter_by(arquivado=True).filter(Entrada.tipo == 'Orçamento')
-        # Aplicar os mesmos filtros da base_query
-        if search_numero:
-            orcamentos_query = orcamentos_query.filter(Entrada.numero_pedido.ilike(f'%{search_numero}%'))
-        if search_cliente:
-            orcamentos_query = orcamentos_query.join(Cliente, Entrada.cliente_id == Cliente.id, isouter=True).filter(
-                db.or_(
-                    Cliente.nome.ilike(f'%{search_cliente}%'),
-                    Entrada.cliente_nome_temp.ilike(f'%{search_cliente}%')
-                )
-            )
-        if search_descricao:
-            orcamentos_query = orcamentos_query.filter(Entrada.obra.ilike(f'%{search_descricao}%'))
-        if filter_status:
-            orcamentos_query = orcamentos_query.filter(Entrada.status == filter_status)
-    else:
-        orcamentos_query = Entrada.query.filter_by(id=-1)  # Query vazia se filtro não for Orçamento
-    
-    # Paginação para pedidos
-    pedidos_paginados = pedidos_query.order_by(Entrada.data_registro.desc()).paginate(
-        page=page_pedidos, per_page=per_page, error_out=False
-    )
-    
-    # Paginação para orçamentos
-    orcamentos_paginados = orcamentos_query.order_by(Entrada.data_registro.desc()).paginate(
-        page=page_orcamentos, per_page=per_page, error_out=False
-    )
+        filtros.append(Entrada.status == filter_status)
+    chave_filtros = (search_numero, search_cliente, search_descricao, filter_status)
+
+    # Mais recentes primeiro; o id desempata registos com a mesma data
+    ordem = ((Entrada.data_registro, True), (Entrada.id, True))
+
+    def paginar(tipo, cursor):
+        if filter_tipo and filter_tipo != tipo:
+            return PaginaKeyset([], 0, per_page, 1, None, None)
+        consulta = consulta_projecao_entradas(detalhado=True).where(Entrada.tipo == tipo, *filtros)
+        total = contar_com_cache(VERSAO_PAINEL, ('arquivados', tipo) + chave_filtros, consulta)
+        return paginar_keyset(
+            consulta, ordem, cursor, per_page, total,
+            lambda instrucao: projetar_entradas(instrucao, detalhado=True, com_anexos=True)
+        )
+
+    pedidos_paginados = paginar('Pedido', cursor_pedidos)
+    orcamentos_paginados = paginar('Orçamento', cursor_orcamentos)
+
+    # Parâmetros preservados nos links de paginação de cada tabela
+    filtros_url = {
+        'search_numero': search_numero, 'search_cliente': search_cliente,
+        'search_descricao': search_descricao, 'filter_status': filter_status, 'filter_tipo': filter_tipo
+    }
 
     return render_template('pedidos_arquivados.html', 
                          pedidos=pedidos_paginados, 
@@ -831,8 +1622,17 @@ def pedidos_arquivados():
                          search_descricao=search_descricao,
                          filter_status=filter_status,
                          filter_tipo=filter_tipo,
-                         pedidos_page=page_pedidos,
-                         orcamentos_page=page_orcamentos)
+                         pedidos_cursor=cursor_pedidos,
+                         orcamentos_cursor=cursor_orcamentos,
+                         filtros_url=filtros_url)
+
+
+@app.route('/api/sistema/pool')
+@login_required
+@admin_required
+def api_estado_pool():
+    """Estado do pool de ligações deste worker (em uso, excedente, tempos de espera)."""
+    return jsonify({'success': True, 'pool': estado_pool(db.engine, app.config['DB_POOL_MODO'], telemetria_pool)})
 
 
 @app.route('/gerir_usuarios', methods=['GET', 'POST'])
@@ -873,15 +1673,196 @@ def excluir_usuario(user_id):
     return redirect(url_for('gerir_usuarios'))
     
 
+# --- ENTREGA DOS ANEXOS ---
+# Os ficheiros guardados pelo conteúdo (ver armazenamento.py) nunca mudam no mesmo endereço:
+# têm o SHA-256 como ETag e cache de um ano sem revalidação. Os ficheiros com nomes antigos
+# são revalidados a cada uso (ETag da data e tamanho). A cache é "private" porque os anexos
+# exigem login.
+
+CACHE_IMUTAVEL = 365 * 24 * 3600
+
+
+def _enviar_anexo(caminho, etag=True, imutavel=False, **opcoes):
+    """Resposta para um ficheiro da pasta de uploads, com validadores, Range e cache.
+
+    `etag` é um validador forte do conteúdo ou True para o do Werkzeug. Com ANEXOS_ENTREGA
+    'nginx' ou 'sendfile' o corpo fica a cargo do proxy e aqui só se responde ao If-None-Match.
+    """
+    modo = app.config['ANEXOS_ENTREGA']
+    if modo == 'flask':
+        resposta = send_file(caminho, etag=etag, conditional=True, **opcoes)
+    else:
+        resposta = send_file(caminho, etag=etag, conditional=False, **opcoes)
+        resposta.close()
+        resposta.response = []
+        resposta.headers.pop('Content-Length', None)
+        if modo == 'nginx':
+            relativo = os.path.relpath(caminho, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+            resposta.headers['X-Accel-Redirect'] = app.config['ANEXOS_ACCEL_PREFIXO'] + urllib.parse.quote(relativo)
+        else:
+            resposta.headers['X-Sendfile'] = os.path.abspath(caminho)
+        resposta = resposta.make_conditional(request, accept_ranges=False)
+        if resposta.status_code == 304:
+            resposta.headers.pop('X-Accel-Redirect', None)
+            resposta.headers.pop('X-Sendfile', None)
+
+    resposta.cache_control.private = True
+    if imutavel:
+        resposta.cache_control.no_cache = None
+        resposta.cache_control.max_age = CACHE_IMUTAVEL
+        resposta.cache_control.immutable = True
+    return resposta
+
+
 @app.route('/uploads/<filename>')
 @login_required
 def uploaded_file(filename):
-    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-    # Adiciona o cabeçalho que sugere a visualização "inline"
-    response.headers['Content-Disposition'] = f'inline; filename="{filename}"'
+    # Visualização "inline" com o nome com que o ficheiro foi enviado (usado ao descarregar).
+    # O mesmo ficheiro pode ser de vários anexos, com nomes diferentes: o nome vem do anexo
+    # indicado em ?anexo=<id>; sem ele fica o nome guardado.
+    caminho = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if caminho is None or not os.path.isfile(caminho):
+        abort(404)
+    hash_conteudo = hash_do_nome(filename)
+    anexo_id = request.args.get('anexo', type=int)
+    anexo = db.session.get(Anexo, anexo_id) if anexo_id else None
+    if anexo is not None and anexo.filename != filename:
+        anexo = None
+    response = _enviar_anexo(caminho, etag=hash_conteudo or True, imutavel=hash_conteudo is not None,
+                             download_name=anexo.nome if anexo else filename)
     response.headers["X-Frame-Options"] = "SAMEORIGIN"
     return response
 
+@app.route('/uploads/<tamanho>/<filename>')
+@login_required
+def anexo_derivado(tamanho, filename):
+    """Anexo reduzido ao tamanho pedido (ver imagens.TAMANHOS: miniatura, previa, impressao).
+
+    Para PDFs é a primeira página. Anexos de outros tipos, ou que não foi possível reduzir,
+    são servidos no original.
+    """
+    if tamanho not in TAMANHOS_IMAGEM or secure_filename(filename) != filename:
+        abort(404)
+    caminho = obter_derivado(app.config['UPLOAD_FOLDER'], tamanho, filename)
+    if caminho is None:
+        return uploaded_file(filename)
+    hash_conteudo = hash_do_nome(filename)
+    if hash_conteudo is None:
+        return _enviar_anexo(caminho)
+    return _enviar_anexo(caminho, etag=f'{hash_conteudo}-{tamanho}', imutavel=True)
+
+@app.route('/uploads/paginas/<filename>')
+@login_required
+def paginas_anexo_pdf(filename):
+    """Número de páginas de um anexo PDF e o endereço da imagem de cada uma (?dpi= opcional)."""
+    if secure_filename(filename) != filename:
+        abort(404)
+    total = total_paginas_pdf(app.config['UPLOAD_FOLDER'], filename)
+    if total is None:
+        return jsonify({'success': False, 'message': 'O anexo não é um PDF legível.'}), 404
+    dpi = resolucao_pdf(request.args.get('dpi', RESOLUCAO_PDF_PADRAO, type=int))
+    return jsonify({
+        'success': True,
+        'paginas': total,
+        'dpi': dpi,
+        'imagens': [url_for('pagina_anexo_pdf', filename=filename, pagina=pagina, dpi=dpi) for pagina in range(1, total + 1)]
+    })
+
+@app.route('/uploads/paginas/<filename>/<int:pagina>')
+@login_required
+def pagina_anexo_pdf(filename, pagina):
+    """Página de um anexo PDF rasterizada em PNG (?dpi=, arredondado para imagens.RESOLUCOES_PDF)."""
+    if secure_filename(filename) != filename:
+        abort(404)
+    dpi = resolucao_pdf(request.args.get('dpi', RESOLUCAO_PDF_PADRAO, type=int))
+    caminho = obter_pagina_pdf(app.config['UPLOAD_FOLDER'], filename, pagina, dpi=dpi)
+    if caminho is None:
+        abort(404)
+    hash_conteudo = hash_do_nome(filename)
+    if hash_conteudo is None:
+        return _enviar_anexo(caminho, mimetype='image/png')
+    return _enviar_anexo(caminho, etag=f'{hash_conteudo}-{pagina}-{dpi}', imutavel=True, mimetype='image/png')
+
+# --- ARMAZENAMENTO DOS ANEXOS ---
+# Os ficheiros são guardados pelo conteúdo (ver armazenamento.py): anexos iguais partilham o
+# mesmo ficheiro, que só é apagado quando o último anexo que o usa é excluído.
+
+# Espaço das chaves de pg_advisory_xact_lock usadas para os ficheiros (as migrações usam 727001)
+TRAVA_FICHEIROS = 727002
+
+
+def travar_ficheiro(nome):
+    """Trava o ficheiro `nome` até ao fim da transação atual da sessão.
+
+    Quem reutiliza um ficheiro guardado trava-o antes de ver se existe e só solta no commit do
+    novo Anexo; quem apaga um ficheiro sem referências trava-o antes de as contar. Assim a
+    contagem vê o anexo novo ou o ficheiro já apagado é gravado de novo. No PostgreSQL é uma
+    trava consultiva por ficheiro; no SQLite a transação passa a escrita, o que serializa
+    tudo o que escreve no banco.
+    """
+    conexao = db.session.connection()
+    if conexao.dialect.name == 'postgresql':
+        chave = int(hashlib.sha256(nome.encode('utf-8')).hexdigest()[:8], 16) - 2 ** 31
+        conexao.execute(db.select(func.pg_advisory_xact_lock(TRAVA_FICHEIROS, chave)))
+    else:
+        conexao.execute(
+            ControleVersao.__table__.update().where(ControleVersao.chave == '').values(versao=ControleVersao.versao)
+        )
+
+
+def _registrar_ficheiro_novo(nome):
+    db.session.info.setdefault('ficheiros_novos', set()).add(nome)
+
+
+@event.listens_for(Session, 'after_commit')
+def _confirmar_ficheiros_novos(session):
+    session.info.pop('ficheiros_novos', None)
+
+
+def desfazer_anexos():
+    """Rollback da transação e remoção dos ficheiros que ela acabou de pôr na pasta de uploads.
+
+    Usar em vez de db.session.rollback() quando a transação guardou anexos: sem o commit
+    nenhum Anexo os referencia.
+    """
+    db.session.rollback()
+    remover_ficheiros_orfaos(db.session.info.pop('ficheiros_novos', ()))
+
+
+def guardar_anexos(ficheiros, entrada):
+    """Guarda os ficheiros enviados e adiciona os Anexo à sessão (sem commit); retorna-os.
+
+    Os ficheiros ficam travados até ao commit; se ele falhar, chamar desfazer_anexos().
+    """
+    anexos = []
+    for ficheiro in ficheiros:
+        if not ficheiro or not ficheiro.filename:
+            continue
+        nome, hash_sha256, novo = guardar_ficheiro(app.config['UPLOAD_FOLDER'], ficheiro, travar_ficheiro)
+        if novo:
+            _registrar_ficheiro_novo(nome)
+            gerar_derivados(app.config['UPLOAD_FOLDER'], nome)
+        anexo = Anexo(filename=nome, nome_original=ficheiro.filename[:255], hash_sha256=hash_sha256, entrada=entrada)
+        db.session.add(anexo)
+        anexos.append(anexo)
+    return anexos
+
+
+def remover_ficheiros_orfaos(nomes):
+    """Apaga os ficheiros (e derivados) de `nomes` que já não são usados por nenhum anexo.
+
+    Chamar depois do commit que excluiu os anexos. Cada ficheiro é verificado numa transação
+    própria, travado (ver travar_ficheiro()) desde a contagem até ser apagado; uma trava de
+    cada vez, para não entrar em deadlock com um envio que trava vários ficheiros.
+    """
+    for nome in set(nomes):
+        try:
+            travar_ficheiro(nome)
+            if db.session.execute(db.select(Anexo.id).where(Anexo.filename == nome).limit(1)).first() is None:
+                apagar_ficheiro(app.config['UPLOAD_FOLDER'], nome)
+        finally:
+            db.session.rollback()
+
 @app.route('/upload_anexos', methods=['POST'])
 @login_required
 def upload_anexos():
@@ -894,35 +1875,11 @@ def upload_anexos():
         entrada = Entrada.query.get_or_404(entrada_id)
         
         # Processa os arquivos enviados
-        uploaded_files = request.files.getlist('anexos')
-        arquivos_salvos = 0
-        
-        for ficheiro in uploaded_files:
-            if ficheiro and ficheiro.filename != '':
-                # Gera nome seguro para o arquivo
-                anexo_filename = secure_filename(ficheiro.filename)
-                
-                # Adiciona timestamp se arquivo já existir
-                if os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], anexo_filename)):
-                    name, ext = os.path.splitext(anexo_filename)
-                    timestamp = str(int(time.time()))
-                    anexo_filename = f"{name}_{timestamp}{ext}"
-                
-                # Salva o arquivo
-                ficheiro.save(os.path.join(app.config['UPLOAD_FOLDER'], anexo_filename))
-                
-                # Cria registro no banco
-                novo_anexo = Anexo(filename=anexo_filename, entrada=entrada)
-                db.session.add(novo_anexo)
-                arquivos_salvos += 1
+        arquivos_salvos = len(guardar_anexos(request.files.getlist('anexos'), entrada))
         
         if arquivos_salvos > 0:
             db.session.commit()
             
-            # Atualiza timestamp global
-            global last_update_time
-            last_update_time = datetime.now()
-            
             # Retorna o total de anexos da entrada
             total_anexos = len(entrada.anexos)
             
@@ -934,99 +1891,374 @@ def upload_anexos():
         else:
             return jsonify({'success': False, 'message': 'Nenhum arquivo válido foi enviado'})
             
+    except RequestEntityTooLarge:
+        # Respondido por pedido_demasiado_grande()
+        desfazer_anexos()
+        raise
     except Exception as e:
-        db.session.rollback()
+        desfazer_anexos()
         return jsonify({'success': False, 'message': f'Erro no servidor: {str(e)}'})
 
+# --- ENVIO DE ANEXOS EM BLOCOS ---
+# Protocolo (ver envios.py e static/js/envios.js):
+#   POST   /anexos/envios                    {entrada_id, nome, tamanho} -> abre o envio
+#   PUT    /anexos/envios/<id>?inicio=N      corpo = bytes do bloco a partir da posição N
+#   GET    /anexos/envios/<id>               progresso e intervalos em falta (para retomar)
+#   POST   /anexos/envios/<id>/concluir      {sha256} -> verifica e anexa o ficheiro à entrada
+#   DELETE /anexos/envios/<id>               cancela
+# Os blocos podem ser enviados em paralelo e por qualquer ordem.
+
+gestor_envios = GestorEnvios(
+    app.config['ENVIOS_PASTA'],
+    tamanho_maximo=app.config['ANEXO_TAMANHO_MAXIMO'],
+    bloco_maximo=app.config['ENVIO_BLOCO_MAXIMO'],
+    retencao=app.config['ENVIOS_RETENCAO']
+)
+
+
+def _obter_envio(envio_id):
+    """Envio do utilizador atual ou 404 (os envios de outros utilizadores não são visíveis)."""
+    envio = gestor_envios.obter(envio_id)
+    if envio is None or envio['utilizador_id'] != current_user.id:
+        abort(404)
+    return envio
+
+
+def _envio_publico(envio):
+    """Estado do envio enviado ao navegador."""
+    recebido, em_falta = gestor_envios.progresso(envio)
+    return {
+        'id': envio['id'],
+        'nome': envio['nome_ficheiro'],
+        'tamanho': envio['tamanho'],
+        'recebido': recebido,
+        'percentual': round(100 * recebido / envio['tamanho']),
+        'em_falta': em_falta,
+        'bloco': app.config['ENVIO_BLOCO_MAXIMO'],
+        'url': url_for('bloco_envio_anexo', envio_id=envio['id']),
+        'url_concluir': url_for('concluir_envio_anexo', envio_id=envio['id']),
+    }
+
+
+@app.route('/anexos/envios', methods=['POST'])
+@login_required
+def iniciar_envio_anexo():
+    dados = request.get_json(silent=True) or {}
+    nome = (dados.get('nome') or '').strip()
+    try:
+        tamanho = int(dados.get('tamanho'))
+    except (TypeError, ValueError):
+        tamanho = None
+    if not nome or tamanho is None:
+        return jsonify({'success': False, 'message': 'Indique o nome e o tamanho do ficheiro.'}), 400
+    entrada = Entrada.query.get_or_404(dados.get('entrada_id'))
+    try:
+        envio = gestor_envios.iniciar(current_user.id, entrada.id, nome[:255], tamanho)
+    except TamanhoExcedido as e:
+        return jsonify({'success': False, 'message': str(e)}), 413
+    except ErroEnvio as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': True, 'envio': _envio_publico(envio)}), 201
+
+
+@app.route('/anexos/envios/<envio_id>', methods=['GET'])
+@login_required
+def estado_envio_anexo(envio_id):
+    return jsonify({'success': True, 'envio': _envio_publico(_obter_envio(envio_id))})
+
+
+@app.route('/anexos/envios/<envio_id>', methods=['PUT'])
+@login_required
+def bloco_envio_anexo(envio_id):
+    """Grava um bloco lido diretamente do corpo do pedido (sem multipart, sem o guardar em memória)."""
+    envio = _obter_envio(envio_id)
+    inicio = request.args.get('inicio', type=int)
+    if inicio is None:
+        return jsonify({'success': False, 'message': 'Indique a posição do bloco (?inicio=).'}), 400
+    try:
+        gestor_envios.gravar_bloco(envio, inicio, request.stream, request.content_length)
+    except TamanhoExcedido as e:
+        return jsonify({'success': False, 'message': str(e)}), 413
+    except ErroEnvio as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    recebido, em_falta = gestor_envios.progresso(envio)
+    return jsonify({'success': True, 'recebido': recebido, 'completo': not em_falta})
+
+
+@app.route('/anexos/envios/<envio_id>/concluir', methods=['POST'])
+@login_required
+def concluir_envio_anexo(envio_id):
+    """Verifica o ficheiro recebido e anexa-o à entrada; o envio deixa de existir."""
+    envio = _obter_envio(envio_id)
+    dados = request.get_json(silent=True) or {}
+    try:
+        caminho, hash_sha256 = gestor_envios.concluir(envio, dados.get('sha256'))
+    except HashDiferente as e:
+        return jsonify({'success': False, 'message': str(e)}), 422
+    except ErroEnvio as e:
+        return jsonify({'success': False, 'message': str(e)}), 409
+    entrada = db.session.get(Entrada, envio['entrada_id'])
+    if entrada is None:
+        gestor_envios.cancelar(envio)
+        return jsonify({'success': False, 'message': 'A entrada foi excluída durante o envio.'}), 404
+
+    try:
+        nome, novo = guardar_caminho(app.config['UPLOAD_FOLDER'], caminho, hash_sha256, envio['nome_ficheiro'],
+                                     travar_ficheiro)
+        if novo:
+            _registrar_ficheiro_novo(nome)
+        anexo = Anexo(filename=nome, nome_original=envio['nome_ficheiro'], hash_sha256=hash_sha256, entrada=entrada)
+        db.session.add(anexo)
+        db.session.commit()
+    except Exception as e:
+        desfazer_anexos()
+        return jsonify({'success': False, 'message': f'Erro no servidor: {str(e)}'}), 500
+    finally:
+        gestor_envios.cancelar(envio)
+    if novo:
+        gerar_derivados(app.config['UPLOAD_FOLDER'], nome)
+    return jsonify({
+        'success': True,
+        'message': f'{anexo.nome} enviado com sucesso',
+        'total_anexos': len(entrada.anexos),
+        'anexo': {'id': anexo.id, 'filename': anexo.filename, 'nome': anexo.nome}
+    })
+
+
+@app.route('/anexos/envios/<envio_id>', methods=['DELETE'])
+@login_required
+def cancelar_envio_anexo(envio_id):
+    gestor_envios.cancelar(_obter_envio(envio_id))
+    return jsonify({'success': True})
+
+# --- ROMANEIOS ---
+# Cada PDF lido fica guardado (pedidos e produtos) pelo SHA-256 dos seus bytes: reenviar o
+# mesmo ficheiro abre o resultado guardado sem voltar a ler o PDF, e os romaneios podem ser
+# consultados e exportados sem o ficheiro original.
+
+ROMANEIOS_LISTADOS = 20
+
+
+def _limitar(modelo, campo, valor):
+    """Corta o texto lido do PDF ao tamanho da coluna (o PostgreSQL recusa valores maiores)."""
+    tamanho = modelo.__table__.c[campo].type.length
+    return valor[:tamanho] if valor and tamanho else valor
+
+
+def romaneio_guardado(hash_sha256):
+    return Romaneio.query.filter_by(hash_sha256=hash_sha256, versao_leitor=VERSAO_LEITOR).first()
+
+
+def guardar_romaneio(hash_sha256, nome_ficheiro, tamanho, relatorios):
+    """Grava o romaneio lido e retorna-o; se outro pedido o gravou entretanto, retorna esse."""
+    romaneio = Romaneio(
+        hash_sha256=hash_sha256, versao_leitor=VERSAO_LEITOR, nome_ficheiro=nome_ficheiro[:255],
+        tamanho=tamanho, total_pedidos=len(relatorios), utilizador_id=current_user.id,
+    )
+    for posicao, relatorio in enumerate(relatorios):
+        pedido = PedidoRomaneio(posicao=posicao, **{
+            campo: _limitar(PedidoRomaneio, campo, relatorio['cabecalho'].get(campo)) for campo in CAMPOS_PEDIDO
+        })
+        pedido.produtos = [
+            ProdutoRomaneio(posicao=indice, **{
+                campo: _limitar(ProdutoRomaneio, campo, produto.get(campo)) for campo in CAMPOS_PRODUTO
+            })
+            for indice, produto in enumerate(relatorio['produtos'])
+        ]
+        romaneio.pedidos.append(pedido)
+    db.session.add(romaneio)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # O mesmo ficheiro enviado em simultâneo: fica o que foi gravado primeiro
+        db.session.rollback()
+        return romaneio_guardado(hash_sha256)
+    return romaneio
+
+
+def _carregar_romaneio(romaneio_id):
+    romaneio = db.session.get(Romaneio, romaneio_id, options=[
+        selectinload(Romaneio.pedidos).selectinload(PedidoRomaneio.produtos)
+    ])
+    if romaneio is None:
+        abort(404)
+    return romaneio
+
+
+def _romaneios_recentes():
+    """Romaneios guardados (mais recentes primeiro), filtrados por ?busca= (pedido ou cliente)."""
+    consulta = Romaneio.query
+    busca = request.args.get('busca', '').strip()
+    if busca:
+        termo = f'%{busca}%'
+        consulta = consulta.filter(Romaneio.pedidos.any(or_(
+            PedidoRomaneio.pedido == busca,
+            PedidoRomaneio.pedido_cli == busca,
+            PedidoRomaneio.cliente.ilike(termo),
+        )))
+    return consulta.order_by(Romaneio.data_registro.desc(), Romaneio.id.desc()).limit(ROMANEIOS_LISTADOS).all()
+
+
+def processar_romaneios(ficheiros):
+    """Lê e guarda os PDFs enviados; retorna, por ficheiro, {'nome', 'romaneio', 'erro', 'reutilizado'}.
+
+    Os ficheiros já guardados (mesmo SHA-256) não são lidos de novo e os repetidos no mesmo
+    envio são lidos uma vez. Um único PDF novo usa a leitura por páginas em paralelo; vários
+    são repartidos pelo pool de processos, um por processo. O erro de um ficheiro fica nesse
+    ficheiro.
+    """
+    resultados = []
+    documentos = {}
+    for ficheiro in ficheiros:
+        resultado = {'nome': ficheiro.filename, 'romaneio': None, 'erro': None, 'reutilizado': False}
+        resultados.append(resultado)
+        if not ficheiro.filename.lower().endswith('.pdf'):
+            resultado['erro'] = 'O ficheiro não é um PDF.'
+            continue
+        pdf_bytes = ficheiro.read()
+        resultado['hash'] = hashlib.sha256(pdf_bytes).hexdigest()
+        documentos.setdefault(resultado['hash'], (ficheiro.filename, pdf_bytes))
+
+    guardados = {
+        romaneio.hash_sha256: romaneio
+        for romaneio in Romaneio.query.filter(
+            Romaneio.hash_sha256.in_(list(documentos)), Romaneio.versao_leitor == VERSAO_LEITOR
+        )
+    } if documentos else {}
+    pendentes = [hash_sha256 for hash_sha256 in documentos if hash_sha256 not in guardados]
+
+    processos = app.config['ROMANEIO_PROCESSOS']
+    if len(pendentes) == 1:
+        try:
+            lidos = [(analisar_romaneio(documentos[pendentes[0]][1], processos=processos,
+                                        paginas_paralelo=app.config['ROMANEIO_PAGINAS_PARALELO']), None)]
+        except Exception as e:
+            lidos = [(None, str(e))]
+    else:
+        lidos = analisar_varios([documentos[hash_sha256][1] for hash_sha256 in pendentes], processos)
+
+    erros = {}
+    for hash_sha256, (relatorios, erro) in zip(pendentes, lidos):
+        if erro is not None:
+            erros[hash_sha256] = f'Erro ao processar o PDF: {erro}'
+        elif not relatorios:
+            erros[hash_sha256] = 'Nenhum dado de pedido válido foi encontrado. O formato do PDF pode ser diferente do esperado.'
+        else:
+            nome_ficheiro, pdf_bytes = documentos[hash_sha256]
+            try:
+                guardados[hash_sha256] = guardar_romaneio(hash_sha256, nome_ficheiro, len(pdf_bytes), relatorios)
+            except Exception as e:
+                db.session.rollback()
+                erros[hash_sha256] = f'Erro ao guardar o romaneio: {e}'
+
+    for resultado in resultados:
+        hash_sha256 = resultado.pop('hash', None)
+        if hash_sha256 is None:
+            continue
+        resultado['erro'] = erros.get(hash_sha256)
+        resultado['romaneio'] = guardados.get(hash_sha256)
+        resultado['reutilizado'] = hash_sha256 not in pendentes
+    return resultados
+
+
 @app.route('/relatorio-romaneio', methods=['GET', 'POST'])
 @login_required
 def relatorio_romaneio():
     if request.method == 'POST':
-        if 'pdf_file' not in request.files:
+        ficheiros = [ficheiro for ficheiro in request.files.getlist('pdf_file') if ficheiro and ficheiro.filename]
+        if not ficheiros:
             flash('Nenhum ficheiro selecionado.', 'warning')
             return redirect(request.url)
-        
-        ficheiro = request.files['pdf_file']
-        
-        if ficheiro.filename == '':
-            flash('Nenhum ficheiro selecionado.', 'warning')
+
+        resultados = processar_romaneios(ficheiros)
+
+        for resultado in resultados:
+            if resultado['erro']:
+                flash(f'{resultado["nome"]}: {resultado["erro"]}', 'danger' if len(resultados) > 1 else 'warning')
+            elif resultado['reutilizado']:
+                romaneio = resultado['romaneio']
+                flash(f'{resultado["nome"]}: já tinha sido processado em {romaneio.data_registro.strftime("%d/%m/%Y %H:%M")} '
+                      f'({romaneio.total_pedidos} pedido(s) carregado(s)).', 'info')
+        ids = list(dict.fromkeys(resultado['romaneio'].id for resultado in resultados if resultado['romaneio']))
+        if not ids:
             return redirect(request.url)
-        
-        if ficheiro and ficheiro.filename.lower().endswith('.pdf'):
-            try:
-                pdf_bytes = ficheiro.read()
-                texto_completo = ""
-                with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-                    for page in doc:
-                        # Extrai o texto mantendo algum layout básico
-                        texto_completo += page.get_text()
-
-                # --- LÓGICA DE EXTRAÇÃO AVANÇADA ---
-                
-                relatorios_extraidos = []
-                # Divide o documento em blocos de pedidos, usando "Pedido Pedido Cli." como separador
-                blocos_pedidos = re.split(r'Pedido\s+Pedido Cli\.', texto_completo, flags=re.IGNORECASE)
-
-                for bloco in blocos_pedidos[1:]: # Ignora o que vem antes do primeiro pedido
-                    
-                    # 1. Extrai o NOME DO CLIENTE do texto que vem ANTES do cabeçalho do pedido
-                    # Padrão: Procura por uma linha com letras maiúsculas que termina com " - VID."
-                    cliente_match = re.search(r'\n([A-Z\s\d\.\-]+-\s*VID\..*?)\n', bloco)
-                    nome_cliente = cliente_match.group(1).strip() if cliente_match else "Cliente não encontrado"
-
-                    # 2. Extrai os dados do cabeçalho do pedido
-                    # Padrão: Procura pela linha de valores que vem logo após o cabeçalho
-                    padrao_cabecalho = re.search(r'Tipo\s+Funcionário\s+Data Pedido\s+Data Entrega\s+Peso\s+m²\s+Total\n(.*?)\n', bloco, re.IGNORECASE | re.DOTALL)
-                    dados_cabecalho = {}
-                    if padrao_cabecalho:
-                        # Divide a linha de valores por múltiplos espaços
-                        valores = re.split(r'\s{2,}', padrao_cabecalho.group(1).strip())
-                        if len(valores) >= 9:
-                            dados_cabecalho = {
-                                'pedido': valores[0], 'pedido_cli': valores[1], 'tipo': valores[2],
-                                'funcionario': valores[3], 'data_pedido': valores[4], 'data_entrega': valores[5],
-                                'peso': valores[6], 'm2': valores[7], 'total': valores[8],
-                                'cliente': nome_cliente # Adiciona o cliente que encontrámos
-                            }
-
-                    # 3. Extrai a tabela de produtos
-                    produtos = []
-                    # Padrão para encontrar uma linha de produto, que pode ser complexa
-                    padrao_produtos = re.compile(r'(\d{4,})\s+(.*?)\s+OS:(\d+)\s+(\d+x\d+)\s+(\d+)\s+([\d,]+)', re.DOTALL)
-                    
-                    seccao_produtos_match = re.search(r'Cod\s+Produto\s+LarguraxAltura(.*?)Resumo:', bloco, re.IGNORECASE | re.DOTALL)
-                    if seccao_produtos_match:
-                        texto_produtos = seccao_produtos_match.group(1)
-                        linhas_produtos = padrao_produtos.findall(texto_produtos)
-                        for linha in linhas_produtos:
-                            produto = {
-                                'cod': linha[0].strip(),
-                                'produto': linha[1].replace('\n', ' ').strip(),
-                                'os': linha[2].strip(),
-                                'dimensoes': linha[3].strip(),
-                                'qtde': linha[4].strip(),
-                                'm2': linha[5].strip()
-                            }
-                            produtos.append(produto)
-                    
-                    if dados_cabecalho:
-                        relatorios_extraidos.append({
-                            'cabecalho': dados_cabecalho,
-                            'produtos': produtos
-                        })
-
-                if not relatorios_extraidos:
-                    flash('Nenhum dado de pedido válido foi encontrado. O formato do PDF pode ser diferente do esperado.', 'warning')
-                    return render_template('relatorio_romaneio.html')
-
-                flash(f'{len(relatorios_extraidos)} pedido(s) processado(s) com sucesso!', 'success')
-                return render_template('relatorio_romaneio.html', relatorios=relatorios_extraidos)
 
-            except Exception as e:
-                flash(f'Ocorreu um erro inesperado ao processar o PDF: {e}', 'danger')
-                return redirect(request.url)
+        novos = {resultado['romaneio'].id: resultado['romaneio'] for resultado in resultados
+                 if resultado['romaneio'] and not resultado['reutilizado']}
+        if novos:
+            flash(f'{sum(romaneio.total_pedidos for romaneio in novos.values())} pedido(s) processado(s) com sucesso '
+                  f'em {len(novos)} ficheiro(s)!', 'success')
+        if len(ids) == 1:
+            return redirect(url_for('ver_romaneio', romaneio_id=ids[0]))
+        return redirect(url_for('consolidar_romaneios', ids=ids))
+
+    return render_template('relatorio_romaneio.html', romaneios=_romaneios_recentes())
+
+
+def _pagina_romaneios(romaneios):
+    """Página de resultados de um ou mais romaneios, com os totais de cada um e do conjunto."""
+    relatorios = []
+    resumo = []
+    for romaneio in romaneios:
+        relatorios_romaneio = romaneio.relatorios()
+        for relatorio in relatorios_romaneio:
+            relatorio['origem'] = romaneio.nome_ficheiro
+        relatorios.extend(relatorios_romaneio)
+        resumo.append((romaneio, totais_romaneio(relatorios_romaneio)))
+    return render_template('relatorio_romaneio.html', romaneio=romaneios[0] if len(romaneios) == 1 else None,
+                           consolidado=romaneios if len(romaneios) > 1 else None, relatorios=relatorios,
+                           resumo=resumo, totais=totais_romaneio(relatorios), romaneios=_romaneios_recentes())
+
+
+@app.route('/romaneios/<int:romaneio_id>')
+@login_required
+def ver_romaneio(romaneio_id):
+    return _pagina_romaneios([_carregar_romaneio(romaneio_id)])
+
+
+@app.route('/romaneios/consolidado')
+@login_required
+def consolidar_romaneios():
+    ids = list(dict.fromkeys(request.args.getlist('ids', type=int)))
+    por_id = {
+        romaneio.id: romaneio
+        for romaneio in Romaneio.query.filter(Romaneio.id.in_(ids)).options(
+            selectinload(Romaneio.pedidos).selectinload(PedidoRomaneio.produtos)
+        )
+    } if ids else {}
+    romaneios = [por_id[romaneio_id] for romaneio_id in ids if romaneio_id in por_id]
+    if not romaneios:
+        abort(404)
+    return _pagina_romaneios(romaneios)
+
+
+CABECALHOS_EXPORTACAO_ROMANEIO = [
+    'Pedido', 'Pedido Cli.', 'Tipo', 'Funcionário', 'Data Pedido', 'Data Entrega', 'Peso', 'M²', 'Total',
+    'Cliente', 'Cod', 'Produto', 'OS', 'Dimensões', 'Qtde', 'M² Produto'
+]
+
+
+def consulta_exportacao_romaneio(romaneio_id):
+    """Uma linha por produto (pedidos sem produtos saem numa linha só), pela ordem do PDF."""
+    pedido, produto = PedidoRomaneio.__table__.c, ProdutoRomaneio.__table__.c
+    return (
+        db.select(*(pedido[campo] for campo in CAMPOS_PEDIDO), *(produto[campo] for campo in CAMPOS_PRODUTO))
+        .select_from(PedidoRomaneio.__table__.outerjoin(
+            ProdutoRomaneio.__table__, produto.pedido_romaneio_id == pedido.id
+        ))
+        .where(pedido.romaneio_id == romaneio_id)
+        .order_by(pedido.posicao, produto.posicao)
+    )
 
-    return render_template('relatorio_romaneio.html')
+
+@app.route('/romaneios/<int:romaneio_id>/exportar')
+@login_required
+def exportar_romaneio(romaneio_id):
+    romaneio = db.session.get(Romaneio, romaneio_id)
+    if romaneio is None:
+        abort(404)
+    return resposta_exportacao(f'romaneio_{romaneio.id}', 'Romaneio', CABECALHOS_EXPORTACAO_ROMANEIO,
+                               consulta_exportacao_romaneio(romaneio.id))
 
 @app.route('/relatorio-pedidos')
 @login_required
@@ -1039,8 +2271,8 @@ def relatorio_pedidos():
 @app.route('/cadastro-clientes')
 @login_required
 def cadastro_clientes():
-    """Exibe a página de gestão de clientes com paginação e filtros (30 clientes por página)."""
-    page = request.args.get('page', 1, type=int)
+    """Exibe a página de gestão de clientes com paginação por cursor e filtros (30 clientes por página)."""
+    cursor = request.args.get('cursor', '')
     per_page = 30  # Limite de 30 clientes por página
     
     # Parâmetros de filtro
@@ -1049,21 +2281,23 @@ def cadastro_clientes():
     search_cpf_cnpj = request.args.get('search_cpf_cnpj', '').strip()
     
     # Query base
-    query = Cliente.query
+    consulta = db.select(Cliente)
     
     # Aplicar filtros
     if search_name:
-        query = query.filter(Cliente.nome.ilike(f'%{search_name}%'))
+        consulta = consulta.where(Cliente.nome.ilike(f'%{search_name}%'))
     
     if filter_tipo_pessoa:
-        query = query.filter(Cliente.tipo_pessoa == filter_tipo_pessoa)
+        consulta = consulta.where(Cliente.tipo_pessoa == filter_tipo_pessoa)
     
     if search_cpf_cnpj:
-        query = query.filter(Cliente.cpf_cnpj.ilike(f'%{search_cpf_cnpj}%'))
+        consulta = consulta.where(Cliente.cpf_cnpj.ilike(f'%{search_cpf_cnpj}%'))
     
-    # Paginação
-    clientes_paginados = query.order_by(Cliente.numero_cliente).paginate(
-        page=page, per_page=per_page, error_out=False
+    # Paginação por cursor sobre numero_cliente (único); o total fica em cache até o cadastro mudar
+    total = contar_com_cache(VERSAO_CLIENTES, ('clientes', search_name, filter_tipo_pessoa, search_cpf_cnpj), consulta)
+    clientes_paginados = paginar_keyset(
+        consulta, ((Cliente.numero_cliente, False),), cursor, per_page, total,
+        lambda instrucao: db.session.execute(instrucao).scalars().all()
     )
     
     return render_template('cadastro_clientes.html', 
@@ -1201,62 +2435,127 @@ def excluir_cliente(id):
 @app.route('/exportar-clientes')
 @login_required
 def exportar_clientes():
-    """Exporta todos os clientes cadastrados para um ficheiro .xlsx."""
-    try:
-        import openpyxl
-        from flask import Response
-        import io
-
-        clientes = Cliente.query.order_by(Cliente.numero_cliente).all()
-
-        workbook = openpyxl.Workbook()
-        sheet = workbook.active
-        sheet.title = "Clientes"
-
-        # Define os cabeçalhos das colunas
-        headers = [
-            'N° Cliente', 'Nome', 'Telefone', 'Tipo Pessoa', 'CPF/CNPJ', 
-            'Como Conheceu', 'Rua', 'Número', 'Complemento', 'Bairro', 
-            'Cidade', 'UF', 'CEP', 'Observações'
-        ]
-        sheet.append(headers)
-
-        # Adiciona os dados de cada cliente
-        for cliente in clientes:
-            sheet.append([
-                cliente.numero_cliente,
-                cliente.nome,
-                cliente.telefone,
-                cliente.tipo_pessoa,
-                cliente.cpf_cnpj,
-                cliente.como_conheceu,
-                cliente.rua,
-                cliente.numero_endereco,
-                cliente.complemento,
-                cliente.bairro,
-                cliente.cidade,
-                cliente.uf,
-                cliente.cep,
-                cliente.observacoes
-            ])
-
-        # Cria um arquivo em memória para não salvar no disco do servidor
-        output = io.BytesIO()
-        workbook.save(output)
-        output.seek(0)
-
-        # Retorna o arquivo para download no navegador
-        return Response(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        headers={"Content-Disposition": "attachment;filename=cadastro_clientes.xlsx"})
-    except Exception as e:
-        flash(f"Ocorreu um erro ao exportar os dados: {e}", "danger")
-        return redirect(url_for('cadastro_clientes'))
+    """Exporta todos os clientes cadastrados (.xlsx, ou .csv com ?formato=csv)."""
+    nome_base, titulo, cabecalhos, consulta, formatar, _ = EXPORTACOES['clientes']
+    return resposta_exportacao(nome_base, titulo, cabecalhos, consulta(), formatar)
+
+
+# --- IMPORTAÇÃO DE CLIENTES EM LOTES ---
+
+# Clientes gravados por instrução INSERT (e por commit)
+IMPORTACAO_LOTE = int(os.environ.get('IMPORTACAO_LOTE', '500'))
+
+# Ordem das colunas da planilha (A a M)
+CAMPOS_IMPORTACAO_CLIENTES = (
+    'nome', 'telefone', 'tipo_pessoa', 'cpf_cnpj', 'como_conheceu', 'rua', 'numero_endereco',
+    'complemento', 'bairro', 'cidade', 'uf', 'cep', 'observacoes'
+)
+
+
+def _preparar_cliente_importado(valores):
+    """Converte uma linha da planilha nos campos de Cliente; retorna (campos, motivo se inválida)."""
+    campos = {}
+    for campo, valor in zip(CAMPOS_IMPORTACAO_CLIENTES, valores):
+        texto = texto_celula(valor)
+        limite = Cliente.__table__.c[campo].type.length
+        if texto and limite and len(texto) > limite:
+            return None, f'{campo} tem mais de {limite} caracteres'
+        campos[campo] = texto
+    if not campos['nome']:
+        return None, 'sem nome'
+    if campos['tipo_pessoa'] not in ['Física', 'Jurídica']:
+        campos['tipo_pessoa'] = 'Física'
+    return campos, None
+
+
+def _gravar_lote_clientes(pendentes, relatorio):
+    """Grava um lote de clientes numa transação, com numero_cliente alocado em bloco.
+
+    `pendentes` é uma lista de (linha, campos). Se outro processo gravar clientes ao mesmo
+    tempo (número ou CPF/CNPJ repetido), o lote é refeito com os dados atualizados.
+    """
+    for _ in range(3):
+        proximo_numero = (db.session.execute(db.select(func.max(Cliente.numero_cliente))).scalar() or 0) + 1
+        registros = [dict(campos, numero_cliente=proximo_numero + i) for i, (_, campos) in enumerate(pendentes)]
+        if relatorio.simulacao:
+            break
+        try:
+            db.session.execute(db.insert(Cliente), registros)
+            # O INSERT em lote não passa pelo flush: versão e índice de clientes são atualizados aqui.
+            # Os números do bloco identificam os clientes acabados de gravar.
+            gravados = db.session.execute(
+                db.select(Cliente.id, Cliente.nome, Cliente.numero_cliente).where(
+                    Cliente.numero_cliente.between(proximo_numero, proximo_numero + len(registros) - 1)
+                )
+            ).all()
+            _incrementar_versao(db.session, VERSAO_CLIENTES)
+            db.session.info.setdefault('clientes_alterados', {}).update(
+                {cliente.id: (cliente.nome, cliente.numero_cliente) for cliente in gravados}
+            )
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+            cpfs = [campos['cpf_cnpj'] for _, campos in pendentes if campos['cpf_cnpj']]
+            existentes = set(db.session.execute(
+                db.select(Cliente.cpf_cnpj).where(Cliente.cpf_cnpj.in_(cpfs))
+            ).scalars()) if cpfs else set()
+            for linha, campos in pendentes:
+                if campos['cpf_cnpj'] in existentes:
+                    relatorio.registrar(linha, IGNORADA, campos['nome'], 'CPF/CNPJ já cadastrado')
+            pendentes = [(linha, campos) for linha, campos in pendentes if campos['cpf_cnpj'] not in existentes]
+    else:
+        for linha, campos in pendentes:
+            relatorio.registrar(linha, INVALIDA, campos['nome'], 'conflito ao gravar; tente novamente')
+        return
+
+    for linha, campos in pendentes:
+        relatorio.registrar(linha, ADICIONADA, campos['nome'])
+
+
+def importar_clientes_em_lotes(linhas, simulacao=False, lote=IMPORTACAO_LOTE):
+    """Importa clientes de (linha, valores) e retorna o RelatorioImportacao.
+
+    Os CPF/CNPJ existentes são lidos numa única consulta; os clientes novos são gravados em
+    INSERTs de `lote` linhas, cada um com o seu commit. Em simulação nada é gravado.
+    """
+    relatorio = RelatorioImportacao(simulacao=simulacao)
+    cpfs_cadastrados = set(db.session.execute(
+        db.select(Cliente.cpf_cnpj).where(Cliente.cpf_cnpj.isnot(None))
+    ).scalars())
+    cpfs_planilha = set()
+    pendentes = []
+
+    for linha, valores in linhas:
+        campos, motivo = _preparar_cliente_importado(valores)
+        if campos is None:
+            relatorio.registrar(linha, INVALIDA, texto_celula(valores[0]), motivo)
+            continue
+
+        # Validação: Ignora se já existir um cliente com o mesmo CPF/CNPJ (se houver um)
+        cpf_cnpj = campos['cpf_cnpj']
+        if cpf_cnpj in cpfs_cadastrados:
+            relatorio.registrar(linha, IGNORADA, campos['nome'], 'CPF/CNPJ já cadastrado')
+            continue
+        if cpf_cnpj in cpfs_planilha:
+            relatorio.registrar(linha, IGNORADA, campos['nome'], 'CPF/CNPJ repetido na planilha')
+            continue
+        if cpf_cnpj:
+            cpfs_planilha.add(cpf_cnpj)
+
+        pendentes.append((linha, campos))
+        if len(pendentes) >= lote:
+            _gravar_lote_clientes(pendentes, relatorio)
+            pendentes = []
+    if pendentes:
+        _gravar_lote_clientes(pendentes, relatorio)
+    return relatorio
 
 
 @app.route('/importar-clientes', methods=['POST'])
 @login_required
 def importar_clientes():
-    """Importa novos clientes a partir de um ficheiro .xlsx."""
+    """Importa novos clientes a partir de um ficheiro .xlsx (com 'simular', apenas valida)."""
     if 'xlsx_file' not in request.files:
         flash('Nenhum ficheiro selecionado.', 'warning')
         return redirect(url_for('cadastro_clientes'))
@@ -1269,152 +2568,301 @@ def importar_clientes():
 
     if ficheiro and ficheiro.filename.lower().endswith('.xlsx'):
         try:
-            import openpyxl
-            workbook = openpyxl.load_workbook(ficheiro)
-            sheet = workbook.active
-
-            clientes_adicionados = 0
-            clientes_ignorados = 0
-            
-            ultimo_cliente = Cliente.query.order_by(Cliente.numero_cliente.desc()).first()
-            proximo_numero = (ultimo_cliente.numero_cliente + 1) if ultimo_cliente else 1
-
-            for row in sheet.iter_rows(min_row=2, values_only=True):
-                if not row or all(cell is None for cell in row) or not row[0]:
-                    continue # Pula linhas vazias ou sem nome
-
-                # Mapeia as colunas para os campos do modelo
-                nome, telefone, tipo_pessoa, cpf_cnpj, como_conheceu, rua, numero_endereco, complemento, bairro, cidade, uf, cep, observacoes = (row + (None,) * 13)[:13]
-
-                # Validação: Ignora se já existir um cliente com o mesmo CPF/CNPJ (se houver um)
-                if cpf_cnpj:
-                    cliente_existente = Cliente.query.filter_by(cpf_cnpj=cpf_cnpj).first()
-                    if cliente_existente:
-                        clientes_ignorados += 1
-                        continue
-                
-                novo_cliente = Cliente(
-                    numero_cliente=proximo_numero,
-                    nome=nome,
-                    telefone=telefone,
-                    tipo_pessoa=tipo_pessoa if tipo_pessoa in ['Física', 'Jurídica'] else 'Física',
-                    cpf_cnpj=cpf_cnpj,
-                    como_conheceu=como_conheceu,
-                    rua=rua,
-                    numero_endereco=numero_endereco,
-                    complemento=complemento,
-                    bairro=bairro,
-                    cidade=cidade,
-                    uf=uf,
-                    cep=cep,
-                    observacoes=observacoes
-                )
-                db.session.add(novo_cliente)
-                clientes_adicionados += 1
-                proximo_numero += 1
-
-            if clientes_adicionados > 0:
-                db.session.commit()
-
-            mensagem = f'{clientes_adicionados} cliente(s) importado(s) com sucesso!'
-            if clientes_ignorados > 0:
-                mensagem += f' {clientes_ignorados} foram ignorados por já possuírem CPF/CNPJ cadastrado.'
-
-            flash(mensagem, 'success' if clientes_adicionados > 0 else 'info')
-
+            relatorio = importar_clientes_em_lotes(
+                ler_planilha(ficheiro, len(CAMPOS_IMPORTACAO_CLIENTES)),
+                simulacao='simular' in request.form
+            )
         except Exception as e:
             db.session.rollback()
             flash(f'Ocorreu um erro ao processar o ficheiro: {e}', 'danger')
+            return redirect(url_for('cadastro_clientes'))
 
+        if relatorio.problemas or relatorio.simulacao:
+            return render_template('relatorio_importacao.html', relatorio=relatorio, entidade='cliente(s)',
+                                   voltar=url_for('cadastro_clientes'))
+        flash(relatorio.mensagem('cliente(s)'), 'success' if relatorio.adicionadas > 0 else 'info')
         return redirect(url_for('cadastro_clientes'))
 
     flash('Formato de ficheiro inválido. Por favor, envie um ficheiro .xlsx.', 'danger')
     return redirect(url_for('cadastro_clientes'))
 
+# --- EXPORTAÇÃO EM FLUXO ---
+
+CABECALHOS_EXPORTACAO_CLIENTES = [
+    'N° Cliente', 'Nome', 'Telefone', 'Tipo Pessoa', 'CPF/CNPJ',
+    'Como Conheceu', 'Rua', 'Número', 'Complemento', 'Bairro',
+    'Cidade', 'UF', 'CEP', 'Observações'
+]
+
+CABECALHOS_EXPORTACAO_ENTRADAS = [
+    'N° Pedido', 'Tipo', 'Cliente', 'Obra', 'Status',
+    'Descrição', 'Observações', 'Data de Registro'
+]
+
+
+def consulta_exportacao_clientes():
+    return db.select(
+        Cliente.numero_cliente, Cliente.nome, Cliente.telefone, Cliente.tipo_pessoa, Cliente.cpf_cnpj,
+        Cliente.como_conheceu, Cliente.rua, Cliente.numero_endereco, Cliente.complemento, Cliente.bairro,
+        Cliente.cidade, Cliente.uf, Cliente.cep, Cliente.observacoes
+    ).order_by(Cliente.numero_cliente)
+
+
+def consulta_exportacao_entradas(arquivado):
+    """Colunas exportadas das entradas; o cliente é o cadastrado ou, na falta dele, o nome temporário."""
+    return db.select(
+        Entrada.numero_pedido, Entrada.tipo, func.coalesce(Cliente.nome, Entrada.cliente_nome_temp),
+        Entrada.obra, Entrada.status, Entrada.descricao, Entrada.observacoes, Entrada.data_registro
+    ).select_from(Entrada).outerjoin(Cliente, Entrada.cliente_id == Cliente.id).where(
+        Entrada.arquivado == arquivado
+    ).order_by(Entrada.numero_pedido)
+
+
+def _formatar_linha_entrada(linha):
+    *valores, data_registro = linha
+    return valores + [data_registro.strftime('%Y-%m-%d %H:%M:%S')]
+
+
+def resposta_exportacao(nome_base, titulo, cabecalhos, consulta, formatar=tuple):
+    """Resposta com o ficheiro gerado em fluxo enquanto as linhas são lidas em lotes.
+
+    O formato vem de ?formato= ('xlsx' por omissão ou 'csv'). A leitura usa uma ligação
+    própria, por isso a sessão do pedido é libertada antes de o envio começar.
+    """
+    formato = 'csv' if request.args.get('formato') == 'csv' else 'xlsx'
+    linhas = (formatar(linha) for linha in ler_em_lotes(db.engine, consulta))
+    return Response(gerar_exportacao(formato, titulo, cabecalhos, linhas), mimetype=MIMETYPES[formato], headers={
+        'Content-Disposition': f'attachment;filename={nome_base}.{formato}',
+        # Impede o nginx de acumular a resposta antes de a enviar
+        'X-Accel-Buffering': 'no'
+    })
+
+
+# tipo -> (nome do ficheiro, título da folha, cabeçalhos, consulta, formatação das linhas, versão dos dados)
+EXPORTACOES = {
+    'clientes': ('cadastro_clientes', 'Clientes', CABECALHOS_EXPORTACAO_CLIENTES,
+                 consulta_exportacao_clientes, tuple, VERSAO_CLIENTES),
+    'painel': ('painel_controle', 'Painel_Controle', CABECALHOS_EXPORTACAO_ENTRADAS,
+               lambda: consulta_exportacao_entradas(False), _formatar_linha_entrada, VERSAO_PAINEL),
+    'arquivados': ('arquivados', 'Arquivados', CABECALHOS_EXPORTACAO_ENTRADAS,
+                   lambda: consulta_exportacao_entradas(True), _formatar_linha_entrada, VERSAO_PAINEL),
+}
+
+
 @app.route('/exportar-painel')
 @login_required
 def exportar_painel():
-    import openpyxl
-    from flask import Response
-    import io
-
     # Seleciona apenas as entradas ativas (não arquivadas)
-    entradas = Entrada.query.filter_by(arquivado=False).order_by(Entrada.numero_pedido).all()
+    nome_base, titulo, cabecalhos, consulta, formatar, _ = EXPORTACOES['painel']
+    return resposta_exportacao(nome_base, titulo, cabecalhos, consulta(), formatar)
 
-    workbook = openpyxl.Workbook()
-    sheet = workbook.active
-    sheet.title = "Painel_Controle"
+@app.route('/exportar-arquivados')
+@login_required
+def exportar_arquivados():
+    # Seleciona apenas as entradas arquivadas
+    nome_base, titulo, cabecalhos, consulta, formatar, _ = EXPORTACOES['arquivados']
+    return resposta_exportacao(nome_base, titulo, cabecalhos, consulta(), formatar)
+
+
+# --- EXPORTAÇÕES EM SEGUNDO PLANO ---
+
+gestor_tarefas = GestorTarefas(
+    app.config['TAREFAS_PASTA'],
+    max_workers=app.config['TAREFAS_THREADS'],
+    por_utilizador=app.config['TAREFAS_POR_UTILIZADOR'],
+    retencao=app.config['TAREFAS_RETENCAO']
+)
+
+
+def _tarefa_publica(tarefa):
+    """Estado da tarefa enviado ao navegador."""
+    dados = {
+        'id': tarefa['id'],
+        'estado': tarefa['estado'],
+        'progresso': tarefa['progresso'],
+        'total': tarefa['total'],
+        'percentual': min(100, round(100 * tarefa['progresso'] / tarefa['total'])) if tarefa['total'] else None,
+        'mensagem': tarefa['mensagem'],
+        'reutilizada': tarefa.get('reutilizada', False),
+        'url_estado': url_for('estado_exportacao', tarefa_id=tarefa['id']),
+    }
+    if tarefa['estado'] == CONCLUIDA:
+        dados['percentual'] = 100
+        dados['url_download'] = url_for('baixar_exportacao', tarefa_id=tarefa['id'])
+    return dados
 
-    # Cabeçalhos
-    sheet.append([
-        'N° Pedido', 'Tipo', 'Cliente', 'Obra', 'Status', 
-        'Descrição', 'Observações', 'Data de Registro'
-    ])
 
-    # Dados
-    for entrada in entradas:
-        # Define o nome do cliente (seja o cadastrado ou o temporário)
-        nome_cliente = entrada.cliente.nome if entrada.cliente else entrada.cliente_nome_temp
-        
-        sheet.append([
-            entrada.numero_pedido,
-            entrada.tipo,
-            nome_cliente,
-            entrada.obra,
-            entrada.status,
-            entrada.descricao,
-            entrada.observacoes,
-            entrada.data_registro.strftime('%Y-%m-%d %H:%M:%S')
-        ])
+@app.route('/exportacoes', methods=['POST'])
+@login_required
+def criar_exportacao():
+    """Agenda uma exportação; exportações iguais (mesmos dados e formato) reutilizam a tarefa existente."""
+    dados = request.get_json(silent=True) or request.form
+    tipo = dados.get('tipo')
+    formato = 'csv' if dados.get('formato') == 'csv' else 'xlsx'
+    if tipo not in EXPORTACOES:
+        return jsonify({'success': False, 'message': 'Tipo de exportação inválido.'}), 400
+
+    nome_base, titulo, cabecalhos, consulta, formatar, chave_versao = EXPORTACOES[tipo]
+    consulta = consulta()
+    total = db.session.execute(db.select(func.count()).select_from(consulta.order_by(None).subquery())).scalar()
+    engine = db.engine
+
+    def executar(caminho, progresso):
+        def contar(linhas):
+            for processados, linha in enumerate(linhas, start=1):
+                yield formatar(linha)
+                if processados % 500 == 0:
+                    progresso(processados)
+            progresso(total)
+
+        with open(caminho, 'wb') as ficheiro:
+            for bloco in gerar_exportacao(formato, titulo, cabecalhos, contar(ler_em_lotes(engine, consulta))):
+                ficheiro.write(bloco)
+
+    chave = [tipo, formato, chave_versao, obter_versao(chave_versao)[0]]
+    try:
+        tarefa = gestor_tarefas.submeter(
+            chave, current_user.id, f'{nome_base}.{formato}', MIMETYPES[formato], executar, total=total
+        )
+    except LimiteTarefas as e:
+        return jsonify({'success': False, 'message': str(e)}), 429
+    return jsonify({'success': True, 'tarefa': _tarefa_publica(tarefa)}), 202
 
-    output = io.BytesIO()
-    workbook.save(output)
-    output.seek(0)
 
-    return Response(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    headers={"Content-Disposition": "attachment;filename=painel_controle.xlsx"})
+@app.route('/exportacoes/<tarefa_id>')
+@login_required
+def estado_exportacao(tarefa_id):
+    tarefa = gestor_tarefas.obter(tarefa_id)
+    if tarefa is None:
+        return jsonify({'success': False, 'message': 'Exportação não encontrada ou expirada.'}), 404
+    return jsonify({'success': True, 'tarefa': _tarefa_publica(tarefa)})
 
-@app.route('/exportar-arquivados')
+
+@app.route('/exportacoes/<tarefa_id>/ficheiro')
 @login_required
-def exportar_arquivados():
-    import openpyxl
-    from flask import Response
-    import io
+def baixar_exportacao(tarefa_id):
+    tarefa = gestor_tarefas.obter(tarefa_id)
+    if tarefa is None or tarefa['estado'] != CONCLUIDA:
+        abort(404)
+    return send_file(
+        gestor_tarefas.caminho_ficheiro(tarefa), mimetype=tarefa['mimetype'],
+        as_attachment=True, download_name=tarefa['nome_ficheiro']
+    )
 
-    # Seleciona apenas as entradas arquivadas
-    entradas = Entrada.query.filter_by(arquivado=True).order_by(Entrada.numero_pedido).all()
+# --- IMPORTAÇÃO DE ENTRADAS EM LOTES ---
 
-    workbook = openpyxl.Workbook()
-    sheet = workbook.active
-    sheet.title = "Arquivados"
+# Ordem das colunas da planilha (A a G)
+CAMPOS_IMPORTACAO_ENTRADAS = ('numero_pedido', 'tipo', 'cliente', 'obra', 'status', 'descricao', 'observacoes')
 
-    # Cabeçalhos
-    sheet.append([
-        'N° Pedido', 'Tipo', 'Cliente', 'Obra', 'Status', 
-        'Descrição', 'Observações', 'Data de Registro'
-    ])
 
-    # Dados
-    for entrada in entradas:
-        nome_cliente = entrada.cliente.nome if entrada.cliente else entrada.cliente_nome_temp
-        
-        sheet.append([
-            entrada.numero_pedido,
-            entrada.tipo,
-            nome_cliente,
-            entrada.obra,
-            entrada.status,
-            entrada.descricao,
-            entrada.observacoes,
-            entrada.data_registro.strftime('%Y-%m-%d %H:%M:%S')
-        ])
+def _chave_nome(nome):
+    """Nome dobrado para comparação: sem acentos, minúsculas e espaços simples."""
+    return ' '.join(normalizar(nome).split())
 
-    output = io.BytesIO()
-    workbook.save(output)
-    output.seek(0)
 
-    return Response(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    headers={"Content-Disposition": "attachment;filename=arquivados.xlsx"})
+def _preparar_entrada_importada(valores):
+    """Converte uma linha da planilha nos campos de Entrada; retorna (campos, nome do cliente, motivo se inválida)."""
+    numero, tipo, nome_cliente, obra, status, descricao, observacoes = (texto_celula(valor) for valor in valores)
+    if not numero or not tipo or not nome_cliente or not descricao:
+        return None, nome_cliente, 'faltam o número, o tipo, o cliente ou a descrição'
+    try:
+        numero = int(numero)
+    except ValueError:
+        return None, nome_cliente, f'número do pedido inválido: {numero}'
+
+    campos = {
+        'numero_pedido': numero,
+        'tipo': tipo,
+        'obra': obra,
+        'status': status if status in ['Não iniciado', 'Em andamento', 'Concluído'] else 'Não iniciado',
+        'descricao': descricao,
+        'observacoes': observacoes,
+    }
+    for campo, texto in (('tipo', tipo), ('obra', obra), ('cliente_nome_temp', nome_cliente)):
+        limite = Entrada.__table__.c[campo].type.length
+        if texto and len(texto) > limite:
+            return None, nome_cliente, f'{campo} tem mais de {limite} caracteres'
+    return campos, nome_cliente, None
+
+
+def importar_entradas_em_lotes(linhas, lote=IMPORTACAO_LOTE):
+    """Importa entradas de (linha, valores) numa única transação e retorna o RelatorioImportacao.
+
+    Os números já existentes são lidos com consultas IN de `lote` números cada e
+    os clientes são associados por nome dobrado (sem acentos nem maiúsculas) a partir de um mapa
+    carregado numa consulta. As entradas são gravadas em INSERTs de `lote` linhas e a versão do
+    painel muda uma só vez, no fim.
+    """
+    relatorio = RelatorioImportacao()
+    validas = []
+    for linha, valores in linhas:
+        campos, nome_cliente, motivo = _preparar_entrada_importada(valores)
+        if campos is None:
+            relatorio.registrar(linha, INVALIDA, nome_cliente, motivo)
+        else:
+            validas.append((linha, campos, nome_cliente))
+    if not validas:
+        return relatorio
+
+    numeros = sorted({campos['numero_pedido'] for _, campos, _ in validas})
+    existentes = set()
+    for inicio in range(0, len(numeros), lote):
+        existentes.update(db.session.execute(
+            db.select(Entrada.numero_pedido).where(Entrada.numero_pedido.in_(numeros[inicio:inicio + lote]))
+        ).scalars())
+
+    # Em nomes repetidos fica o cliente mais antigo, como na consulta por nome usada antes
+    clientes_por_nome = {}
+    for cliente_id, nome in db.session.execute(db.select(Cliente.id, Cliente.nome).order_by(Cliente.id.desc())):
+        clientes_por_nome[_chave_nome(nome)] = cliente_id
+
+    registros = []
+    for linha, campos, nome_cliente in validas:
+        descricao = f"{campos['numero_pedido']} - {nome_cliente}"
+        if campos['numero_pedido'] in existentes:
+            relatorio.registrar(linha, IGNORADA, descricao, 'número do pedido já existe')
+            continue
+        existentes.add(campos['numero_pedido'])
+
+        cliente_id = clientes_por_nome.get(_chave_nome(nome_cliente))
+        campos['cliente_id'] = cliente_id
+        campos['cliente_nome_temp'] = None if cliente_id else nome_cliente
+        registros.append(campos)
+        if cliente_id:
+            relatorio.registrar(linha, ADICIONADA, descricao)
+        else:
+            relatorio.registrar(linha, ADICIONADA, descricao, 'cliente não cadastrado; gravado como nome temporário')
+
+    if not registros:
+        return relatorio
+
+    numeros = [campos['numero_pedido'] for campos in registros]
+    for inicio in range(0, len(registros), lote):
+        db.session.execute(db.insert(Entrada), registros[inicio:inicio + lote])
+
+    # O INSERT em lote não passa pelo flush: registo de alterações, versão e índice de busca são atualizados aqui
+    novos_ids = []
+    for inicio in range(0, len(numeros), lote):
+        novos_ids.extend(db.session.execute(
+            db.select(Entrada.id).where(Entrada.numero_pedido.in_(numeros[inicio:inicio + lote]))
+        ).scalars())
+    registrar_alteracoes_painel(db.session, novos_ids)
+    if indice_busca.mantido_pela_aplicacao:
+        indice_busca.sincronizar(db.session.connection(), entradas=novos_ids)
+    db.session.commit()
+    return relatorio
+
+
+def _gravar_relatorio_csv(relatorio, caminho, progresso):
+    with open(caminho, 'w', encoding='utf-8-sig', newline='') as ficheiro:
+        escritor = csv.writer(ficheiro, delimiter=';')
+        escritor.writerow(['Linha', 'Resultado', 'Registo', 'Motivo'])
+        for processados, problema in enumerate(relatorio.todos_problemas, start=1):
+            escritor.writerow([problema['linha'], problema['resultado'], problema['descricao'] or '', problema['motivo'] or ''])
+            if processados % 500 == 0:
+                progresso(processados)
+    progresso(len(relatorio.todos_problemas))
+
 
 @app.route('/importar-entradas', methods=['POST'])
 @login_required
@@ -1431,73 +2879,27 @@ def importar_entradas():
 
     if ficheiro and ficheiro.filename.lower().endswith('.xlsx'):
         try:
-            workbook = openpyxl.load_workbook(ficheiro)
-            sheet = workbook.active
-
-            entradas_adicionadas = 0
-            entradas_ignoradas = 0
-            
-            for row in sheet.iter_rows(min_row=2, values_only=True):
-                # --- INÍCIO DA CORREÇÃO ---
-                # Pula a iteração se a linha for nula ou inteiramente vazia
-                if not row or all(cell is None for cell in row):
-                    continue
-                # --- FIM DA CORREÇÃO ---
-                
-                # Garante que a linha tenha colunas suficientes antes de tentar acessá-las
-                if len(row) < 7:
-                    continue
-                
-                num_pedido_str, tipo_entrada, nome_cliente, obra, status, descricao, observacoes = row[:7]
-
-                if not num_pedido_str or not tipo_entrada or not nome_cliente or not descricao:
-                    continue
-
-                try:
-                    num_pedido = int(num_pedido_str)
-                except (ValueError, TypeError):
-                    continue
-
-                if Entrada.query.filter_by(numero_pedido=num_pedido).first():
-                    entradas_ignoradas += 1
-                    continue
-
-                cliente_obj = Cliente.query.filter(Cliente.nome.ilike(str(nome_cliente))).first()
-
-                nova_entrada = Entrada(
-                    numero_pedido=num_pedido,
-                    tipo=tipo_entrada,
-                    cliente_id=cliente_obj.id if cliente_obj else None,
-                    cliente_nome_temp=str(nome_cliente) if not cliente_obj else None,
-                    obra=str(obra) if obra else None,
-                    status=str(status) if status in ['Não iniciado', 'Em andamento', 'Concluído'] else 'Não iniciado',
-                    descricao=str(descricao),
-                    observacoes=str(observacoes) if observacoes else None
-                )
-                db.session.add(nova_entrada)
-                entradas_adicionadas += 1
-
-            if entradas_adicionadas > 0:
-                db.session.commit()
-                global last_update_time
-                last_update_time = datetime.now()
-
-            mensagem = ""
-            if entradas_adicionadas > 0:
-                mensagem += f'{entradas_adicionadas} entrada(s) importada(s) com sucesso! '
-            if entradas_ignoradas > 0:
-                mensagem += f'{entradas_ignoradas} entrada(s) foram ignoradas por já existirem.'
-
-            if mensagem:
-                flash(mensagem, 'success' if entradas_adicionadas > 0 else 'info')
-            else:
-                flash('Nenhum dado novo para importar foi encontrado no ficheiro.', 'info')
-
+            relatorio = importar_entradas_em_lotes(ler_planilha(ficheiro, len(CAMPOS_IMPORTACAO_ENTRADAS)))
         except Exception as e:
             db.session.rollback()
             flash(f'Ocorreu um erro ao processar o ficheiro: {e}', 'danger')
+            return redirect(request.referrer)
 
-        return redirect(request.referrer)
+        if not relatorio.problemas:
+            if relatorio.adicionadas:
+                flash(relatorio.mensagem('entrada(s)'), 'success')
+            else:
+                flash('Nenhum dado novo para importar foi encontrado no ficheiro.', 'info')
+            return redirect(request.referrer)
+
+        # Relatório completo (ignoradas, inválidas e clientes não encontrados) guardado para download
+        tarefa = gestor_tarefas.guardar(
+            ['relatorio_importacao', uuid.uuid4().hex], current_user.id, 'relatorio_importacao_entradas.csv',
+            MIMETYPES['csv'], lambda caminho, progresso: _gravar_relatorio_csv(relatorio, caminho, progresso)
+        )
+        return render_template('relatorio_importacao.html', relatorio=relatorio, entidade='entrada(s)',
+                               voltar=request.referrer or url_for('painel_controle'),
+                               url_relatorio=url_for('baixar_exportacao', tarefa_id=tarefa['id']))
 
     flash('Formato de ficheiro inválido. Por favor, envie um ficheiro .xlsx.', 'danger')
     return redirect(request.referrer)
@@ -1579,12 +2981,32 @@ def relatorio_pedido(id):
 @app.route('/buscar-clientes')
 @login_required
 def buscar_clientes():
-    """Busca clientes por nome para o autocomplete."""
+    """Busca clientes por nome ou número para o autocomplete (índice em memória, sem ir ao banco)."""
     search = request.args.get('term', '')
-    query = Cliente.query.filter(Cliente.nome.ilike(f'%{search}%')).limit(10).all()
+    encontrados = indice_clientes.buscar(search, limite=10)
     # --- ALTERAÇÃO AQUI ---
     # Removemos o "N°: " da formatação da 'label'
-    results = [{'id': cliente.id, 'label': f"{cliente.nome} ({cliente.numero_cliente})", 'value': cliente.nome} for cliente in query]
+    results = [{'id': cliente_id, 'label': f"{nome} ({numero_cliente})", 'value': nome} for cliente_id, nome, numero_cliente in encontrados]
+    return jsonify(results)
+
+@app.route('/buscar-entradas')
+@login_required
+def buscar_entradas():
+    """Busca entradas (ativas e arquivadas) pelo índice de busca, ordenadas por relevância."""
+    termo = request.args.get('term', '').strip()
+    if not termo or not indice_busca.disponivel(db.session.connection()):
+        return jsonify([])
+    encontrados = indice_busca.buscar(db.session.connection(), termo, limite=20)
+    relevancia = {linha.id: linha.relevancia for linha in encontrados}
+    entradas = projetar_entradas(consulta_projecao_entradas().where(Entrada.id.in_(relevancia.keys()))) if relevancia else []
+    entradas.sort(key=lambda entrada: relevancia[entrada.id], reverse=True)
+    results = [{
+        'id': entrada.id,
+        'label': f"{entrada.tipo} {entrada.numero_pedido} - {entrada.nome_cliente or ''}",
+        'value': entrada.numero_pedido,
+        'arquivado': entrada.arquivado,
+        'relevancia': float(relevancia[entrada.id])
+    } for entrada in entradas]
     return jsonify(results)
 
 @app.route('/configurar-relatorio/<int:id>')
@@ -1761,63 +3183,67 @@ def salvar_textos_personalizados():
         db.session.rollback()
         return jsonify({'success': False, 'message': f'Erro ao salvar textos: {str(e)}'}), 500
 
+def _dados_relatorio(entrada):
+    """Dados do relatório de impressão: cabeçalho, anexos com as posições guardadas e textos."""
+    # Preparar dados para impressão
+    imagens_anexos = []
+    for anexo in entrada.anexos:
+        anexo_data = {
+            'id': anexo.id,
+            'caminho': url_for('anexo_derivado', tamanho='impressao', filename=anexo.filename),
+            'nome': anexo.filename,
+            'filename': anexo.filename
+        }
+        
+        # Incluir posições salvas se existirem
+        if anexo.position_left is not None:
+            anexo_data['position_left'] = anexo.position_left
+        if anexo.position_top is not None:
+            anexo_data['position_top'] = anexo.position_top
+        if anexo.width is not None:
+            anexo_data['width'] = anexo.width
+        if anexo.height is not None:
+            anexo_data['height'] = anexo.height
+            
+        imagens_anexos.append(anexo_data)
+    
+    # Preparar textos personalizados salvos
+    textos_personalizados = []
+    for texto in entrada.textos_personalizados:
+        texto_data = {
+            'id': texto.id,
+            'conteudo': texto.conteudo,
+            'position_left': texto.position_left,
+            'position_top': texto.position_top,
+            'font_size': texto.font_size,
+            'font_family': texto.font_family,
+            'color': texto.color
+        }
+        textos_personalizados.append(texto_data)
+    
+    return {
+        'id': entrada.id,
+        'numero_pedido': entrada.numero_pedido,
+        'numero_cliente': entrada.cliente.numero_cliente if entrada.cliente else '',
+        'cliente': entrada.cliente_nome_temp or (entrada.cliente.nome if entrada.cliente else ''),
+        'obra': entrada.obra or '',
+        'endereco': entrada.descricao or '',
+        'telefone': request.args.get('telefone', ''),
+        'servico_executado': request.args.get('servico_executado', ''),
+        'observacoes': entrada.observacoes or '',
+        'observacoes_pedido': entrada.observacoes_pedido or '',
+        'data_formatada': entrada.data_registro.strftime('%d/%m/%Y') if entrada.data_registro else '',
+        'imagens': imagens_anexos,  # Lista de imagens dos anexos
+        'textos_personalizados': textos_personalizados  # Lista de textos personalizados com posições
+    }
+
 @app.route('/imprimir-relatorio/<int:id>')
 @login_required
 def imprimir_relatorio(id):
     """Página de impressão/PDF do relatório com layout otimizado."""
     try:
         entrada = Entrada.query.get_or_404(id)
-        
-        # Preparar dados para impressão
-        imagens_anexos = []
-        for anexo in entrada.anexos:
-            anexo_data = {
-                'id': anexo.id,
-                'caminho': url_for('uploaded_file', filename=anexo.filename),
-                'nome': anexo.filename
-            }
-            
-            # Incluir posições salvas se existirem
-            if anexo.position_left is not None:
-                anexo_data['position_left'] = anexo.position_left
-            if anexo.position_top is not None:
-                anexo_data['position_top'] = anexo.position_top
-            if anexo.width is not None:
-                anexo_data['width'] = anexo.width
-            if anexo.height is not None:
-                anexo_data['height'] = anexo.height
-                
-            imagens_anexos.append(anexo_data)
-        
-        # Preparar textos personalizados salvos
-        textos_personalizados = []
-        for texto in entrada.textos_personalizados:
-            texto_data = {
-                'id': texto.id,
-                'conteudo': texto.conteudo,
-                'position_left': texto.position_left,
-                'position_top': texto.position_top,
-                'font_size': texto.font_size,
-                'font_family': texto.font_family,
-                'color': texto.color
-            }
-            textos_personalizados.append(texto_data)
-        
-        relatorio_data = {
-            'id': entrada.id,
-            'numero_pedido': entrada.numero_pedido,
-            'numero_cliente': entrada.cliente.numero_cliente if entrada.cliente else '',
-            'cliente': entrada.cliente_nome_temp or (entrada.cliente.nome if entrada.cliente else ''),
-            'obra': entrada.obra or '',
-            'endereco': entrada.descricao or '',
-            'telefone': request.args.get('telefone', ''),
-            'servico_executado': request.args.get('servico_executado', ''),
-            'observacoes': entrada.observacoes or '',
-            'observacoes_pedido': entrada.observacoes_pedido or '',
-            'data_formatada': entrada.data_registro.strftime('%d/%m/%Y') if entrada.data_registro else '',
-            'imagens': imagens_anexos,  # Lista de imagens dos anexos
-            'textos_personalizados': textos_personalizados  # Lista de textos personalizados com posições
-        }
+        relatorio_data = _dados_relatorio(entrada)
         
         return render_template('imprimir_relatorio.html', relatorio=relatorio_data)
         
@@ -1825,6 +3251,90 @@ def imprimir_relatorio(id):
         flash(f'Erro ao carregar página de impressão: {str(e)}', 'danger')
         return redirect(url_for('painel_controle'))
 
+def _estado_editor(entrada):
+    """Imagens e textos do parâmetro `estado` enviado pelo editor (o mesmo da página de impressão).
+
+    Retorna (imagens, textos) no formato de gerar_relatorio_pdf(), listas vazias se o estado não
+    for válido. Só são aceites anexos da própria entrada.
+    """
+    try:
+        estado = json.loads(urllib.parse.unquote(request.args.get('estado', '')))
+    except ValueError:
+        return [], []
+    if not isinstance(estado, dict):
+        return [], []
+    nomes = {anexo.filename for anexo in entrada.anexos}
+    imagens = []
+    for imagem in estado.get('imagens') or []:
+        if not isinstance(imagem, dict):
+            continue
+        filename = os.path.basename(urllib.parse.urlparse(str(imagem.get('caminho', ''))).path)
+        if filename in nomes:
+            imagens.append({'filename': filename, 'left': imagem.get('posicao_x') or 0, 'top': imagem.get('posicao_y') or 0,
+                            'width': imagem.get('largura'), 'height': imagem.get('altura')})
+    textos = [
+        {'conteudo': str(texto.get('conteudo') or ''), 'left': texto.get('posicao_x') or 0, 'top': texto.get('posicao_y') or 0,
+         'font_size': texto.get('font_size'), 'color': texto.get('color') or '#333333', 'bold': texto.get('bold'),
+         'italic': texto.get('italic'), 'underline': texto.get('underline'), 'fundo': False}
+        for texto in estado.get('textos') or [] if isinstance(texto, dict)
+    ]
+    return imagens, textos
+
+@app.route('/imprimir-relatorio/<int:id>/pdf')
+@login_required
+def relatorio_pdf(id):
+    """Relatório do pedido em PDF, gerado no servidor (ver relatorio_pdf.py).
+
+    Aceita os mesmos parâmetros da página de impressão: campos do cabeçalho (cliente, obra,
+    numero_cliente, numero_pedido, data) e o `estado` do editor com as posições por gravar.
+    O PDF fica guardado (ver cache_relatorios.py) e é reutilizado enquanto a versão do
+    relatório e os parâmetros forem os mesmos.
+    """
+    entrada = Entrada.query.get_or_404(id)
+    numero_pedido = request.args.get('numero_pedido') or str(entrada.numero_pedido or entrada.id)
+    chave = cache_relatorios.chave(entrada.versao_relatorio, VERSAO_DESENHO, entrada.data_registro,
+                                   sorted(request.args.items(multi=True)))
+    caminho = cache_relatorios.obter(entrada.id, chave)
+    if caminho is None:
+        caminho = cache_relatorios.guardar(entrada.id, chave, _gerar_relatorio_pdf(entrada, numero_pedido))
+
+    resposta = send_file(caminho, mimetype='application/pdf', as_attachment=True, etag=chave,
+                         download_name=f'relatorio_{secure_filename(numero_pedido) or entrada.id}.pdf')
+    resposta.cache_control.private = True
+    resposta.cache_control.no_cache = True
+    return resposta
+
+def _gerar_relatorio_pdf(entrada, numero_pedido):
+    """Compõe o PDF do relatório com os dados guardados e os parâmetros do pedido; retorna os bytes."""
+    relatorio = _dados_relatorio(entrada)
+    campos = [
+        ('Data:', request.args.get('data') or relatorio['data_formatada']),
+        ('N° Pedido:', numero_pedido),
+        ('N° Cliente:', request.args.get('numero_cliente') or str(relatorio['numero_cliente'] or '')),
+        ('Cliente:', request.args.get('cliente') or relatorio['cliente']),
+        ('Obra:', (request.args.get('obra') or relatorio['obra']).strip() or 'Não informado'),
+    ]
+    if relatorio['observacoes_pedido']:
+        campos.append(('Observações:', relatorio['observacoes_pedido']))
+
+    imagens = [
+        {'filename': imagem['filename'], 'left': imagem.get('position_left'), 'top': imagem.get('position_top'),
+         'width': imagem.get('width'), 'height': imagem.get('height')}
+        for imagem in relatorio['imagens']
+    ]
+    textos = [
+        {'conteudo': texto['conteudo'], 'left': texto['position_left'], 'top': texto['position_top'],
+         'font_size': texto['font_size'], 'color': texto['color']}
+        for texto in relatorio['textos_personalizados']
+    ]
+    if request.args.get('estado'):
+        # Como na página: o que vier no estado do editor substitui o que está guardado
+        imagens_estado, textos_estado = _estado_editor(entrada)
+        imagens = imagens_estado or imagens
+        textos = textos_estado or textos
+
+    return gerar_relatorio_pdf(app.config['UPLOAD_FOLDER'], campos, imagens, textos)
+
 # @app.cli.command("init-db")
 # def init_db_command():
 #    db.create_all()
@@ -0,0 +1,110 @@
+# armazenamento.py
+"""Armazenamento dos anexos por conteúdo.
+
+Cada ficheiro enviado é gravado na pasta de uploads com o nome <sha256 do conteúdo><extensão>,
+calculado enquanto o ficheiro é copiado para o disco (sem o carregar inteiro em memória). O
+nome escolhido pelo utilizador fica em Anexo.nome_original.
+
+- Dois ficheiros diferentes com o mesmo nome deixam de se sobrescrever.
+- O mesmo ficheiro anexado a vários pedidos ocupa espaço uma única vez: todos os Anexo
+  apontam para o mesmo nome.
+- As referências de cada ficheiro são as linhas de Anexo com esse nome; o ficheiro só é
+  apagado quando a última deixa de existir.
+
+Os ficheiros recebidos em blocos (ver envios.py) já têm o SHA-256 calculado na conclusão e
+são movidos para o lugar com guardar_caminho().
+
+Reutilizar um ficheiro que já existe e apagar um ficheiro sem referências não podem
+cruzar-se (o ficheiro seria apagado logo depois de um novo anexo passar a usá-lo): quem
+guarda passa `travar`, chamado com o nome antes de ver se o ficheiro existe, e quem apaga
+usa a mesma trava (ver travar_ficheiros() em app.py).
+"""
+import errno
+import hashlib
+import os
+import re
+import shutil
+import threading
+
+from imagens import remover_derivados
+
+BLOCO = 1024 * 1024
+
+_EXTENSAO_VALIDA = re.compile(r'\.[a-z0-9]{1,10}')
+# Nome de um ficheiro guardado pelo conteúdo: <sha256><extensão>
+_NOME_POR_CONTEUDO = re.compile(r'([0-9a-f]{64})(?:\.[a-z0-9]{1,10})?')
+
+
+def extensao(nome_ficheiro):
+    """Extensão em minúsculas (com o ponto), ou '' se não for uma extensão simples."""
+    sufixo = os.path.splitext(nome_ficheiro or '')[1].lower()
+    return sufixo if _EXTENSAO_VALIDA.fullmatch(sufixo) else ''
+
+
+def hash_do_nome(nome_ficheiro):
+    """SHA-256 do conteúdo, se o ficheiro foi guardado pelo conteúdo; None para nomes antigos."""
+    correspondencia = _NOME_POR_CONTEUDO.fullmatch(nome_ficheiro)
+    return correspondencia.group(1) if correspondencia else None
+
+
+def _temporario(pasta):
+    return os.path.join(pasta, f'.envio.{os.getpid()}.{threading.get_ident()}.tmp')
+
+
+def guardar_ficheiro(pasta, ficheiro, travar=None):
+    """Grava o FileStorage enviado pelo seu conteúdo e retorna (nome gravado, sha256, novo).
+
+    `novo` é False quando um ficheiro igual já estava guardado; nesse caso o original e os
+    derivados existentes são reutilizados e a cópia enviada é descartada.
+    """
+    resumo = hashlib.sha256()
+    temporario = _temporario(pasta)
+    try:
+        with open(temporario, 'wb') as destino:
+            for bloco in iter(lambda: ficheiro.stream.read(BLOCO), b''):
+                resumo.update(bloco)
+                destino.write(bloco)
+        hash_sha256 = resumo.hexdigest()
+        nome, novo = guardar_caminho(pasta, temporario, hash_sha256, ficheiro.filename, travar)
+        return nome, hash_sha256, novo
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+
+def guardar_caminho(pasta, caminho, hash_sha256, nome_ficheiro, travar=None):
+    """Move para a pasta de uploads um ficheiro já completo cujo SHA-256 é conhecido.
+
+    Retorna (nome gravado, novo). Se um ficheiro igual já estava guardado, `caminho` fica onde
+    está e cabe a quem chamou apagá-lo. `travar(nome)`, se indicado, é chamado antes de
+    verificar se o ficheiro existe.
+    """
+    nome = hash_sha256 + extensao(nome_ficheiro)
+    if travar is not None:
+        travar(nome)
+    destino = os.path.join(pasta, nome)
+    if os.path.exists(destino):
+        return nome, False
+    try:
+        os.replace(caminho, destino)
+    except OSError as erro:
+        if erro.errno != errno.EXDEV:
+            raise
+        # Origem noutro sistema de ficheiros: copia para junto do destino e troca de uma vez
+        temporario = _temporario(pasta)
+        try:
+            shutil.copyfile(caminho, temporario)
+            os.replace(temporario, destino)
+        finally:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+    return nome, True
+
+
+def apagar_ficheiro(pasta, nome):
+    """Apaga um ficheiro guardado e os seus derivados (chamar só quando já não tem referências)."""
+    remover_derivados(pasta, nome)
+    try:
+        os.remove(os.path.join(pasta, nome))
+    except FileNotFoundError:
+        pass
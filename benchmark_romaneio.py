@@ -0,0 +1,125 @@
+# benchmark_romaneio.py
+"""Mede a leitura de romaneios em PDF sintéticos gerados com o PyMuPDF.
+
+Compara a leitura anterior (texto do documento inteiro concatenado e separado de uma vez)
+com romaneio.py em modo sequencial e com o pool de processos, e confirma que as três
+produzem os mesmos pedidos.
+
+Uso: python benchmark_romaneio.py [--paginas 400] [--pedidos-por-pagina 2] [--processos 4] [--repeticoes 3]
+"""
+import argparse
+import os
+import re
+import time
+import tracemalloc
+
+import fitz
+
+from romaneio import analisar_romaneio
+
+PRODUTOS = ('VIDRO TEMPERADO INCOLOR 8MM', 'ESPELHO PRATA 4MM', 'VIDRO LAMINADO FUME 10MM',
+            'VIDRO COMUM INCOLOR 6MM')
+
+
+def gerar_pdf(paginas, pedidos_por_pagina, produtos_por_pedido=4):
+    """PDF com o layout do romaneio: cliente, cabeçalho do pedido e tabela de produtos."""
+    documento = fitz.open()
+    numero = 10000
+    for _ in range(paginas):
+        pagina = documento.new_page(width=595, height=842)
+        linhas = []
+        for _ in range(pedidos_por_pagina):
+            numero += 1
+            linhas += [
+                f'CLIENTE {numero} LTDA - VID. CENTRO',
+                'Pedido  Pedido Cli.  Tipo  Funcionário  Data Pedido  Data Entrega  Peso  m²  Total',
+                f'{numero}  PC{numero}  Venda  JOAO  01/02/2024  05/02/2024  120,50  14,20  2.350,00',
+                'Cod  Produto  LarguraxAltura  Qtde  m²',
+            ]
+            for indice in range(produtos_por_pedido):
+                linhas.append(f'{1000 + indice}  {PRODUTOS[indice % len(PRODUTOS)]}  OS:{numero}{indice}  '
+                              f'{500 + indice * 10}x{1200 + indice * 5}  {indice + 1}  {indice + 1},25')
+            linhas.append('Resumo: pedido conferido')
+        pagina.insert_text((30, 30), '\n'.join(linhas), fontsize=7)
+    dados = documento.tobytes()
+    documento.close()
+    return dados
+
+
+def analisar_anterior(pdf_bytes):
+    """Leitura anterior: junta o texto de todas as páginas e aplica os padrões a cada bloco."""
+    texto_completo = ''
+    with fitz.open(stream=pdf_bytes, filetype='pdf') as doc:
+        for page in doc:
+            texto_completo += page.get_text()
+
+    relatorios = []
+    for bloco in re.split(r'Pedido\s+Pedido Cli\.', texto_completo, flags=re.IGNORECASE)[1:]:
+        cliente_match = re.search(r'\n([A-Z\s\d\.\-]+-\s*VID\..*?)\n', bloco)
+        nome_cliente = cliente_match.group(1).strip() if cliente_match else 'Cliente não encontrado'
+        padrao_cabecalho = re.search(r'Tipo\s+Funcionário\s+Data Pedido\s+Data Entrega\s+Peso\s+m²\s+Total\n(.*?)\n',
+                                     bloco, re.IGNORECASE | re.DOTALL)
+        dados_cabecalho = {}
+        if padrao_cabecalho:
+            valores = re.split(r'\s{2,}', padrao_cabecalho.group(1).strip())
+            if len(valores) >= 9:
+                dados_cabecalho = {
+                    'pedido': valores[0], 'pedido_cli': valores[1], 'tipo': valores[2],
+                    'funcionario': valores[3], 'data_pedido': valores[4], 'data_entrega': valores[5],
+                    'peso': valores[6], 'm2': valores[7], 'total': valores[8], 'cliente': nome_cliente,
+                }
+        produtos = []
+        seccao = re.search(r'Cod\s+Produto\s+LarguraxAltura(.*?)Resumo:', bloco, re.IGNORECASE | re.DOTALL)
+        if seccao:
+            for linha in re.findall(r'(\d{4,})\s+(.*?)\s+OS:(\d+)\s+(\d+x\d+)\s+(\d+)\s+([\d,]+)',
+                                    seccao.group(1), re.DOTALL):
+                produtos.append({'cod': linha[0].strip(), 'produto': linha[1].replace('\n', ' ').strip(),
+                                 'os': linha[2].strip(), 'dimensoes': linha[3].strip(),
+                                 'qtde': linha[4].strip(), 'm2': linha[5].strip()})
+        if dados_cabecalho:
+            relatorios.append({'cabecalho': dados_cabecalho, 'produtos': produtos})
+    return relatorios
+
+
+def medir(nome, funcao, repeticoes):
+    melhor = None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = funcao()
+        duracao = time.perf_counter() - inicio
+        melhor = duracao if melhor is None else min(melhor, duracao)
+    tracemalloc.start()
+    funcao()
+    pico = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'{nome:<28} {melhor:8.3f} s   pico {pico / 1024 / 1024:7.1f} MB   {len(resultado)} pedidos')
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--paginas', type=int, default=400)
+    parser.add_argument('--pedidos-por-pagina', type=int, default=2)
+    parser.add_argument('--processos', type=int, default=min(os.cpu_count() or 1, 4))
+    parser.add_argument('--repeticoes', type=int, default=3)
+    argumentos = parser.parse_args()
+
+    pdf_bytes = gerar_pdf(argumentos.paginas, argumentos.pedidos_por_pagina)
+    print(f'PDF sintético: {argumentos.paginas} páginas, {len(pdf_bytes) / 1024:.0f} KB, '
+          f'{os.cpu_count()} CPU(s)\n')
+
+    anterior = medir('anterior', lambda: analisar_anterior(pdf_bytes), argumentos.repeticoes)
+    sequencial = medir('romaneio.py sequencial', lambda: analisar_romaneio(pdf_bytes), argumentos.repeticoes)
+    # A primeira chamada cria o pool de processos; não entra nas medições
+    analisar_romaneio(pdf_bytes, processos=argumentos.processos, paginas_paralelo=1)
+    paralelo = medir(f'romaneio.py {argumentos.processos} processos',
+                     lambda: analisar_romaneio(pdf_bytes, processos=argumentos.processos, paginas_paralelo=1),
+                     argumentos.repeticoes)
+
+    if not anterior == sequencial == paralelo:
+        raise SystemExit('ERRO: os resultados diferem entre as leituras.')
+    print('\nResultados idênticos nas três leituras.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+# busca.py
+"""Índice de busca textual das entradas (painel e arquivados), sem varreduras sequenciais.
+
+Dois backends, escolhidos em app.py pelo banco configurado:
+
+- IndiceBuscaPostgres: extensões pg_trgm e unaccent, com índices GIN de trigramas sobre as
+  colunas normalizadas (minúsculas e sem acentos). O próprio PostgreSQL mantém os índices.
+- IndiceBuscaSQLite: tabela-sombra FTS5 (tokenizer trigram) com os textos já normalizados,
+  mantida pela aplicação no mesmo flush que altera as entradas ou os clientes.
+
+Ambos fazem correspondência por substring, como o ILIKE '%termo%' que substituem, mas
+insensível a acentos ("conceicao" encontra "Conceição"), e ordenam por relevância em buscar().
+As estruturas são criadas por preparar(), chamado pela migração 1 (migracoes.py).
+"""
+import logging
+import time
+import unicodedata
+
+from sqlalchemy import Text, cast, func, literal_column, or_, select, text, union
+from sqlalchemy.sql import column, table
+
+logger = logging.getLogger(__name__)
+
+# Campos pesquisáveis de uma entrada
+CAMPOS = ('numero', 'descricao', 'obra', 'cliente')
+
+
+def normalizar(texto):
+    """Minúsculas e sem acentos: 'Conceição' -> 'conceicao'."""
+    if texto is None:
+        return ''
+    decomposto = unicodedata.normalize('NFKD', str(texto))
+    return ''.join(c for c in decomposto if not unicodedata.combining(c)).lower()
+
+
+def _escapar_like(termo):
+    return termo.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class _IndiceBusca:
+    """Base comum: guarda as tabelas e a verificação de disponibilidade."""
+
+    # Se True, a aplicação tem de chamar sincronizar() a cada flush
+    mantido_pela_aplicacao = False
+
+    def __init__(self, entrada, cliente):
+        self.entrada = entrada
+        self.cliente = cliente
+        self._disponivel = False
+        self._verificado_em = 0.0
+
+    def disponivel(self, conexao):
+        """Indica se as estruturas já foram criadas (verificação repetida no máximo a cada minuto)."""
+        if not self._disponivel and time.monotonic() - self._verificado_em > 60:
+            self._verificado_em = time.monotonic()
+            try:
+                self._disponivel = self._existe(conexao)
+            except Exception:
+                logger.exception('Falha ao verificar o índice de busca')
+        return self._disponivel
+
+    def sincronizar(self, conexao, entradas=(), removidas=(), clientes=()):
+        """Atualiza o índice para as entradas/clientes alterados; nada a fazer por omissão."""
+
+
+class IndiceBuscaPostgres(_IndiceBusca):
+    """Índices GIN de trigramas (pg_trgm) sobre expressões normalizadas com unaccent."""
+
+    FUNCAO = 'busca_normalizar'
+
+    def _indices(self):
+        entrada, cliente = self.entrada.name, self.cliente.name
+        return {
+            'ix_busca_entrada_numero': f'{entrada} USING gin ((numero_pedido::text) gin_trgm_ops)',
+            'ix_busca_entrada_descricao': f'{entrada} USING gin ({self.FUNCAO}(descricao) gin_trgm_ops)',
+            'ix_busca_entrada_obra': f'{entrada} USING gin ({self.FUNCAO}(obra) gin_trgm_ops)',
+            'ix_busca_entrada_cliente_temp': f'{entrada} USING gin ({self.FUNCAO}(cliente_nome_temp) gin_trgm_ops)',
+            'ix_busca_cliente_nome': f'{cliente} USING gin ({self.FUNCAO}(nome) gin_trgm_ops)',
+        }
+
+    def preparar(self, conexao):
+        conexao.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        conexao.execute(text('CREATE EXTENSION IF NOT EXISTS unaccent'))
+        # unaccent() não é IMMUTABLE (depende do search_path); o wrapper fixa o dicionário
+        # para poder ser usado em índices de expressão
+        conexao.execute(text(
+            f"CREATE OR REPLACE FUNCTION {self.FUNCAO}(text) RETURNS text "
+            "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT "
+            "AS $$ SELECT lower(public.unaccent('public.unaccent'::regdictionary, $1)) $$"
+        ))
+        # CONCURRENTLY não bloqueia as escritas, mas exige uma ligação em autocommit (ver migracoes.py)
+        for nome, definicao in self._indices().items():
+            invalido = conexao.execute(
+                text('SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:nome)'), {'nome': nome}
+            ).scalar()
+            if invalido:
+                conexao.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {nome}'))
+            conexao.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {nome} ON {definicao}'))
+        self._disponivel = True
+
+    def _existe(self, conexao):
+        return conexao.execute(text(
+            "SELECT to_regprocedure(:funcao) IS NOT NULL AND to_regclass('ix_busca_cliente_nome') IS NOT NULL"
+        ), {'funcao': f'{self.FUNCAO}(text)'}).scalar()
+
+    def _normalizada(self, coluna):
+        return getattr(func, self.FUNCAO)(coluna)
+
+    def _padrao(self, termo):
+        return func.concat('%', self._normalizada(_escapar_like(termo)), '%')
+
+    def _consultas(self, termo, campos):
+        e, c = self.entrada.c, self.cliente.c
+        padrao = self._padrao(termo)
+        consultas = []
+        if 'numero' in campos:
+            consultas.append(select(e.id).where(
+                cast(e.numero_pedido, Text).like(f'%{_escapar_like(termo)}%', escape='\\')
+            ))
+        for campo, coluna in (('descricao', e.descricao), ('obra', e.obra), ('cliente', e.cliente_nome_temp)):
+            if campo in campos:
+                consultas.append(select(e.id).where(self._normalizada(coluna).like(padrao, escape='\\')))
+        if 'cliente' in campos:
+            consultas.append(
+                select(e.id).select_from(self.entrada.join(self.cliente, e.cliente_id == c.id))
+                .where(self._normalizada(c.nome).like(padrao, escape='\\'))
+            )
+        return consultas
+
+    def condicao(self, termo, campos=CAMPOS):
+        """Condição sobre entrada.id: cada ramo da união usa o seu índice GIN."""
+        return self.entrada.c.id.in_(union(*self._consultas(termo, campos)))
+
+    def buscar(self, conexao, termo, limite=50, campos=CAMPOS):
+        """Ids das entradas encontradas, da mais para a menos relevante (similaridade de trigramas)."""
+        e, c = self.entrada.c, self.cliente.c
+        termo_normalizado = self._normalizada(termo)
+        similaridades = [func.word_similarity(termo_normalizado, cast(e.numero_pedido, Text))]
+        similaridades += [
+            func.word_similarity(termo_normalizado, func.coalesce(self._normalizada(coluna), ''))
+            for coluna in (e.descricao, e.obra, e.cliente_nome_temp, c.nome)
+        ]
+        relevancia = func.greatest(*similaridades)
+        consulta = (
+            select(e.id, relevancia.label('relevancia'))
+            .select_from(self.entrada.outerjoin(self.cliente, e.cliente_id == c.id))
+            .where(self.condicao(termo, campos))
+            .order_by(relevancia.desc(), e.id.desc())
+            .limit(limite)
+        )
+        return conexao.execute(consulta).all()
+
+
+class IndiceBuscaSQLite(_IndiceBusca):
+    """Tabela-sombra FTS5 com trigramas; rowid = id da entrada."""
+
+    mantido_pela_aplicacao = True
+    TABELA = 'busca_entrada'
+    LOTE = 500
+
+    def __init__(self, entrada, cliente):
+        super().__init__(entrada, cliente)
+        self.sombra = table(self.TABELA, column('rowid'), *[column(campo) for campo in CAMPOS])
+
+    def preparar(self, conexao):
+        conexao.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.TABELA} "
+            f"USING fts5({', '.join(CAMPOS)}, tokenize='trigram')"
+        ))
+        # Reconstrói a sombra a partir das tabelas reais
+        conexao.execute(text(f'DELETE FROM {self.TABELA}'))
+        ids = list(conexao.execute(select(self.entrada.c.id)).scalars())
+        for inicio in range(0, len(ids), self.LOTE):
+            self._indexar(conexao, ids[inicio:inicio + self.LOTE])
+        self._disponivel = True
+
+    def _existe(self, conexao):
+        return conexao.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :nome"), {'nome': self.TABELA}
+        ).first() is not None
+
+    def _indexar(self, conexao, ids):
+        if not ids:
+            return
+        e, c = self.entrada.c, self.cliente.c
+        linhas = conexao.execute(
+            select(e.id, e.numero_pedido, e.descricao, e.obra, e.cliente_nome_temp, c.nome)
+            .select_from(self.entrada.outerjoin(self.cliente, e.cliente_id == c.id))
+            .where(e.id.in_(ids))
+        ).all()
+        conexao.execute(self.sombra.delete().where(self.sombra.c.rowid.in_(ids)))
+        if linhas:
+            conexao.execute(self.sombra.insert(), [{
+                'rowid': linha.id,
+                'numero': str(linha.numero_pedido),
+                'descricao': normalizar(linha.descricao),
+                'obra': normalizar(linha.obra),
+                'cliente': ' '.join(filter(None, (normalizar(linha.nome), normalizar(linha.cliente_nome_temp)))),
+            } for linha in linhas])
+
+    def sincronizar(self, conexao, entradas=(), removidas=(), clientes=()):
+        if not self.disponivel(conexao):
+            return
+        ids = set(entradas)
+        if clientes:
+            # O nome do cliente está indexado em todas as suas entradas (ativas e arquivadas)
+            ids.update(conexao.execute(
+                select(self.entrada.c.id).where(self.entrada.c.cliente_id.in_(list(clientes)))
+            ).scalars())
+        ids -= set(removidas)
+        if removidas:
+            conexao.execute(self.sombra.delete().where(self.sombra.c.rowid.in_(list(removidas))))
+        ids = list(ids)
+        for inicio in range(0, len(ids), self.LOTE):
+            self._indexar(conexao, ids[inicio:inicio + self.LOTE])
+
+    def _filtro(self, termo, campos):
+        termo = normalizar(termo)
+        if len(termo) >= 3:
+            # Frase FTS5 restrita às colunas: com trigramas equivale a uma busca por substring
+            frase = '"' + termo.replace('"', '""') + '"'
+            return literal_column(self.TABELA).op('MATCH')('{' + ' '.join(campos) + '} : ' + frase)
+        # Termos com menos de 3 caracteres não formam trigramas: LIKE sobre a sombra
+        padrao = f'%{_escapar_like(termo)}%'
+        return or_(*[self.sombra.c[campo].like(padrao, escape='\\') for campo in campos])
+
+    def condicao(self, termo, campos=CAMPOS):
+        return self.entrada.c.id.in_(select(self.sombra.c.rowid).where(self._filtro(termo, campos)))
+
+    def buscar(self, conexao, termo, limite=50, campos=CAMPOS):
+        """Ids das entradas encontradas, da mais para a menos relevante (bm25 do FTS5)."""
+        # Termos curtos não passam pelo MATCH e não têm bm25: ficam as entradas mais recentes primeiro
+        curto = len(normalizar(termo)) < 3
+        relevancia = literal_column('0') if curto else literal_column('-rank')
+        consulta = (
+            select(self.sombra.c.rowid.label('id'), relevancia.label('relevancia'))
+            .where(self._filtro(termo, campos))
+            .order_by(self.sombra.c.rowid.desc() if curto else literal_column('rank'))
+            .limit(limite)
+        )
+        return conexao.execute(consulta).all()
+
+
+def criar_indice_busca(backend, entrada, cliente):
+    """Cria o índice correspondente ao banco ('postgresql' ou 'sqlite'); recebe as Tables de Entrada e Cliente."""
+    if backend == 'postgresql':
+        return IndiceBuscaPostgres(entrada, cliente)
+    if backend == 'sqlite':
+        return IndiceBuscaSQLite(entrada, cliente)
+    raise ValueError(f'Banco sem índice de busca suportado: {backend}')
@@ -0,0 +1,90 @@
+# cache_relatorios.py
+"""PDFs dos relatórios já gerados, guardados em disco até o relatório mudar.
+
+Cada entrada tem uma versão do relatório (Entrada.versao_relatorio), incrementada sempre
+que muda algo que aparece na folha: posições dos anexos, textos personalizados, campos do
+cabeçalho, anexos acrescentados ou removidos, o cliente. O PDF fica em
+<pasta>/<entrada>/<versão>-<resumo>.pdf, onde o resumo cobre os parâmetros do pedido (campos
+do cabeçalho e estado do editor) e a versão do desenho (relatorio_pdf.VERSAO_DESENHO).
+
+Como a chave muda com tudo o que o PDF mostra, o que está guardado nunca fica
+desatualizado e nada precisa de ser apagado para invalidar: uma nova versão simplesmente
+não encontra o ficheiro antigo. Ao gravar uma versão, os ficheiros das anteriores são
+apagados; a pasta de uma entrada excluída é removida com ela.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+# Variantes (parâmetros diferentes) guardadas por entrada na mesma versão
+VARIANTES_POR_ENTRADA = 20
+
+
+class CacheRelatorios:
+
+    def __init__(self, pasta, variantes=VARIANTES_POR_ENTRADA):
+        self.pasta = pasta
+        self.variantes = variantes
+        os.makedirs(pasta, exist_ok=True)
+
+    def _pasta_entrada(self, entrada_id):
+        return os.path.join(self.pasta, str(int(entrada_id)))
+
+    @staticmethod
+    def chave(versao, *partes):
+        """Nome do ficheiro para a versão do relatório e as restantes partes da chave (serializáveis em JSON)."""
+        resumo = hashlib.sha256(json.dumps(partes, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return f'{int(versao)}-{resumo[:32]}'
+
+    def obter(self, entrada_id, chave):
+        """Caminho do PDF guardado com esta chave, ou None."""
+        caminho = os.path.join(self._pasta_entrada(entrada_id), chave + '.pdf')
+        return caminho if os.path.isfile(caminho) else None
+
+    def guardar(self, entrada_id, chave, dados):
+        """Grava o PDF e apaga os de versões anteriores da entrada; retorna o caminho."""
+        pasta = self._pasta_entrada(entrada_id)
+        os.makedirs(pasta, exist_ok=True)
+        destino = os.path.join(pasta, chave + '.pdf')
+        # Dois pedidos podem gerar o mesmo relatório ao mesmo tempo: cada um grava o seu temporário
+        temporario = f'{destino}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temporario, 'wb') as ficheiro:
+                ficheiro.write(dados)
+            os.replace(temporario, destino)
+        finally:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+        self._podar(pasta, chave)
+        return destino
+
+    def _podar(self, pasta, chave):
+        versao = chave.split('-', 1)[0]
+        variantes = []
+        for nome in os.listdir(pasta):
+            caminho = os.path.join(pasta, nome)
+            if not nome.endswith('.pdf'):
+                continue
+            if nome.split('-', 1)[0] != versao:
+                self._apagar(caminho)
+            else:
+                try:
+                    variantes.append((os.path.getmtime(caminho), caminho))
+                except OSError:
+                    pass
+        # Estados do editor por gravar dão muitas variantes: ficam só as mais recentes
+        for _, caminho in sorted(variantes, reverse=True)[self.variantes:]:
+            self._apagar(caminho)
+
+    @staticmethod
+    def _apagar(caminho):
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+
+    def remover(self, entrada_id):
+        """Apaga os PDFs guardados de uma entrada (excluída)."""
+        shutil.rmtree(self._pasta_entrada(entrada_id), ignore_errors=True)
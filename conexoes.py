@@ -0,0 +1,156 @@
+# conexoes.py
+"""Gestão das ligações ao banco: modo do pool escolhido por configuração e telemetria.
+
+Modos (DB_POOL_MODO):
+
+- 'fila': QueuePool do SQLAlchemy. Mantém até DB_POOL_TAMANHO ligações abertas por worker
+  (mais DB_POOL_EXCEDENTE temporárias), com pre-ping e reciclagem, evitando abrir uma ligação
+  TCP/TLS nova em cada pedido. Indicado para a ligação direta ao PostgreSQL (porta 5432).
+- 'pgbouncer': para o pooler em modo transação (Supabase, porta 6543). O pool local guarda
+  apenas as ligações ao pgbouncer, que por sua vez partilha as ligações ao PostgreSQL; as
+  ligações são devolvidas com ROLLBACK e recicladas mais cedo. Neste modo o banco não
+  preserva estado de sessão entre transações: LISTEN (PAINEL_PUSH_BACKEND='postgres') e as
+  migrações (advisory lock, CREATE INDEX CONCURRENTLY) devem usar a ligação direta.
+- 'nenhum': NullPool, uma ligação nova por checkout (comportamento anterior).
+
+Dimensionamento: cada thread de um worker gunicorn usa no máximo uma ligação de cada vez,
+por isso DB_POOL_TAMANHO ~ threads por worker; o total no servidor é workers x (tamanho +
+excedente), que tem de caber no limite de ligações do banco ou do pooler.
+"""
+import collections
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as TimeoutPool
+from sqlalchemy.pool import NullPool, QueuePool
+
+# Quantas esperas recentes entram no cálculo dos percentis
+AMOSTRAS_ESPERA = 1000
+
+
+class TelemetriaPool:
+    """Contadores de uso do pool, partilhados pelas threads do worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.ligacoes_criadas = 0
+        self.invalidacoes = 0
+        self.esgotamentos = 0
+        self.espera_total = 0.0
+        self.espera_maxima = 0.0
+        self._esperas = collections.deque(maxlen=AMOSTRAS_ESPERA)
+
+    def registrar_espera(self, segundos):
+        with self._lock:
+            self.checkouts += 1
+            self.espera_total += segundos
+            self.espera_maxima = max(self.espera_maxima, segundos)
+            self._esperas.append(segundos)
+
+    def incrementar(self, contador):
+        with self._lock:
+            setattr(self, contador, getattr(self, contador) + 1)
+
+    def resumo(self):
+        with self._lock:
+            esperas = sorted(self._esperas)
+            dados = {
+                'checkouts': self.checkouts,
+                'ligacoes_criadas': self.ligacoes_criadas,
+                'invalidacoes': self.invalidacoes,
+                'esgotamentos': self.esgotamentos,
+                'espera_media_ms': round(1000 * self.espera_total / self.checkouts, 3) if self.checkouts else 0.0,
+                'espera_maxima_ms': round(1000 * self.espera_maxima, 3),
+            }
+        for nome, fracao in (('espera_p50_ms', 0.5), ('espera_p95_ms', 0.95), ('espera_p99_ms', 0.99)):
+            dados[nome] = round(1000 * esperas[min(int(len(esperas) * fracao), len(esperas) - 1)], 3) if esperas else 0.0
+        return dados
+
+
+class _PoolMedido:
+    """Mede o tempo de cada checkout (espera por uma ligação livre ou criação de uma nova)."""
+
+    telemetria = None
+
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutPool:
+            # Todas as ligações ocupadas durante pool_timeout segundos
+            self.telemetria.incrementar('esgotamentos')
+            raise
+        finally:
+            self.telemetria.registrar_espera(time.perf_counter() - inicio)
+
+
+class QueuePoolMedido(_PoolMedido, QueuePool):
+    pass
+
+
+class NullPoolMedido(_PoolMedido, NullPool):
+    pass
+
+
+def _inteiro(config, chave, padrao):
+    return int(config.get(chave, padrao))
+
+
+def opcoes_engine(modo, config, telemetria):
+    """Retorna SQLALCHEMY_ENGINE_OPTIONS para o modo indicado ('fila', 'pgbouncer' ou 'nenhum').
+
+    `config` é um dicionário com as chaves DB_POOL_* (normalmente os.environ).
+    """
+    classe_base = {'fila': QueuePoolMedido, 'pgbouncer': QueuePoolMedido, 'nenhum': NullPoolMedido}.get(modo)
+    if classe_base is None:
+        raise ValueError(f'Modo de pool desconhecido: {modo}')
+    # Subclasse própria para que cada app tenha a sua telemetria
+    classe = type(classe_base.__name__, (classe_base,), {'telemetria': telemetria})
+
+    if modo == 'nenhum':
+        return {'poolclass': classe}
+
+    opcoes = {
+        'poolclass': classe,
+        'pool_size': _inteiro(config, 'DB_POOL_TAMANHO', 5),
+        'max_overflow': _inteiro(config, 'DB_POOL_EXCEDENTE', 10),
+        'pool_timeout': _inteiro(config, 'DB_POOL_TIMEOUT', 30),
+        'pool_recycle': _inteiro(config, 'DB_POOL_RECICLAR', 1800),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+    if modo == 'pgbouncer':
+        # O pgbouncer fecha ligações de clientes inativas (client_idle_timeout); recicla antes disso
+        opcoes['pool_recycle'] = min(opcoes['pool_recycle'], _inteiro(config, 'DB_POOL_RECICLAR_PGBOUNCER', 300))
+        opcoes['pool_pre_ping'] = True
+        opcoes['pool_reset_on_return'] = 'rollback'
+    return opcoes
+
+
+def instrumentar_engine(engine, telemetria):
+    """Conta as ligações físicas abertas e invalidadas pelo engine."""
+    @event.listens_for(engine, 'connect')
+    def _ao_ligar(dbapi_connection, connection_record):
+        telemetria.incrementar('ligacoes_criadas')
+
+    @event.listens_for(engine, 'invalidate')
+    def _ao_invalidar(dbapi_connection, connection_record, exception):
+        telemetria.incrementar('invalidacoes')
+
+
+def estado_pool(engine, modo, telemetria):
+    """Fotografia do pool do worker atual, para dimensionamento."""
+    pool = engine.pool
+    dados = {'modo': modo}
+    if isinstance(pool, QueuePool):
+        dados.update({
+            'tamanho': pool.size(),
+            'em_uso': pool.checkedout(),
+            'livres': pool.checkedin(),
+            'excedente': max(pool.overflow(), 0),
+            'excedente_maximo': pool._max_overflow,
+            'timeout': pool.timeout(),
+        })
+    dados.update(telemetria.resumo())
+    return dados
@@ -0,0 +1,203 @@
+# envios.py
+"""Envio de anexos em blocos, retomável depois de uma ligação cortada.
+
+O navegador abre o envio (nome e tamanho do ficheiro), manda o conteúdo em blocos com a
+posição de cada um e, no fim, pede a conclusão com o SHA-256 que calculou. Cada bloco é um
+pedido curto, por isso um ficheiro grande não ocupa um worker durante minutos e uma ligação
+cortada só obriga a reenviar os blocos que faltam.
+
+Cada envio tem uma pasta dentro de ENVIOS_PASTA com:
+
+- envio.json: dono, entrada, nome e tamanho declarados (gravado uma vez, na abertura);
+- dados: o ficheiro, criado já com o tamanho final, onde cada bloco é escrito na sua posição;
+- blocos/: um ficheiro vazio <início>-<comprimento> por bloco gravado por inteiro.
+
+Como cada bloco escreve a sua própria zona do ficheiro e regista-se num ficheiro próprio,
+vários blocos podem chegar ao mesmo tempo, a qualquer worker, sem locks. O que já foi
+recebido é a união dos blocos registados; um bloco interrompido a meio não se regista e volta
+a ser pedido. Envios sem atividade durante o prazo de retenção são apagados.
+"""
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import time
+
+BLOCO_LEITURA = 1024 * 1024
+
+
+class ErroEnvio(Exception):
+    """Pedido de envio inválido (tamanho acima do limite, bloco fora do ficheiro, hash diferente...)."""
+
+
+class TamanhoExcedido(ErroEnvio):
+    """O ficheiro ou o bloco passa do tamanho máximo configurado."""
+
+
+class HashDiferente(ErroEnvio):
+    """O ficheiro recebido está completo mas não é o que o navegador tem (o envio é apagado)."""
+
+
+class GestorEnvios:
+
+    def __init__(self, pasta, tamanho_maximo, bloco_maximo, retencao=86400):
+        self.pasta = pasta
+        self.tamanho_maximo = tamanho_maximo
+        self.bloco_maximo = bloco_maximo
+        self.retencao = retencao
+        os.makedirs(pasta, exist_ok=True)
+
+    # --- Estado persistente ---
+
+    def _pasta_envio(self, envio_id):
+        return os.path.join(self.pasta, envio_id)
+
+    def caminho_dados(self, envio):
+        return os.path.join(self._pasta_envio(envio['id']), 'dados')
+
+    def obter(self, envio_id):
+        """Estado do envio (dicionário) ou None se não existir ou já tiver sido concluído/apagado."""
+        if not envio_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self._pasta_envio(envio_id), 'envio.json'), encoding='utf-8') as ficheiro:
+                return json.load(ficheiro)
+        except (OSError, ValueError):
+            return None
+
+    def _ultima_atividade(self, envio):
+        try:
+            return max(envio['criado_em'], os.path.getmtime(os.path.join(self._pasta_envio(envio['id']), 'blocos')))
+        except OSError:
+            return envio['criado_em']
+
+    def limpar(self):
+        """Remove os envios sem blocos novos há mais do que o prazo de retenção."""
+        agora = time.time()
+        for nome in os.listdir(self.pasta):
+            envio = self.obter(nome)
+            if envio is None:
+                # Pasta de um envio cuja abertura falhou a meio
+                caminho = self._pasta_envio(nome)
+                if os.path.isdir(caminho) and agora - os.path.getmtime(caminho) > self.retencao:
+                    shutil.rmtree(caminho, ignore_errors=True)
+            elif agora - self._ultima_atividade(envio) > self.retencao:
+                self.cancelar(envio)
+
+    # --- Protocolo ---
+
+    def iniciar(self, utilizador_id, entrada_id, nome_ficheiro, tamanho):
+        """Abre um envio e retorna o seu estado; o ficheiro é criado já com `tamanho` bytes."""
+        if tamanho < 1:
+            raise ErroEnvio('O ficheiro está vazio.')
+        if tamanho > self.tamanho_maximo:
+            raise TamanhoExcedido(f'O ficheiro excede o tamanho máximo de {self.tamanho_maximo // (1024 * 1024)} MB.')
+        self.limpar()
+        envio = {
+            'id': secrets.token_hex(16),
+            'utilizador_id': utilizador_id,
+            'entrada_id': entrada_id,
+            'nome_ficheiro': nome_ficheiro,
+            'tamanho': tamanho,
+            'criado_em': time.time(),
+        }
+        pasta = self._pasta_envio(envio['id'])
+        os.makedirs(os.path.join(pasta, 'blocos'))
+        with open(os.path.join(pasta, 'dados'), 'wb') as ficheiro:
+            ficheiro.truncate(tamanho)
+        # O envio.json é o último a ser criado: enquanto não existe, o envio não é visível
+        temporario = os.path.join(pasta, 'envio.json.tmp')
+        with open(temporario, 'w', encoding='utf-8') as ficheiro:
+            json.dump(envio, ficheiro)
+        os.replace(temporario, os.path.join(pasta, 'envio.json'))
+        return envio
+
+    def gravar_bloco(self, envio, inicio, stream, comprimento):
+        """Escreve `comprimento` bytes lidos de `stream` a partir da posição `inicio` do ficheiro."""
+        if comprimento is None or comprimento < 1:
+            raise ErroEnvio('O bloco está vazio ou não indica o tamanho (Content-Length).')
+        if comprimento > self.bloco_maximo:
+            raise TamanhoExcedido(f'O bloco excede o tamanho máximo de {self.bloco_maximo} bytes.')
+        if inicio < 0 or inicio + comprimento > envio['tamanho']:
+            raise ErroEnvio('O bloco está fora do ficheiro.')
+
+        recebidos = 0
+        try:
+            ficheiro = open(self.caminho_dados(envio), 'r+b')
+        except FileNotFoundError:
+            raise ErroEnvio('O envio já foi concluído ou cancelado.')
+        with ficheiro:
+            ficheiro.seek(inicio)
+            while recebidos < comprimento:
+                dados = stream.read(min(BLOCO_LEITURA, comprimento - recebidos))
+                if not dados:
+                    break
+                ficheiro.write(dados)
+                recebidos += len(dados)
+        if recebidos != comprimento:
+            # Ligação cortada a meio do bloco: não fica registado e volta a ser pedido
+            raise ErroEnvio('O bloco chegou incompleto.')
+        try:
+            open(os.path.join(self._pasta_envio(envio['id']), 'blocos', f'{inicio}-{comprimento}'), 'wb').close()
+        except FileNotFoundError:
+            raise ErroEnvio('O envio já foi concluído ou cancelado.')
+
+    def recebidos(self, envio):
+        """Intervalos [início, fim) já recebidos, ordenados e sem sobreposições."""
+        blocos = []
+        for nome in os.listdir(os.path.join(self._pasta_envio(envio['id']), 'blocos')):
+            inicio, comprimento = (int(parte) for parte in nome.split('-'))
+            blocos.append((inicio, inicio + comprimento))
+        intervalos = []
+        for inicio, fim in sorted(blocos):
+            if intervalos and inicio <= intervalos[-1][1]:
+                intervalos[-1][1] = max(intervalos[-1][1], fim)
+            else:
+                intervalos.append([inicio, fim])
+        return intervalos
+
+    def progresso(self, envio):
+        """Bytes recebidos e intervalos [início, fim) que ainda faltam."""
+        em_falta = []
+        posicao = 0
+        recebido = 0
+        for inicio, fim in self.recebidos(envio):
+            if inicio > posicao:
+                em_falta.append([posicao, inicio])
+            recebido += fim - inicio
+            posicao = fim
+        if posicao < envio['tamanho']:
+            em_falta.append([posicao, envio['tamanho']])
+        return recebido, em_falta
+
+    def concluir(self, envio, hash_esperado):
+        """Confirma que o ficheiro está completo e que o SHA-256 coincide; retorna (caminho, sha256).
+
+        Sem `hash_esperado` (navegadores sem crypto.subtle, fora de HTTPS) só é verificado que
+        todos os bytes chegaram. O ficheiro continua na pasta do envio: quem o guarda move-o e
+        chama cancelar() no fim.
+
+        Só uma conclusão de cada envio passa: o ficheiro é renomeado antes de ser lido, e um
+        segundo pedido (duplo clique, nova tentativa) recebe ErroEnvio em vez de anexar o
+        ficheiro outra vez.
+        """
+        try:
+            _, em_falta = self.progresso(envio)
+            if em_falta:
+                raise ErroEnvio('Ainda faltam blocos do ficheiro.')
+            caminho = os.path.join(self._pasta_envio(envio['id']), 'concluido')
+            os.rename(self.caminho_dados(envio), caminho)
+        except FileNotFoundError:
+            raise ErroEnvio('O envio já foi concluído ou cancelado.')
+        resumo = hashlib.sha256()
+        with open(caminho, 'rb') as ficheiro:
+            for bloco in iter(lambda: ficheiro.read(BLOCO_LEITURA), b''):
+                resumo.update(bloco)
+        if hash_esperado and resumo.hexdigest() != hash_esperado.lower():
+            self.cancelar(envio)
+            raise HashDiferente('O SHA-256 do ficheiro recebido não coincide com o enviado.')
+        return caminho, resumo.hexdigest()
+
+    def cancelar(self, envio):
+        shutil.rmtree(self._pasta_envio(envio['id']), ignore_errors=True)
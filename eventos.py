@@ -0,0 +1,206 @@
+# eventos.py
+"""Broker de eventos (publicação/assinatura) usado para enviar alterações ao painel em tempo real.
+
+Três backends, escolhidos por configuração em app.py:
+
+- BrokerLocal: entrega apenas aos assinantes do próprio processo (desenvolvimento, um único worker).
+- BrokerSondagem: além da entrega local, uma thread por processo consulta a versão persistente
+  no banco e publica quando ela muda; funciona entre workers com qualquer banco (inclusive SQLite).
+- BrokerPostgres: a notificação viaja dentro da transação (pg_notify) e uma thread por processo
+  faz LISTEN numa ligação dedicada, entregando o evento a todos os workers assim que há commit.
+"""
+import json
+import logging
+import queue
+import select
+import threading
+import time
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+class Assinatura:
+    """Fila de eventos de um assinante (uma ligação SSE)."""
+
+    def __init__(self, broker, tamanho_maximo=50):
+        self._broker = broker
+        self.fila = queue.Queue(maxsize=tamanho_maximo)
+
+    def obter(self, timeout=None):
+        """Aguarda o próximo evento; retorna None se o tempo esgotar."""
+        try:
+            return self.fila.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def entregar(self, evento):
+        # Um assinante lento não bloqueia os outros: descarta o evento mais antigo
+        try:
+            self.fila.put_nowait(evento)
+        except queue.Full:
+            try:
+                self.fila.get_nowait()
+            except queue.Empty:
+                pass
+            self.fila.put_nowait(evento)
+
+    def cancelar(self):
+        self._broker.cancelar(self)
+
+
+class BrokerLocal:
+    """Broker em memória, limitado ao processo atual."""
+
+    def __init__(self):
+        self._assinaturas = set()
+        self._lock = threading.Lock()
+
+    def assinar(self):
+        assinatura = Assinatura(self)
+        with self._lock:
+            self._assinaturas.add(assinatura)
+        return assinatura
+
+    def cancelar(self, assinatura):
+        with self._lock:
+            self._assinaturas.discard(assinatura)
+
+    def total_assinantes(self):
+        with self._lock:
+            return len(self._assinaturas)
+
+    def notificar(self, conexao, evento):
+        """Chamado dentro da transação de escrita; o backend local não precisa fazer nada aqui."""
+
+    def publicar(self, evento):
+        """Chamado depois do commit da transação de escrita."""
+        self._entregar(evento)
+
+    def _entregar(self, evento):
+        with self._lock:
+            assinaturas = list(self._assinaturas)
+        for assinatura in assinaturas:
+            assinatura.entregar(evento)
+
+
+class BrokerSondagem(BrokerLocal):
+    """Broker entre processos baseado na versão persistente guardada no banco.
+
+    `ler_versao` é uma função sem argumentos que retorna a versão atual. A thread de
+    sondagem só existe enquanto houver assinantes neste processo.
+    """
+
+    def __init__(self, ler_versao, intervalo=2.0):
+        super().__init__()
+        self._ler_versao = ler_versao
+        self._intervalo = intervalo
+        self._ultima_versao = None
+        self._thread = None
+
+    def assinar(self):
+        assinatura = super().assinar()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._executar, name='broker-sondagem', daemon=True)
+                self._thread.start()
+        return assinatura
+
+    def publicar(self, evento):
+        self._ultima_versao = evento.get('versao', self._ultima_versao)
+        super().publicar(evento)
+
+    def _executar(self):
+        while True:
+            with self._lock:
+                if not self._assinaturas:
+                    self._thread = None
+                    return
+            try:
+                versao = self._ler_versao()
+                if self._ultima_versao is None:
+                    self._ultima_versao = versao
+                elif versao != self._ultima_versao:
+                    self._ultima_versao = versao
+                    self._entregar({'versao': versao})
+            except Exception:
+                logger.exception('Falha ao consultar a versão do painel')
+            time.sleep(self._intervalo)
+
+
+class BrokerPostgres(BrokerLocal):
+    """Broker entre processos com LISTEN/NOTIFY do PostgreSQL.
+
+    O LISTEN exige uma ligação de sessão: se DATABASE_URL aponta para o pooler em modo
+    transação (pgbouncer), configure `dsn` com a ligação direta.
+    """
+
+    def __init__(self, dsn, canal='painel_eventos'):
+        if not dsn or not dsn.startswith(('postgres://', 'postgresql://', 'postgresql+psycopg2://')):
+            raise ValueError(
+                'PAINEL_PUSH_BACKEND=postgres exige uma ligação PostgreSQL em PAINEL_PUSH_DSN '
+                '(ou DATABASE_URL); use o backend "sondagem" com outros bancos.'
+            )
+        super().__init__()
+        self._dsn = dsn.replace('postgresql+psycopg2://', 'postgresql://', 1)
+        self._canal = canal
+        self._thread = None
+
+    def assinar(self):
+        assinatura = super().assinar()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._escutar, name='broker-postgres', daemon=True)
+                self._thread.start()
+        return assinatura
+
+    def notificar(self, conexao, evento):
+        # Entregue pelo PostgreSQL apenas se (e quando) a transação fizer commit
+        conexao.execute(text('SELECT pg_notify(:canal, :dados)'), {'canal': self._canal, 'dados': json.dumps(evento)})
+
+    def publicar(self, evento):
+        # A entrega chega a todos os processos, incluindo este, pelo LISTEN
+        pass
+
+    def _escutar(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        while True:
+            conexao = None
+            try:
+                conexao = psycopg2.connect(self._dsn)
+                conexao.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conexao.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self._canal}')
+                while True:
+                    if select.select([conexao], [], [], 30) == ([], [], []):
+                        continue
+                    conexao.poll()
+                    while conexao.notifies:
+                        notificacao = conexao.notifies.pop(0)
+                        try:
+                            self._entregar(json.loads(notificacao.payload))
+                        except ValueError:
+                            logger.warning('Notificação inválida ignorada: %r', notificacao.payload)
+            except Exception:
+                logger.exception('Ligação LISTEN perdida; nova tentativa em 5s')
+                time.sleep(5)
+            finally:
+                if conexao is not None:
+                    try:
+                        conexao.close()
+                    except Exception:
+                        pass
+
+
+def criar_broker(backend, ler_versao=None, dsn=None, intervalo=2.0):
+    """Cria o broker correspondente ao nome configurado ('local', 'sondagem' ou 'postgres')."""
+    if backend == 'local':
+        return BrokerLocal()
+    if backend == 'sondagem':
+        return BrokerSondagem(ler_versao, intervalo=intervalo)
+    if backend == 'postgres':
+        return BrokerPostgres(dsn)
+    raise ValueError(f'Backend de eventos desconhecido: {backend}')
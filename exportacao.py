@@ -0,0 +1,184 @@
+# exportacao.py
+"""Exportação em fluxo (XLSX e CSV) com memória constante.
+
+As linhas são lidas do banco em lotes por um cursor do lado do servidor (ler_em_lotes) e
+convertidas em bytes à medida que chegam, por isso o primeiro bloco sai logo e a memória
+usada não depende do número de linhas.
+
+O XLSX é escrito diretamente como SpreadsheetML dentro de um ZIP em fluxo (com data
+descriptors, sem voltar atrás no ficheiro): o modo write-only do openpyxl também tem memória
+constante, mas só produz o ficheiro depois da última linha, o que atrasaria o primeiro byte
+até ao fim da consulta. Os ficheiros gerados abrem no Excel, no LibreOffice e no openpyxl.
+"""
+import csv
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+# Linhas lidas do banco por ida ao servidor
+LOTE = 1000
+# Tamanho aproximado de cada bloco enviado ao cliente
+BLOCO = 64 * 1024
+
+MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    # O Flask/Werkzeug acrescenta "; charset=utf-8" aos tipos text/*
+    'csv': 'text/csv',
+}
+
+# Caracteres de controlo que o XML 1.0 não aceita (o openpyxl recusa-os com IllegalCharacterError)
+_CARACTERES_ILEGAIS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def ler_em_lotes(engine, consulta, tamanho=LOTE):
+    """Percorre o resultado da consulta numa ligação própria, `tamanho` linhas de cada vez.
+
+    No PostgreSQL usa um cursor nomeado (stream_results); a ligação é devolvida ao pool
+    quando o gerador termina ou é fechado.
+    """
+    with engine.connect() as conexao:
+        resultado = conexao.execution_options(yield_per=tamanho).execute(consulta)
+        for lote in resultado.partitions():
+            yield from lote
+
+
+class _Buffer:
+    """Destino de escrita que acumula bytes até serem recolhidos (não permite seek)."""
+
+    def __init__(self):
+        self._partes = []
+        self.tamanho = 0
+
+    def write(self, dados):
+        self._partes.append(bytes(dados))
+        self.tamanho += len(dados)
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def recolher(self):
+        dados = b''.join(self._partes)
+        self._partes = []
+        self.tamanho = 0
+        return dados
+
+
+def gerar_csv(cabecalhos, linhas):
+    """Gera o CSV em blocos de bytes (UTF-8 com BOM e ';' como separador, como o Excel em português espera)."""
+    texto = io.StringIO()
+    escritor = csv.writer(texto, delimiter=';')
+    texto.write('\ufeff')
+    escritor.writerow(cabecalhos)
+    for linha in linhas:
+        escritor.writerow(['' if valor is None else valor for valor in linha])
+        if texto.tell() >= BLOCO:
+            yield texto.getvalue().encode('utf-8')
+            texto.seek(0)
+            texto.truncate()
+    yield texto.getvalue().encode('utf-8')
+
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{titulo}" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '</Relationships>'
+)
+# Estilo 0: normal; estilo 1: negrito (cabeçalho)
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+
+def _celula(valor, estilo):
+    atributo_estilo = f' s="{estilo}"' if estilo else ''
+    if isinstance(valor, bool):
+        return f'<c t="b"{atributo_estilo}><v>{int(valor)}</v></c>'
+    if isinstance(valor, (int, float)):
+        return f'<c{atributo_estilo}><v>{valor}</v></c>'
+    texto = escape(_CARACTERES_ILEGAIS.sub('', str(valor)))
+    return f'<c t="inlineStr"{atributo_estilo}><is><t xml:space="preserve">{texto}</t></is></c>'
+
+
+def _linha_xml(numero, valores, estilo=0):
+    # Células vazias (None) ocupam a posição sem conteúdo, para manter o alinhamento das colunas
+    celulas = ''.join('<c/>' if valor is None else _celula(valor, estilo) for valor in valores)
+    return f'<row r="{numero}">{celulas}</row>'
+
+
+def gerar_xlsx(titulo, cabecalhos, linhas):
+    """Gera um .xlsx de uma folha em blocos de bytes; a primeira linha (cabeçalhos) fica a negrito."""
+    destino = _Buffer()
+    with zipfile.ZipFile(destino, 'w', compression=zipfile.ZIP_DEFLATED) as arquivo:
+        arquivo.writestr('[Content_Types].xml', _CONTENT_TYPES)
+        arquivo.writestr('_rels/.rels', _RELS)
+        arquivo.writestr('xl/workbook.xml', _WORKBOOK.format(titulo=escape(titulo[:31], {'"': '&quot;'})))
+        arquivo.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS)
+        arquivo.writestr('xl/styles.xml', _STYLES)
+        yield destino.recolher()
+
+        with arquivo.open('xl/worksheets/sheet1.xml', 'w') as folha:
+            folha.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            folha.write(_linha_xml(1, cabecalhos, estilo=1).encode('utf-8'))
+            for numero, linha in enumerate(linhas, start=2):
+                folha.write(_linha_xml(numero, linha).encode('utf-8'))
+                if destino.tamanho >= BLOCO:
+                    yield destino.recolher()
+            folha.write(b'</sheetData></worksheet>')
+    yield destino.recolher()
+
+
+def gerar_exportacao(formato, titulo, cabecalhos, linhas):
+    """Gerador de blocos no formato pedido ('xlsx' ou 'csv')."""
+    if formato == 'csv':
+        return gerar_csv(cabecalhos, linhas)
+    return gerar_xlsx(titulo, cabecalhos, linhas)
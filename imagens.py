@@ -0,0 +1,265 @@
+# imagens.py
+"""Versões reduzidas (derivados) das imagens e PDFs anexados.
+
+Os anexos ficam guardados tal como foram enviados (fotos de telemóvel com vários MB); para
+mostrar e imprimir usam-se cópias em JPEG com o lado maior limitado a cada tamanho de
+TAMANHOS, guardadas em <pasta de uploads>/derivados/<tamanho>/<ficheiro>.jpg.
+
+As imagens são abertas pelo PyMuPDF como documento de uma página, o que aplica a orientação
+EXIF (fotos tiradas ao alto ficam ao alto) e descodifica o JPEG já reduzido quando a escala é
+pequena. Transparências ficam sobre fundo branco. Imagens menores do que o tamanho pedido não
+são ampliadas.
+
+Os derivados são gerados quando o anexo é enviado e, para anexos anteriores ou ficheiros
+substituídos, no primeiro pedido de cada tamanho; um derivado mais antigo do que o original é
+gerado de novo.
+
+Os PDFs (desenhos, orçamentos) têm as páginas rasterizadas em PNG, para serem mostrados e
+colocados no relatório como imagens sem o navegador descarregar o documento inteiro. Cada
+página é guardada em derivados/paginas/<sha256 do PDF>/<página>_<resolução>.png: a chave
+muda com o conteúdo do ficheiro, por isso o que está guardado nunca fica desatualizado. Nos
+tamanhos de TAMANHOS um PDF dá a sua primeira página, com o lado maior nesse tamanho.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import threading
+
+import fitz
+
+logger = logging.getLogger(__name__)
+
+# tamanho -> (lado maior em pixels, qualidade JPEG)
+TAMANHOS = {
+    'miniatura': (320, 80),
+    'previa': (1280, 85),
+    # A4 a 300 dpi tem 2480 x 3508 pixels
+    'impressao': (2480, 90),
+}
+
+EXTENSOES_IMAGEM = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp'}
+
+# Resoluções aceites para as páginas de PDF (o pedido é arredondado para a mais próxima)
+RESOLUCOES_PDF = (36, 72, 96, 150, 200, 300)
+RESOLUCAO_PDF_PADRAO = 96
+# Limite do lado maior de uma página rasterizada (plantas em A0 a 300 dpi teriam 14000 pixels)
+LADO_MAXIMO_PAGINA = 5000
+
+
+def e_imagem(nome_ficheiro):
+    return os.path.splitext(nome_ficheiro)[1].lower() in EXTENSOES_IMAGEM
+
+
+def e_pdf(nome_ficheiro):
+    return os.path.splitext(nome_ficheiro)[1].lower() == '.pdf'
+
+
+def caminho_derivado(pasta, tamanho, nome_ficheiro):
+    return os.path.join(pasta, 'derivados', tamanho, nome_ficheiro + '.jpg')
+
+
+def _gerar(origem, alvos):
+    """Gera os derivados `alvos` [(destino, lado maior, qualidade)] descodificando o original uma vez."""
+    alvos = sorted(alvos, key=lambda alvo: alvo[1], reverse=True)
+    with fitz.open(origem) as documento:
+        pagina = documento[0]
+        info = pagina.get_image_info()
+        # Tamanho original em pixels (a página está em pontos, conforme a resolução da imagem)
+        lado_pagina = max(pagina.rect.width, pagina.rect.height)
+        lado_original = max(info[0]['width'], info[0]['height']) if info else lado_pagina
+        escala = min(alvos[0][1], lado_original) / lado_pagina
+        base = pagina.get_pixmap(matrix=fitz.Matrix(escala, escala), alpha=False)
+
+    for destino, lado_maximo, qualidade in alvos:
+        pixmap = base
+        fator = lado_maximo / max(base.width, base.height)
+        if fator < 1:
+            pixmap = fitz.Pixmap(base, max(round(base.width * fator), 1), max(round(base.height * fator), 1), None)
+        _gravar(pixmap, destino, output='jpg', jpg_quality=qualidade)
+
+
+def _gravar(pixmap, destino, **opcoes):
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    # Nome temporário próprio da thread: dois pedidos podem gerar o mesmo derivado ao mesmo tempo
+    temporario = f'{destino}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        pixmap.save(temporario, **opcoes)
+        os.replace(temporario, destino)
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+
+def _desatualizado(origem, destino):
+    try:
+        return os.path.getmtime(destino) < os.path.getmtime(origem)
+    except OSError:
+        return True
+
+
+def obter_derivado(pasta, tamanho, nome_ficheiro):
+    """Caminho do derivado atualizado (gerando-o se preciso) ou None se não houver derivado.
+
+    Retorna None se o ficheiro não for uma imagem, não existir ou não puder ser lido; nesse
+    caso deve servir-se o original.
+    """
+    if tamanho not in TAMANHOS:
+        return None
+    if e_pdf(nome_ficheiro):
+        return obter_pagina_pdf(pasta, nome_ficheiro, 1, tamanho=tamanho)
+    if not e_imagem(nome_ficheiro):
+        return None
+    origem = os.path.join(pasta, nome_ficheiro)
+    if not os.path.isfile(origem):
+        return None
+    destino = caminho_derivado(pasta, tamanho, nome_ficheiro)
+    if _desatualizado(origem, destino):
+        try:
+            _gerar(origem, [(destino, *TAMANHOS[tamanho])])
+        except Exception:
+            logger.exception('Não foi possível gerar o derivado %s de %s', tamanho, nome_ficheiro)
+            return None
+    return destino
+
+
+def imagem_para_impressao(origem, largura, altura, dpi, qualidade=85):
+    """JPEG da imagem reduzida para caber em largura x altura pontos a `dpi` (sem ampliar)."""
+    with fitz.open(origem) as documento:
+        pagina = documento[0]
+        info = pagina.get_image_info()
+        escala = min(largura / pagina.rect.width, altura / pagina.rect.height) * dpi / 72
+        if info:
+            # Não passa da resolução do original
+            escala = min(escala, max(info[0]['width'], info[0]['height']) / max(pagina.rect.width, pagina.rect.height))
+        pixmap = pagina.get_pixmap(matrix=fitz.Matrix(escala, escala), alpha=False)
+    return pixmap.tobytes(output='jpg', jpg_quality=qualidade)
+
+
+def gerar_derivados(pasta, nome_ficheiro):
+    """Gera todos os tamanhos de um anexo acabado de gravar (imagem ou primeira página de um PDF).
+
+    Um ficheiro que não se consegue ler não impede a gravação do anexo: fica registado no log e
+    é servido no original.
+    """
+    if e_pdf(nome_ficheiro):
+        for tamanho in TAMANHOS:
+            obter_pagina_pdf(pasta, nome_ficheiro, 1, tamanho=tamanho)
+        return
+    if not e_imagem(nome_ficheiro):
+        return
+    origem = os.path.join(pasta, nome_ficheiro)
+    try:
+        _gerar(origem, [(caminho_derivado(pasta, tamanho, nome_ficheiro), lado, qualidade)
+                        for tamanho, (lado, qualidade) in TAMANHOS.items()])
+    except Exception:
+        logger.exception('Não foi possível gerar os derivados de %s', nome_ficheiro)
+
+
+def remover_derivados(pasta, nome_ficheiro):
+    """Apaga os derivados de um anexo; chamar antes de apagar o original (os PDFs usam o seu hash)."""
+    if e_pdf(nome_ficheiro):
+        origem = os.path.join(pasta, nome_ficheiro)
+        if os.path.isfile(origem):
+            shutil.rmtree(os.path.join(pasta, 'derivados', 'paginas', hash_ficheiro(origem)), ignore_errors=True)
+        return
+    for tamanho in TAMANHOS:
+        try:
+            os.remove(caminho_derivado(pasta, tamanho, nome_ficheiro))
+        except FileNotFoundError:
+            pass
+
+
+# --- Páginas de PDF ---
+
+_hashes = {}
+_paginas = {}
+_cache_lock = threading.Lock()
+# Entradas guardadas em memória em cada cache antes de ser esvaziada
+MAXIMO_CACHE = 2000
+
+
+def hash_ficheiro(caminho):
+    """SHA-256 do ficheiro, guardado em memória enquanto o tamanho e a data de alteração não mudarem."""
+    estado = os.stat(caminho)
+    assinatura = (estado.st_mtime_ns, estado.st_size)
+    with _cache_lock:
+        guardado = _hashes.get(caminho)
+    if guardado is not None and guardado[0] == assinatura:
+        return guardado[1]
+    resumo = hashlib.sha256()
+    with open(caminho, 'rb') as ficheiro:
+        for bloco in iter(lambda: ficheiro.read(1024 * 1024), b''):
+            resumo.update(bloco)
+    with _cache_lock:
+        if len(_hashes) >= MAXIMO_CACHE:
+            _hashes.clear()
+        _hashes[caminho] = (assinatura, resumo.hexdigest())
+    return resumo.hexdigest()
+
+
+def resolucao_pdf(dpi):
+    """Resolução aceite mais próxima da pedida (limita as variantes guardadas de cada página)."""
+    return min(RESOLUCOES_PDF, key=lambda resolucao: abs(resolucao - dpi))
+
+
+def total_paginas_pdf(pasta, nome_ficheiro):
+    """Número de páginas do PDF anexado, ou None se não for um PDF legível."""
+    origem = os.path.join(pasta, nome_ficheiro)
+    if not e_pdf(nome_ficheiro) or not os.path.isfile(origem):
+        return None
+    chave = hash_ficheiro(origem)
+    with _cache_lock:
+        total = _paginas.get(chave)
+    if total is None:
+        try:
+            with fitz.open(origem) as documento:
+                total = documento.page_count
+        except Exception:
+            logger.exception('Não foi possível abrir o PDF %s', nome_ficheiro)
+            return None
+        with _cache_lock:
+            if len(_paginas) >= MAXIMO_CACHE:
+                _paginas.clear()
+            _paginas[chave] = total
+    return total
+
+
+def _rasterizar(origem, destino, pagina, dpi=None, lado_maximo=None):
+    with fitz.open(origem) as documento:
+        if not 1 <= pagina <= documento.page_count:
+            raise IndexError(pagina)
+        pagina_pdf = documento[pagina - 1]
+        lado_pagina = max(pagina_pdf.rect.width, pagina_pdf.rect.height)
+        # Escala de pontos (1/72 polegada) para pixels
+        escala = dpi / 72 if dpi else min(lado_maximo / lado_pagina, max(RESOLUCOES_PDF) / 72)
+        escala = min(escala, LADO_MAXIMO_PAGINA / lado_pagina)
+        pixmap = pagina_pdf.get_pixmap(matrix=fitz.Matrix(escala, escala), alpha=False)
+    _gravar(pixmap, destino, output='png')
+
+
+def obter_pagina_pdf(pasta, nome_ficheiro, pagina, dpi=RESOLUCAO_PDF_PADRAO, tamanho=None):
+    """Caminho do PNG da página (1 = primeira) do PDF anexado, gerando-o se preciso.
+
+    Com `tamanho` (chave de TAMANHOS) a página fica com o lado maior nesse tamanho; caso
+    contrário é rasterizada a `dpi`, arredondado para RESOLUCOES_PDF. Retorna None se o
+    ficheiro não for um PDF legível ou a página não existir.
+    """
+    origem = os.path.join(pasta, nome_ficheiro)
+    if not e_pdf(nome_ficheiro) or not os.path.isfile(origem):
+        return None
+    if tamanho is not None:
+        resolucao, lado_maximo, dpi = tamanho, TAMANHOS[tamanho][0], None
+    else:
+        dpi = resolucao_pdf(dpi)
+        resolucao, lado_maximo = f'{dpi}dpi', None
+    destino = os.path.join(pasta, 'derivados', 'paginas', hash_ficheiro(origem), f'{pagina}_{resolucao}.png')
+    if not os.path.exists(destino):
+        try:
+            _rasterizar(origem, destino, pagina, dpi=dpi, lado_maximo=lado_maximo)
+        except IndexError:
+            return None
+        except Exception:
+            logger.exception('Não foi possível rasterizar a página %s de %s', pagina, nome_ficheiro)
+            return None
+    return destino
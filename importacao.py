@@ -0,0 +1,104 @@
+# importacao.py
+"""Leitura de planilhas de importação e relatório linha a linha do resultado.
+
+A planilha é lida em modo read-only do openpyxl, que percorre as linhas sem carregar o
+ficheiro inteiro em memória. As regras de cada importação (clientes, entradas) ficam em
+app.py; aqui ficam as partes comuns: leitura, conversão das células e relatório.
+"""
+from collections import Counter
+from datetime import date, datetime
+
+ADICIONADA, IGNORADA, INVALIDA = 'adicionada', 'ignorada', 'invalida'
+
+# Linhas com problema mostradas no relatório; as restantes entram apenas nas contagens
+MAXIMO_LINHAS_RELATORIO = 1000
+
+
+def ler_planilha(ficheiro, colunas, primeira_linha=2):
+    """Percorre a folha ativa e produz (número da linha, valores) das linhas não vazias.
+
+    Cada tupla de valores tem exatamente `colunas` posições (completada com None).
+    """
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(ficheiro, read_only=True, data_only=True)
+    try:
+        for numero, linha in enumerate(workbook.active.iter_rows(min_row=primeira_linha, values_only=True),
+                                       start=primeira_linha):
+            if not linha or all(celula is None or celula == '' for celula in linha):
+                continue
+            yield numero, (tuple(linha) + (None,) * colunas)[:colunas]
+    finally:
+        workbook.close()
+
+
+def texto_celula(valor):
+    """Converte o valor de uma célula em texto sem espaços nas pontas (None se vazio).
+
+    Números inteiros gravados como decimais pelo Excel (CPF, CEP, telefone) perdem o '.0'.
+    """
+    if valor is None:
+        return None
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    elif isinstance(valor, datetime):
+        valor = valor.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(valor, date):
+        valor = valor.isoformat()
+    texto = str(valor).strip()
+    return texto or None
+
+
+class RelatorioImportacao:
+    """Resultado de cada linha da planilha: adicionada, ignorada ou inválida."""
+
+    def __init__(self, simulacao=False):
+        self.simulacao = simulacao
+        self.contagem = Counter()
+        # Todas as linhas com problema ou aviso (para o ficheiro do relatório) e as mostradas na página
+        self.todos_problemas = []
+        self.problemas = []
+
+    def registrar(self, linha, resultado, descricao=None, motivo=None):
+        """Regista o resultado da linha; uma linha adicionada com `motivo` conta como aviso."""
+        self.contagem[resultado] += 1
+        if resultado == ADICIONADA and not motivo:
+            return
+        if resultado == ADICIONADA:
+            self.contagem['avisos'] += 1
+        problema = {'linha': linha, 'resultado': resultado, 'descricao': descricao, 'motivo': motivo}
+        self.todos_problemas.append(problema)
+        if len(self.problemas) < MAXIMO_LINHAS_RELATORIO:
+            self.problemas.append(problema)
+
+    @property
+    def adicionadas(self):
+        return self.contagem[ADICIONADA]
+
+    @property
+    def ignoradas(self):
+        return self.contagem[IGNORADA]
+
+    @property
+    def invalidas(self):
+        return self.contagem[INVALIDA]
+
+    @property
+    def avisos(self):
+        return self.contagem['avisos']
+
+    @property
+    def problemas_omitidos(self):
+        return len(self.todos_problemas) - len(self.problemas)
+
+    def mensagem(self, entidade):
+        """Resumo para o flash, ex.: mensagem('cliente(s)')."""
+        verbo = 'seriam importado(s)' if self.simulacao else 'importado(s) com sucesso'
+        mensagem = f'{self.adicionadas} {entidade} {verbo}.'
+        if self.ignoradas:
+            mensagem += f' {self.ignoradas} ignorado(s).'
+        if self.invalidas:
+            mensagem += f' {self.invalidas} linha(s) inválida(s).'
+        if self.avisos:
+            mensagem += f' {self.avisos} com aviso(s).'
+        return mensagem
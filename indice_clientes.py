@@ -0,0 +1,183 @@
+# indice_clientes.py
+"""Índice em memória dos clientes para o autocomplete de /buscar-clientes.
+
+Cada worker mantém os nomes (minúsculas e sem acentos) e os números dos clientes, com
+listas ordenadas para buscas por prefixo e listas invertidas de n-gramas (1 a 3 caracteres)
+para buscas por substring, de modo que cada tecla é respondida sem ir ao banco.
+
+O índice é construído na primeira busca e mantido assim:
+
+- as alterações feitas por este worker são aplicadas uma a uma depois do commit (aplicar());
+- as feitas por outros workers são detectadas pela versão persistente dos clientes, lida no
+  máximo a cada `intervalo` segundos; se ela avançou além do que este worker aplicou, o índice
+  é descartado e reconstruído na busca seguinte.
+"""
+import bisect
+import threading
+import time
+
+from busca import normalizar
+
+# Tamanho máximo dos n-gramas indexados; termos maiores são filtrados pelos trigramas e confirmados no texto
+TAMANHO_NGRAMA = 3
+
+
+def _ngramas(texto):
+    return {
+        texto[inicio:inicio + tamanho]
+        for tamanho in range(1, TAMANHO_NGRAMA + 1)
+        for inicio in range(len(texto) - tamanho + 1)
+    }
+
+
+class _Estrutura:
+    """Dados de uma versão do índice; substituída por inteiro quando há reconstrução."""
+
+    def __init__(self, clientes, versao):
+        self.versao = versao
+        self.clientes = {}          # id -> (nome, numero_cliente, nome normalizado)
+        self.nomes = []             # [(nome normalizado, id)] ordenada, para prefixos
+        self.numeros = []           # [(str(numero_cliente), id)] ordenada, para prefixos
+        self.ngramas = {}           # n-grama -> {ids}
+        for cliente_id, nome, numero in clientes:
+            self.incluir(cliente_id, nome, numero, ordenar=False)
+        self.nomes.sort()
+        self.numeros.sort()
+
+    def incluir(self, cliente_id, nome, numero, ordenar=True):
+        chave = normalizar(nome)
+        self.clientes[cliente_id] = (nome, numero, chave)
+        inserir = bisect.insort if ordenar else list.append
+        inserir(self.nomes, (chave, cliente_id))
+        inserir(self.numeros, (str(numero), cliente_id))
+        for ngrama in _ngramas(chave):
+            self.ngramas.setdefault(ngrama, set()).add(cliente_id)
+
+    def excluir(self, cliente_id):
+        registo = self.clientes.pop(cliente_id, None)
+        if registo is None:
+            return
+        _, numero, chave = registo
+        for lista, valor in ((self.nomes, chave), (self.numeros, str(numero))):
+            posicao = bisect.bisect_left(lista, (valor, cliente_id))
+            if posicao < len(lista) and lista[posicao] == (valor, cliente_id):
+                del lista[posicao]
+        for ngrama in _ngramas(chave):
+            ids = self.ngramas.get(ngrama)
+            if ids is not None:
+                ids.discard(cliente_id)
+                if not ids:
+                    del self.ngramas[ngrama]
+
+    def _por_prefixo(self, lista, prefixo):
+        inicio = bisect.bisect_left(lista, (prefixo,))
+        for posicao in range(inicio, len(lista)):
+            valor, cliente_id = lista[posicao]
+            if not valor.startswith(prefixo):
+                break
+            yield cliente_id
+
+    def _por_substring(self, termo):
+        if len(termo) <= TAMANHO_NGRAMA:
+            return self.ngramas.get(termo, set())
+        trigramas = sorted(
+            (self.ngramas.get(termo[inicio:inicio + TAMANHO_NGRAMA], set())
+             for inicio in range(len(termo) - TAMANHO_NGRAMA + 1)),
+            key=len
+        )
+        candidatos = set(trigramas[0]).intersection(*trigramas[1:])
+        return {cliente_id for cliente_id in candidatos if termo in self.clientes[cliente_id][2]}
+
+    def buscar(self, termo, limite):
+        """Ids por ordem: número exato, número por prefixo, nome por prefixo e nome por substring (alfabética)."""
+        if not termo:
+            return [cliente_id for _, cliente_id in self.nomes[:limite]]
+
+        resultado = []
+        vistos = set()
+
+        def adicionar(ids):
+            for cliente_id in ids:
+                if cliente_id not in vistos:
+                    vistos.add(cliente_id)
+                    resultado.append(cliente_id)
+                    if len(resultado) >= limite:
+                        return True
+            return False
+
+        if termo.isdigit():
+            numeros = list(self._por_prefixo(self.numeros, termo))
+            exatos = [cliente_id for cliente_id in numeros if str(self.clientes[cliente_id][1]) == termo]
+            if adicionar(exatos) or adicionar(numeros):
+                return resultado
+        if adicionar(self._por_prefixo(self.nomes, termo)):
+            return resultado
+        restantes = sorted(self._por_substring(termo) - vistos, key=lambda cliente_id: self.clientes[cliente_id][2])
+        adicionar(restantes)
+        return resultado
+
+
+class IndiceClientes:
+    """Índice de clientes do worker.
+
+    `carregar` é uma função sem argumentos que retorna (id, nome, numero_cliente) de todos os
+    clientes; `ler_versao` retorna a versão persistente dos clientes. Ambas são chamadas pela
+    aplicação dentro de um contexto de app.
+    """
+
+    def __init__(self, carregar, ler_versao, intervalo=5.0):
+        self._carregar = carregar
+        self._ler_versao = ler_versao
+        self._intervalo = intervalo
+        self._estrutura = None
+        self._verificado_em = 0.0
+        self._lock = threading.Lock()
+
+    def _atual(self):
+        agora = time.monotonic()
+        estrutura = self._estrutura
+        if estrutura is not None and agora - self._verificado_em < self._intervalo:
+            return estrutura
+
+        versao = self._ler_versao()
+        self._verificado_em = agora
+        if estrutura is not None and estrutura.versao == versao:
+            return estrutura
+
+        # Reconstrução fora do lock: as buscas concorrentes continuam com a estrutura anterior
+        nova = _Estrutura(self._carregar(), versao)
+        with self._lock:
+            if self._estrutura is None or self._estrutura.versao < versao:
+                self._estrutura = nova
+            return self._estrutura
+
+    def buscar(self, termo, limite=10):
+        """Retorna até `limite` tuplas (id, nome, numero_cliente) para o termo digitado."""
+        estrutura = self._atual()
+        with self._lock:
+            ids = estrutura.buscar(normalizar(termo.strip()), limite)
+            return [(cliente_id,) + estrutura.clientes[cliente_id][:2] for cliente_id in ids]
+
+    def aplicar(self, alteracoes, versao):
+        """Aplica as alterações de uma transação deste worker já confirmada.
+
+        `alteracoes` mapeia id -> (nome, numero_cliente), ou None para clientes excluídos;
+        `versao` é a versão dos clientes gravada por essa transação.
+        """
+        with self._lock:
+            estrutura = self._estrutura
+            if estrutura is None:
+                return
+            if versao != estrutura.versao + 1:
+                # Outro worker alterou os clientes entretanto: reconstrói na próxima busca
+                self._estrutura = None
+                return
+            for cliente_id, dados in alteracoes.items():
+                estrutura.excluir(cliente_id)
+                if dados is not None:
+                    estrutura.incluir(cliente_id, *dados)
+            estrutura.versao = versao
+
+    def invalidar(self):
+        with self._lock:
+            self._estrutura = None
@@ -1,5 +1,6 @@
 # init_db.py
 from app import app, db
+from migracoes import aplicar_migracoes
 
 print("Iniciando a criação do banco de dados...")
 
@@ -7,4 +8,7 @@ print("Iniciando a criação do banco de dados...")
 with app.app_context():
     db.create_all()
 
+    # Índices e estruturas de busca (migracoes.py); só aplica as migrações pendentes
+    aplicar_migracoes(db.engine)
+
 print("Banco de dados e tabelas criados com sucesso!")
\ No newline at end of file
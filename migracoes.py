@@ -0,0 +1,273 @@
+# migracoes.py
+"""Migrações versionadas do esquema e verificação dos planos das consultas mais usadas.
+
+Uso:
+    python migracoes.py              aplica as migrações pendentes
+    python migracoes.py estado       lista as migrações aplicadas e pendentes
+    python migracoes.py explicar     mostra o plano (EXPLAIN) das consultas das rotas principais
+    python migracoes.py explicar --analisar   no PostgreSQL, executa as consultas (EXPLAIN ANALYZE)
+
+As tabelas continuam a ser criadas por db.create_all() (init_db.py); as migrações tratam do
+que o create_all não faz ou não altera depois de criado: índices compostos e parciais,
+extensões e estruturas de busca. Cada migração é registada na tabela schema_migracao e só
+é executada uma vez. No PostgreSQL as migrações marcadas como não transacionais correm em
+autocommit, para que os índices sejam criados com CREATE INDEX CONCURRENTLY sem bloquear
+as escritas no painel.
+"""
+import argparse
+from datetime import datetime
+
+from sqlalchemy import func, inspect, select, text
+
+from app import (
+    app, db, indice_busca, Entrada, Anexo, TextoPersonalizado, Cliente, AlteracaoEntrada,
+    consulta_projecao_entradas, filtros_painel
+)
+
+TABELA_MIGRACOES = 'schema_migracao'
+# Chave do pg_advisory_lock que impede dois deploys de migrarem ao mesmo tempo
+TRAVA_MIGRACOES = 727001
+
+
+class Migracao:
+    def __init__(self, versao, nome, aplicar, transacional=True):
+        self.versao = versao
+        self.nome = nome
+        self.aplicar = aplicar
+        self.transacional = transacional
+
+
+MIGRACOES = []
+
+
+def migracao(versao, nome, transacional=True):
+    """Regista a função decorada como a migração `versao`."""
+    def registrar(funcao):
+        MIGRACOES.append(Migracao(versao, nome, funcao, transacional))
+        return funcao
+    return registrar
+
+
+# --- AUXILIARES DE ÍNDICES ---
+
+def _postgres(conexao):
+    return conexao.dialect.name == 'postgresql'
+
+
+def booleano(conexao, valor):
+    """Literal booleano usado nos predicados dos índices parciais.
+
+    Tem de ser escrito como o SQLAlchemy o escreve nas consultas (false no PostgreSQL,
+    0 no SQLite); caso contrário o SQLite não reconhece o índice parcial.
+    """
+    if _postgres(conexao):
+        return 'true' if valor else 'false'
+    return '1' if valor else '0'
+
+
+def criar_indice(conexao, nome, tabela, colunas, where=None):
+    """Cria o índice se ainda não existir; no PostgreSQL sem bloquear escritas (CONCURRENTLY)."""
+    predicado = f' WHERE {where}' if where else ''
+    if _postgres(conexao):
+        # Um CREATE INDEX CONCURRENTLY interrompido deixa um índice inválido com o mesmo nome
+        invalido = conexao.execute(
+            text('SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:nome)'), {'nome': nome}
+        ).scalar()
+        if invalido:
+            conexao.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {nome}'))
+        conexao.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {nome} ON {tabela} ({colunas}){predicado}'))
+    else:
+        conexao.execute(text(f'CREATE INDEX IF NOT EXISTS {nome} ON {tabela} ({colunas}){predicado}'))
+
+
+def adicionar_coluna(conexao, tabela, coluna, tipo):
+    """Acrescenta a coluna se ainda não existir (o create_all não altera tabelas já criadas)."""
+    if coluna not in {existente['name'] for existente in inspect(conexao).get_columns(tabela)}:
+        conexao.execute(text(f'ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}'))
+
+
+def remover_indice(conexao, nome):
+    if _postgres(conexao):
+        conexao.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {nome}'))
+    else:
+        conexao.execute(text(f'DROP INDEX IF EXISTS {nome}'))
+
+
+# --- MIGRAÇÕES ---
+# Nunca altere uma migração já publicada: para mudar um índice, acrescente uma nova que o
+# remova e o recrie. As migrações não transacionais têm de ser idempotentes (IF NOT EXISTS),
+# porque uma falha a meio não desfaz os passos anteriores.
+
+@migracao(1, 'Índice de busca textual das entradas', transacional=False)
+def _m0001_indice_busca(conexao):
+    indice_busca.preparar(conexao)
+
+
+@migracao(2, 'Índices das listagens do painel, arquivados e relações', transacional=False)
+def _m0002_indices_listagens(conexao):
+    falso, verdadeiro = booleano(conexao, False), booleano(conexao, True)
+    # Janelas do painel: WHERE arquivado = false AND tipo = ? ORDER BY numero_pedido
+    criar_indice(conexao, 'ix_entrada_ativas_tipo_numero', 'entrada', 'tipo, numero_pedido',
+                 where=f'arquivado = {falso}')
+    # Dashboard (GROUP BY tipo, status) e filtro de status do painel
+    criar_indice(conexao, 'ix_entrada_ativas_tipo_status', 'entrada', 'tipo, status',
+                 where=f'arquivado = {falso}')
+    # Arquivados: WHERE arquivado = true AND tipo = ? ORDER BY data_registro DESC, id DESC
+    criar_indice(conexao, 'ix_entrada_arquivadas_tipo_data', 'entrada', 'tipo, data_registro, id',
+                 where=f'arquivado = {verdadeiro}')
+    # Chaves estrangeiras: o PostgreSQL e o SQLite não as indexam automaticamente
+    criar_indice(conexao, 'ix_entrada_cliente_id', 'entrada', 'cliente_id')
+    criar_indice(conexao, 'ix_anexo_entrada_id', 'anexo', 'entrada_id')
+    criar_indice(conexao, 'ix_texto_personalizado_entrada_id', 'texto_personalizado', 'entrada_id')
+
+
+@migracao(3, 'Anexos guardados por conteúdo: nome original, hash e índice do ficheiro', transacional=False)
+def _m0003_anexos_por_conteudo(conexao):
+    adicionar_coluna(conexao, 'anexo', 'nome_original', 'VARCHAR(255)')
+    adicionar_coluna(conexao, 'anexo', 'hash_sha256', 'VARCHAR(64)')
+    # Contagem das referências de um ficheiro antes de o apagar e nome original no download
+    criar_indice(conexao, 'ix_anexo_filename', 'anexo', 'filename')
+
+
+@migracao(4, 'Versão do relatório de cada entrada (chave dos PDFs guardados)', transacional=False)
+def _m0004_versao_relatorio(conexao):
+    adicionar_coluna(conexao, 'entrada', 'versao_relatorio', 'INTEGER NOT NULL DEFAULT 0')
+
+
+# --- EXECUÇÃO ---
+
+def _garantir_tabela(engine):
+    with engine.begin() as conexao:
+        conexao.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {TABELA_MIGRACOES} ('
+            'versao INTEGER PRIMARY KEY, nome VARCHAR(200) NOT NULL, aplicada_em TIMESTAMP NOT NULL)'
+        ))
+
+
+def versoes_aplicadas(engine):
+    _garantir_tabela(engine)
+    with engine.connect() as conexao:
+        return set(conexao.execute(text(f'SELECT versao FROM {TABELA_MIGRACOES}')).scalars())
+
+
+def _registrar(conexao, item):
+    conexao.execute(
+        text(f'INSERT INTO {TABELA_MIGRACOES} (versao, nome, aplicada_em) VALUES (:versao, :nome, :agora)'),
+        {'versao': item.versao, 'nome': item.nome, 'agora': datetime.now()}
+    )
+
+
+def aplicar_migracoes(engine, saida=print):
+    """Aplica, por ordem de versão, as migrações ainda não registadas; retorna quantas aplicou."""
+    _garantir_tabela(engine)
+    trava = None
+    if engine.dialect.name == 'postgresql':
+        trava = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        trava.execute(text('SELECT pg_advisory_lock(:chave)'), {'chave': TRAVA_MIGRACOES})
+    try:
+        aplicadas = versoes_aplicadas(engine)
+        pendentes = sorted((m for m in MIGRACOES if m.versao not in aplicadas), key=lambda m: m.versao)
+        for item in pendentes:
+            saida(f'Aplicando migração {item.versao:04d}: {item.nome}...')
+            if item.transacional or engine.dialect.name != 'postgresql':
+                with engine.begin() as conexao:
+                    item.aplicar(conexao)
+                    _registrar(conexao, item)
+            else:
+                with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conexao:
+                    item.aplicar(conexao)
+                    _registrar(conexao, item)
+        return len(pendentes)
+    finally:
+        if trava is not None:
+            trava.execute(text('SELECT pg_advisory_unlock(:chave)'), {'chave': TRAVA_MIGRACOES})
+            trava.close()
+
+
+# --- PLANOS DAS CONSULTAS ---
+
+def consultas_criticas():
+    """(descrição, instrução) das consultas executadas pelas rotas mais usadas."""
+    janela = app.config['PAINEL_JANELA'] + 1
+    return [
+        ('Painel: primeira janela de pedidos',
+         consulta_projecao_entradas().where(Entrada.tipo == 'Pedido', *filtros_painel())
+         .order_by(Entrada.numero_pedido.asc()).limit(janela)),
+        ('Painel: janela seguinte filtrada por status',
+         consulta_projecao_entradas().where(
+             Entrada.tipo == 'Pedido', *filtros_painel(selected_status='Em andamento'), Entrada.numero_pedido > 1000
+         ).order_by(Entrada.numero_pedido.asc()).limit(janela)),
+        ('Painel: busca textual',
+         consulta_projecao_entradas().where(Entrada.tipo == 'Pedido', *filtros_painel(search_query='vidro'))
+         .order_by(Entrada.numero_pedido.asc()).limit(janela)),
+        ('Painel: sincronização incremental',
+         select(AlteracaoEntrada.entrada_id).where(AlteracaoEntrada.versao > 0).distinct()),
+        ('Dashboard: contadores por tipo e status',
+         select(Entrada.tipo, Entrada.status, func.count(Entrada.id))
+         .where(Entrada.arquivado == False, Entrada.tipo.in_(['Pedido', 'Orçamento']))
+         .group_by(Entrada.tipo, Entrada.status)),
+        ('Arquivados: primeira página de pedidos',
+         consulta_projecao_entradas(detalhado=True).where(Entrada.tipo == 'Pedido', Entrada.arquivado == True)
+         .order_by(Entrada.data_registro.desc(), Entrada.id.desc()).limit(30)),
+        ('Arquivados: total de pedidos',
+         select(func.count()).select_from(Entrada).where(Entrada.tipo == 'Pedido', Entrada.arquivado == True)),
+        ('Entradas ativas de um cliente',
+         select(Entrada.id).where(Entrada.cliente_id == 1, Entrada.arquivado == False)),
+        ('Anexos de uma entrada', select(Anexo).where(Anexo.entrada_id == 1)),
+        ('Textos personalizados de uma entrada', select(TextoPersonalizado).where(TextoPersonalizado.entrada_id == 1)),
+        ('Cadastro de clientes: primeira página', select(Cliente).order_by(Cliente.numero_cliente.asc()).limit(20)),
+    ]
+
+
+def _varredura_sequencial(conexao, linha):
+    """Indica se a linha do plano é uma leitura completa de uma tabela sem índice."""
+    if _postgres(conexao):
+        return 'Seq Scan on' in linha
+    return linha.startswith('SCAN ') and ' USING ' not in linha and 'VIRTUAL TABLE' not in linha
+
+
+def explicar(conexao, analisar=False, saida=print):
+    """Imprime o plano de cada consulta crítica; retorna o número de varreduras sequenciais."""
+    varreduras = 0
+    for descricao, consulta in consultas_criticas():
+        sql = str(consulta.compile(dialect=conexao.dialect, compile_kwargs={'literal_binds': True}))
+        if _postgres(conexao):
+            prefixo = 'EXPLAIN (ANALYZE, BUFFERS) ' if analisar else 'EXPLAIN '
+            linhas = [linha[0] for linha in conexao.exec_driver_sql(prefixo + sql)]
+        else:
+            # Linhas do EXPLAIN QUERY PLAN: (id, pai, não usado, detalhe); indenta pela profundidade
+            profundidade = {0: -1}
+            linhas = []
+            for id_no, pai, _, detalhe in conexao.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql):
+                profundidade[id_no] = profundidade.get(pai, -1) + 1
+                linhas.append('  ' * profundidade[id_no] + detalhe)
+
+        saida(f'\n== {descricao} ==')
+        for linha in linhas:
+            aviso = _varredura_sequencial(conexao, linha.strip())
+            varreduras += aviso
+            saida(('!! ' if aviso else '   ') + linha)
+    saida(f'\n{varreduras} varredura(s) sequencial(is) encontrada(s).')
+    if varreduras and _postgres(conexao):
+        saida('Em tabelas pequenas o PostgreSQL prefere varreduras sequenciais; compare com dados reais.')
+    return varreduras
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrações do esquema e planos das consultas.')
+    parser.add_argument('comando', nargs='?', default='aplicar', choices=['aplicar', 'estado', 'explicar'])
+    parser.add_argument('--analisar', action='store_true', help='executa as consultas (EXPLAIN ANALYZE, só PostgreSQL)')
+    argumentos = parser.parse_args()
+
+    with app.app_context():
+        if argumentos.comando == 'aplicar':
+            aplicadas = aplicar_migracoes(db.engine)
+            print(f'{aplicadas} migração(ões) aplicada(s).' if aplicadas else 'Esquema já está atualizado.')
+        elif argumentos.comando == 'estado':
+            aplicadas = versoes_aplicadas(db.engine)
+            for item in sorted(MIGRACOES, key=lambda m: m.versao):
+                marca = 'aplicada' if item.versao in aplicadas else 'PENDENTE'
+                print(f'{item.versao:04d}  {marca:9}  {item.nome}')
+        else:
+            with db.engine.connect() as conexao:
+                explicar(conexao, analisar=argumentos.analisar)
@@ -0,0 +1,235 @@
+# relatorio_pdf.py
+"""Relatório do pedido em PDF, composto no servidor com o PyMuPDF.
+
+Reproduz a folha de imprimir_relatorio.html, um A4 de 794 x 1123 px (96 dpi): o cabeçalho
+com os dados do pedido em duas colunas e, por baixo, a área das imagens. Os anexos e os
+textos personalizados ficam nas posições guardadas pelo editor, em px relativos a essa área;
+sem posições guardadas, as imagens são distribuídas como na página (a primeira maior, as
+restantes em linhas de duas).
+
+O texto e as caixas são vetoriais. As imagens são reduzidas à resolução de impressão do
+espaço que ocupam na folha, não à do ficheiro original, e um anexo em PDF entra pela sua
+primeira página, ainda em vetor. O navegador deixa de rasterizar a página inteira para um
+PNG, e o ficheiro fica uma fração do tamanho.
+"""
+import logging
+import math
+import os
+import re
+
+import fitz
+
+from imagens import e_imagem, e_pdf, imagem_para_impressao
+
+logger = logging.getLogger(__name__)
+
+# Versão do desenho da folha: incrementar ao mudar o que é gerado aqui, para os PDFs já
+# guardados (cache_relatorios.py) deixarem de ser usados
+VERSAO_DESENHO = 1
+
+# px CSS (96 por polegada) -> pontos PDF (72 por polegada)
+PX = 72 / 96
+
+# Medidas da folha em px, como no CSS de imprimir_relatorio.html
+LARGURA_FOLHA, ALTURA_FOLHA = 794, 1123
+MARGEM = 11  # padding de 0.3cm
+ALTURA_CAMPO, ESPACO_CAMPOS = 70, 15
+ALTURA_AREA_IMAGENS = 1123 - 200 - 170
+TOPO_AREA_IMAGENS = ALTURA_FOLHA - MARGEM - ALTURA_AREA_IMAGENS
+LARGURA_AREA_IMAGENS = LARGURA_FOLHA - 2 * MARGEM
+# Tamanho de uma imagem sem largura/altura guardadas (o mesmo da página)
+TAMANHO_IMAGEM_PADRAO = (150, 100)
+
+RESOLUCAO_IMPRESSAO = 200
+
+AZUL = (0, 0.482, 1)  # #007bff
+CINZA_FUNDO = (0.973, 0.976, 0.98)  # #f8f9fa
+CINZA_ROTULO = (0.286, 0.314, 0.341)  # #495057
+COR_VALOR = (0.129, 0.145, 0.161)  # #212529
+COR_BORDA_IMAGEM = (0.867, 0.867, 0.867)  # #ddd
+COR_BORDA_TEXTO = (0.8, 0.8, 0.8)  # #ccc
+
+_COR_HEX = re.compile(r'#?([0-9a-fA-F]{3}|[0-9a-fA-F]{6})')
+_TAMANHO_FONTE = re.compile(r'\s*(\d+(?:\.\d+)?)\s*(px|pt)?\s*')
+
+
+def _cor(texto, padrao=(0, 0, 0)):
+    """Cor CSS em hexadecimal ('#333', '#1a2b3c') como (r, g, b) entre 0 e 1."""
+    correspondencia = _COR_HEX.fullmatch((texto or '').strip())
+    if not correspondencia:
+        return padrao
+    valor = correspondencia.group(1)
+    if len(valor) == 3:
+        valor = ''.join(digito * 2 for digito in valor)
+    return tuple(int(valor[indice:indice + 2], 16) / 255 for indice in (0, 2, 4))
+
+
+def _tamanho_fonte(valor, padrao=16):
+    """Tamanho de letra em px a partir de '16px', '12pt' ou de um número."""
+    if isinstance(valor, (int, float)):
+        return float(valor) or padrao
+    correspondencia = _TAMANHO_FONTE.fullmatch(valor or '')
+    if not correspondencia:
+        return padrao
+    tamanho = float(correspondencia.group(1))
+    return tamanho / PX if correspondencia.group(2) == 'pt' else tamanho
+
+
+# As fontes base escrevem Latin-1; a pontuação tipográfica mais comum passa ao equivalente simples
+_PONTUACAO = str.maketrans({'\u2013': '-', '\u2014': '-', '\u2018': "'", '\u2019': "'", '\u201c': '"',
+                            '\u201d': '"', '\u2026': '...', '\u2022': '-', '\u00a0': ' '})
+
+
+def _texto_pdf(texto):
+    """Texto em maiúsculas (como o CSS da página) e com a pontuação que as fontes base têm."""
+    return (texto or '').upper().translate(_PONTUACAO)
+
+
+def _retangulo(esquerda, topo, largura, altura):
+    """Retângulo em pontos a partir de medidas em px da folha."""
+    return fitz.Rect(esquerda * PX, topo * PX, (esquerda + largura) * PX, (topo + altura) * PX)
+
+
+def _fonte(negrito=False, italico=False):
+    # Helvetica das 14 fontes base do PDF (acentos do português incluídos)
+    return {(False, False): 'helv', (True, False): 'hebo', (False, True): 'heit', (True, True): 'hebi'}[negrito, italico]
+
+
+def _texto_ajustado(pagina, retangulo, texto, tamanho, fonte, cor, minimo=6):
+    """Escreve o texto no retângulo, reduzindo a letra até caber (no mínimo `minimo` pt) e,
+    se nem assim couber, cortando o fim."""
+    while texto:
+        # insert_textbox não escreve nada e retorna um valor negativo se o texto não couber
+        if pagina.insert_textbox(retangulo, texto, fontsize=tamanho, fontname=fonte, color=cor) >= 0:
+            return
+        if tamanho > minimo:
+            tamanho = max(tamanho - 0.5, minimo)
+        else:
+            texto = texto[:len(texto) * 9 // 10].rstrip() + '...' if len(texto) > 3 else ''
+
+
+# --- Cabeçalho ---
+
+def _cabecalho(pagina, campos):
+    largura_campo = (LARGURA_AREA_IMAGENS - ESPACO_CAMPOS) / 2
+    linhas = math.ceil(len(campos) / 2)
+    for indice, (rotulo, valor) in enumerate(campos):
+        esquerda = MARGEM + (indice % 2) * (largura_campo + ESPACO_CAMPOS)
+        topo = MARGEM + (indice // 2) * (ALTURA_CAMPO + ESPACO_CAMPOS)
+        pagina.draw_rect(_retangulo(esquerda, topo, largura_campo, ALTURA_CAMPO), color=None, fill=CINZA_FUNDO)
+        pagina.draw_rect(_retangulo(esquerda, topo, 4, ALTURA_CAMPO), color=None, fill=AZUL)
+        _texto_ajustado(pagina, _retangulo(esquerda + 19, topo + 8, largura_campo - 34, 22), _texto_pdf(rotulo),
+                        14.4 * PX, _fonte(negrito=True), CINZA_ROTULO)
+        _texto_ajustado(pagina, _retangulo(esquerda + 19, topo + 30, largura_campo - 34, ALTURA_CAMPO - 34),
+                        _texto_pdf(valor), 17.6 * PX, _fonte(), COR_VALOR)
+    # Linha azul por baixo do cabeçalho
+    fim = MARGEM + linhas * ALTURA_CAMPO + (linhas - 1) * ESPACO_CAMPOS + 15 + 20
+    pagina.draw_line(fitz.Point(MARGEM * PX, fim * PX), fitz.Point((LARGURA_FOLHA - MARGEM) * PX, fim * PX),
+                     color=AZUL, width=2 * PX)
+
+
+# --- Imagens ---
+
+def posicoes_automaticas(quantidade):
+    """Posições (esquerda, topo, largura, altura) em px, relativas à área das imagens, sem layout guardado."""
+    if quantidade == 0:
+        return []
+    if quantidade == 1:
+        return [(0, 0, LARGURA_AREA_IMAGENS, ALTURA_AREA_IMAGENS)]
+    espaco = 10
+    altura_primeira = ALTURA_AREA_IMAGENS / 2
+    posicoes = [(0, 0, LARGURA_AREA_IMAGENS, altura_primeira - espaco)]
+    restantes = quantidade - 1
+    linhas = math.ceil(restantes / 2)
+    altura_linha = (ALTURA_AREA_IMAGENS - altura_primeira) / linhas
+    largura_coluna = (LARGURA_AREA_IMAGENS - espaco) / 2
+    for indice in range(restantes):
+        # Uma imagem sozinha na última linha ocupa a largura toda
+        sozinha = indice == restantes - 1 and restantes % 2 == 1
+        posicoes.append((
+            0 if sozinha else (indice % 2) * (largura_coluna + espaco),
+            altura_primeira + (indice // 2) * altura_linha,
+            LARGURA_AREA_IMAGENS if sozinha else largura_coluna,
+            altura_linha - espaco,
+        ))
+    return posicoes
+
+
+def _imagem(pagina, origem, nome_ficheiro, retangulo, dpi):
+    if e_pdf(nome_ficheiro):
+        with fitz.open(origem) as documento:
+            pagina.show_pdf_page(retangulo, documento, 0, keep_proportion=True)
+    else:
+        dados = imagem_para_impressao(origem, retangulo.width, retangulo.height, dpi)
+        pagina.insert_image(retangulo, stream=dados, keep_proportion=True)
+    # Borda de 1px com cantos de 8px (o raio é uma fração do lado menor)
+    pagina.draw_rect(retangulo, color=COR_BORDA_IMAGEM, width=PX, radius=min(8 * PX / min(retangulo.width, retangulo.height), 0.5))
+
+
+# --- Textos personalizados ---
+
+def _texto(pagina, texto):
+    tamanho = _tamanho_fonte(texto.get('font_size')) * PX
+    fonte = _fonte(bool(texto.get('bold', True)), bool(texto.get('italic')))
+    cor = _cor(texto.get('color'))
+    linhas = _texto_pdf(texto.get('conteudo')).split('\n')
+    # Caixa com borda e fundo (textos guardados) ou só o texto (estado do editor), como na página
+    folga_x, folga_y = (5, 5) if texto.get('fundo', True) else (4, 2)
+    altura_linha = tamanho * 1.2
+    largura = max(fitz.get_text_length(linha, fontname=fonte, fontsize=tamanho) for linha in linhas)
+    esquerda = (MARGEM + (texto.get('left') or 0)) * PX
+    topo = (TOPO_AREA_IMAGENS + (texto.get('top') or 0)) * PX
+    caixa = fitz.Rect(esquerda, topo, esquerda + largura + 2 * folga_x * PX,
+                      topo + altura_linha * len(linhas) + 2 * folga_y * PX)
+    if texto.get('fundo', True):
+        pagina.draw_rect(caixa, color=COR_BORDA_TEXTO, fill=(1, 1, 1), fill_opacity=0.9, width=PX)
+    for numero, linha in enumerate(linhas):
+        base = fitz.Point(esquerda + folga_x * PX, topo + folga_y * PX + altura_linha * numero + tamanho * 0.95)
+        pagina.insert_text(base, linha, fontsize=tamanho, fontname=fonte, color=cor)
+        if texto.get('underline'):
+            comprimento = fitz.get_text_length(linha, fontname=fonte, fontsize=tamanho)
+            pagina.draw_line(base + (0, tamanho * 0.12), base + (comprimento, tamanho * 0.12), color=cor, width=tamanho / 16)
+
+
+# --- Documento ---
+
+def gerar_relatorio_pdf(pasta, campos, imagens, textos, dpi=RESOLUCAO_IMPRESSAO):
+    """Bytes do PDF do relatório (uma folha A4).
+
+    - campos: [(rótulo, valor)] do cabeçalho, pela ordem;
+    - imagens: [{'filename', 'left', 'top', 'width', 'height'}] com medidas em px relativas à
+      área das imagens (None nas quatro para a distribuição automática);
+    - textos: [{'conteudo', 'left', 'top', 'font_size', 'color', 'bold', 'italic', 'underline',
+      'fundo'}].
+
+    Anexos que não são imagens nem PDFs, ou que não se conseguem abrir, ficam de fora.
+    """
+    documento = fitz.open()
+    largura, altura = fitz.paper_size('a4')
+    pagina = documento.new_page(width=largura, height=altura)
+    pagina.draw_rect(pagina.rect, color=None, fill=(1, 1, 1))
+    _cabecalho(pagina, campos)
+
+    imagens = [imagem for imagem in imagens if e_imagem(imagem['filename']) or e_pdf(imagem['filename'])]
+    if any(imagem.get('left') is not None or imagem.get('top') is not None for imagem in imagens):
+        posicoes = [(imagem.get('left') or 0, imagem.get('top') or 0,
+                     imagem.get('width') or TAMANHO_IMAGEM_PADRAO[0], imagem.get('height') or TAMANHO_IMAGEM_PADRAO[1])
+                    for imagem in imagens]
+    else:
+        posicoes = posicoes_automaticas(len(imagens))
+    for imagem, (esquerda, topo, largura, altura) in zip(imagens, posicoes):
+        retangulo = _retangulo(MARGEM + esquerda, TOPO_AREA_IMAGENS + topo, largura, altura) & pagina.rect
+        if retangulo.is_empty:
+            continue
+        try:
+            _imagem(pagina, os.path.join(pasta, imagem['filename']), imagem['filename'], retangulo, dpi)
+        except Exception:
+            logger.exception('Não foi possível colocar o anexo %s no relatório', imagem['filename'])
+
+    for texto in textos:
+        if (texto.get('conteudo') or '').strip():
+            _texto(pagina, texto)
+
+    dados = documento.tobytes(garbage=3, deflate=True)
+    documento.close()
+    return dados
@@ -0,0 +1,244 @@
+# romaneio.py
+"""Leitura dos PDFs de romaneio: texto página a página e pedidos extraídos em fluxo.
+
+O texto de cada página é extraído pelo PyMuPDF e entra num separador incremental, que
+entrega cada pedido (o bloco entre dois cabeçalhos "Pedido  Pedido Cli.") assim que o
+cabeçalho seguinte aparece. Em memória fica apenas o pedido em curso, não o documento
+inteiro, e o resultado é o mesmo de juntar todas as páginas e separar de uma vez.
+
+A extração do texto é a parte cara. Em documentos com pelo menos `paginas_paralelo` páginas
+as páginas são repartidas por um pool de processos (o PyMuPDF não liberta o GIL), em grupos
+consecutivos cujos textos voltam pela ordem original. Os processos abrem o PDF a partir de um
+ficheiro temporário, para não copiar os bytes do documento para cada grupo.
+
+Vários romaneios enviados de uma vez (analisar_varios) usam o mesmo pool, um documento por
+processo; o erro de um documento fica nesse documento e não interrompe os restantes.
+"""
+import atexit
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from decimal import Decimal, InvalidOperation
+
+import fitz
+
+# Separador entre pedidos e padrões de cada bloco (compilados uma única vez)
+SEPARADOR_PEDIDOS = re.compile(r'Pedido\s+Pedido Cli\.', re.IGNORECASE)
+PADRAO_CLIENTE = re.compile(r'\n([A-Z\s\d\.\-]+-\s*VID\..*?)\n')
+PADRAO_CABECALHO = re.compile(
+    r'Tipo\s+Funcionário\s+Data Pedido\s+Data Entrega\s+Peso\s+m²\s+Total\n(.*?)\n',
+    re.IGNORECASE | re.DOTALL,
+)
+PADRAO_SECCAO_PRODUTOS = re.compile(r'Cod\s+Produto\s+LarguraxAltura(.*?)Resumo:', re.IGNORECASE | re.DOTALL)
+PADRAO_PRODUTO = re.compile(r'(\d{4,})\s+(.*?)\s+OS:(\d+)\s+(\d+x\d+)\s+(\d+)\s+([\d,]+)', re.DOTALL)
+PADRAO_COLUNAS = re.compile(r'\s{2,}')
+
+CAMPOS_CABECALHO = ('pedido', 'pedido_cli', 'tipo', 'funcionario', 'data_pedido',
+                    'data_entrega', 'peso', 'm2', 'total')
+# Chaves de cada pedido e de cada produto devolvidos por extrair_pedido()
+CAMPOS_PEDIDO = CAMPOS_CABECALHO + ('cliente',)
+CAMPOS_PRODUTO = ('cod', 'produto', 'os', 'dimensoes', 'qtde', 'm2')
+
+# Sobe quando a leitura passa a produzir resultados diferentes para o mesmo PDF; os
+# romaneios guardados por uma versão anterior voltam então a ser lidos
+VERSAO_LEITOR = 1
+
+# Caracteres já lidos que voltam a ser procurados quando chega uma página nova, para
+# encontrar um separador partido entre o fim de uma página e o início da seguinte
+SOBREPOSICAO_SEPARADOR = 256
+
+# Páginas enviadas a cada processo de uma vez
+PAGINAS_POR_GRUPO = 16
+
+
+# --- Pedidos ---
+
+def extrair_pedido(bloco):
+    """Cabeçalho e produtos de um bloco de pedido, ou None se o bloco não tiver cabeçalho válido."""
+    cliente_match = PADRAO_CLIENTE.search(bloco)
+    nome_cliente = cliente_match.group(1).strip() if cliente_match else 'Cliente não encontrado'
+
+    cabecalho_match = PADRAO_CABECALHO.search(bloco)
+    if not cabecalho_match:
+        return None
+    # Os valores do cabeçalho vêm numa linha, separados por dois ou mais espaços
+    valores = PADRAO_COLUNAS.split(cabecalho_match.group(1).strip())
+    if len(valores) < len(CAMPOS_CABECALHO):
+        return None
+    cabecalho = dict(zip(CAMPOS_CABECALHO, valores))
+    cabecalho['cliente'] = nome_cliente
+
+    produtos = []
+    seccao_match = PADRAO_SECCAO_PRODUTOS.search(bloco)
+    if seccao_match:
+        for cod, produto, os_, dimensoes, qtde, m2 in PADRAO_PRODUTO.findall(seccao_match.group(1)):
+            produtos.append({
+                'cod': cod.strip(),
+                'produto': produto.replace('\n', ' ').strip(),
+                'os': os_.strip(),
+                'dimensoes': dimensoes.strip(),
+                'qtde': qtde.strip(),
+                'm2': m2.strip(),
+            })
+    return {'cabecalho': cabecalho, 'produtos': produtos}
+
+
+def separar_blocos(textos):
+    """Produz os blocos de pedido a partir dos textos das páginas, pela ordem.
+
+    Equivale a SEPARADOR_PEDIDOS.split(''.join(textos))[1:], mas cada bloco sai assim que o
+    separador seguinte é lido; o texto antes do primeiro separador é descartado.
+    """
+    pendente = ''
+    dentro_de_pedido = False
+    for texto in textos:
+        inicio_busca = max(len(pendente) - SOBREPOSICAO_SEPARADOR, 0)
+        pendente += texto
+        fim_anterior = 0
+        for separador in SEPARADOR_PEDIDOS.finditer(pendente, inicio_busca):
+            if dentro_de_pedido:
+                yield pendente[fim_anterior:separador.start()]
+            dentro_de_pedido = True
+            fim_anterior = separador.end()
+        if fim_anterior:
+            pendente = pendente[fim_anterior:]
+        elif not dentro_de_pedido:
+            # Antes do primeiro pedido só interessa o fim, onde o separador pode estar partido
+            pendente = pendente[-SOBREPOSICAO_SEPARADOR:]
+    if dentro_de_pedido:
+        yield pendente
+
+
+def extrair_pedidos(textos):
+    """Pedidos válidos (dicionários com 'cabecalho' e 'produtos') dos textos das páginas."""
+    for bloco in separar_blocos(textos):
+        pedido = extrair_pedido(bloco)
+        if pedido is not None:
+            yield pedido
+
+
+# --- Texto das páginas ---
+
+def _textos_grupo(caminho, inicio, fim):
+    # Corre nos processos do pool: abre o PDF e extrai as páginas [inicio, fim)
+    with fitz.open(caminho) as documento:
+        return [documento[numero].get_text() for numero in range(inicio, fim)]
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _obter_executor(processos):
+    """Pool de processos partilhado pelo worker, criado no primeiro uso.
+
+    Usa 'spawn': o worker do servidor tem threads e um fork copiaria locks em uso.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=processos, mp_context=multiprocessing.get_context('spawn'))
+            atexit.register(_executor.shutdown, wait=False, cancel_futures=True)
+        return _executor
+
+
+def _descartar_executor(executor):
+    # Um processo do pool morreu (ex.: falta de memória): o pool deixa de aceitar tarefas e
+    # é recriado no próximo uso
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _textos_em_paralelo(pdf_bytes, total_paginas, processos):
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temporario:
+        temporario.write(pdf_bytes)
+    try:
+        executor = _obter_executor(processos)
+        grupos = [(inicio, min(inicio + PAGINAS_POR_GRUPO, total_paginas))
+                  for inicio in range(0, total_paginas, PAGINAS_POR_GRUPO)]
+        # No máximo dois grupos por processo em curso, para não acumular textos à espera
+        em_curso = []
+        proximo = 0
+        while proximo < len(grupos) or em_curso:
+            while proximo < len(grupos) and len(em_curso) < 2 * processos:
+                em_curso.append(executor.submit(_textos_grupo, temporario.name, *grupos[proximo]))
+                proximo += 1
+            yield from em_curso.pop(0).result()
+    finally:
+        os.remove(temporario.name)
+
+
+def textos_paginas(pdf_bytes, processos=1, paginas_paralelo=40):
+    """Texto de cada página do PDF, pela ordem, extraído em fluxo.
+
+    Com `processos` > 1 e pelo menos `paginas_paralelo` páginas, a extração é repartida
+    pelo pool de processos; caso contrário corre no processo atual, página a página.
+    """
+    with fitz.open(stream=pdf_bytes, filetype='pdf') as documento:
+        total_paginas = documento.page_count
+        if processos <= 1 or total_paginas < paginas_paralelo:
+            for pagina in documento:
+                yield pagina.get_text()
+            return
+    yield from _textos_em_paralelo(pdf_bytes, total_paginas, processos)
+
+
+def analisar_romaneio(pdf_bytes, processos=1, paginas_paralelo=40):
+    """Lista dos pedidos encontrados no PDF do romaneio."""
+    return list(extrair_pedidos(textos_paginas(pdf_bytes, processos, paginas_paralelo)))
+
+
+# --- Vários romaneios ---
+
+def analisar_varios(documentos, processos=1):
+    """Lê vários PDFs e retorna, pela mesma ordem, (pedidos, None) ou (None, mensagem de erro).
+
+    Com `processos` > 1 cada documento é lido num processo do pool; caso contrário são lidos
+    um a um no processo atual.
+    """
+    if processos <= 1 or len(documentos) <= 1:
+        resultados = []
+        for pdf_bytes in documentos:
+            try:
+                resultados.append((analisar_romaneio(pdf_bytes), None))
+            except Exception as erro:
+                resultados.append((None, str(erro) or erro.__class__.__name__))
+        return resultados
+
+    executor = _obter_executor(processos)
+    futuros = [executor.submit(analisar_romaneio, pdf_bytes) for pdf_bytes in documentos]
+    resultados = []
+    for futuro in futuros:
+        try:
+            resultados.append((futuro.result(), None))
+        except BrokenProcessPool:
+            _descartar_executor(executor)
+            resultados.append((None, 'O processo de leitura terminou inesperadamente.'))
+        except Exception as erro:
+            resultados.append((None, str(erro) or erro.__class__.__name__))
+    return resultados
+
+
+def numero_br(texto):
+    """Converte um número escrito como no PDF ('1.234,56') em Decimal; None se não for um número."""
+    try:
+        valor = Decimal(texto.strip().replace('.', '').replace(',', '.'))
+    except (AttributeError, InvalidOperation):
+        return None
+    return valor if valor.is_finite() else None
+
+
+def totais(relatorios):
+    """Número de pedidos e soma do peso e do m² dos cabeçalhos (valores ilegíveis contam como zero)."""
+    peso = m2 = Decimal(0)
+    for relatorio in relatorios:
+        peso += numero_br(relatorio['cabecalho'].get('peso')) or 0
+        m2 += numero_br(relatorio['cabecalho'].get('m2')) or 0
+    return {'pedidos': len(relatorios), 'peso': peso, 'm2': m2}
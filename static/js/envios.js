@@ -0,0 +1,125 @@
+/**
+ * Envio de anexos em blocos (ver /anexos/envios em app.py).
+ *
+ * EnviosAnexos.enviar(ficheiro, entradaId, aoProgredir) abre o envio, manda o ficheiro em
+ * blocos (vários em paralelo), calcula o SHA-256 e conclui; devolve uma Promise com a
+ * resposta da conclusão. aoProgredir(percentual, ficheiro) é chamado a cada bloco gravado.
+ *
+ * O id de cada envio fica no localStorage (pela entrada, nome, tamanho e data do ficheiro):
+ * se a ligação cair ou a página for recarregada, enviar o mesmo ficheiro de novo retoma o
+ * envio e só manda os blocos em falta.
+ */
+(function() {
+    'use strict';
+
+    const BLOCOS_EM_PARALELO = 3;
+    const TENTATIVAS_POR_BLOCO = 4;
+
+    function chaveRetoma(ficheiro, entradaId) {
+        return ['envio', entradaId, ficheiro.name, ficheiro.size, ficheiro.lastModified].join(':');
+    }
+
+    function pedirJson(url, opcoes) {
+        return fetch(url, Object.assign({ credentials: 'same-origin' }, opcoes))
+            .then(resposta => resposta.json().catch(() => ({}))
+                .then(dados => {
+                    if (!resposta.ok || dados.success === false) {
+                        const erro = new Error(dados.message || `Erro ${resposta.status}`);
+                        erro.status = resposta.status;
+                        throw erro;
+                    }
+                    return dados;
+                }));
+    }
+
+    function enviarJson(url, metodo, corpo) {
+        return pedirJson(url, {
+            method: metodo,
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(corpo)
+        });
+    }
+
+    async function sha256(ficheiro) {
+        // crypto.subtle só existe em HTTPS (ou localhost); sem ele o servidor verifica só o tamanho
+        if (!window.crypto || !crypto.subtle) return null;
+        const resumo = await crypto.subtle.digest('SHA-256', await ficheiro.arrayBuffer());
+        return Array.from(new Uint8Array(resumo), byte => byte.toString(16).padStart(2, '0')).join('');
+    }
+
+    async function abrirOuRetomar(ficheiro, entradaId) {
+        const chave = chaveRetoma(ficheiro, entradaId);
+        const envioId = localStorage.getItem(chave);
+        if (envioId) {
+            try {
+                return (await pedirJson(`/anexos/envios/${envioId}`)).envio;
+            } catch (erro) {
+                // Envio expirado ou concluído noutra página: começa de novo
+                localStorage.removeItem(chave);
+            }
+        }
+        const dados = await enviarJson('/anexos/envios', 'POST',
+            { entrada_id: entradaId, nome: ficheiro.name, tamanho: ficheiro.size });
+        localStorage.setItem(chave, dados.envio.id);
+        return dados.envio;
+    }
+
+    async function enviarBloco(envio, ficheiro, inicio, fim) {
+        for (let tentativa = 1; ; tentativa++) {
+            try {
+                return await pedirJson(`${envio.url}?inicio=${inicio}`, {
+                    method: 'PUT',
+                    headers: { 'Content-Type': 'application/octet-stream' },
+                    body: ficheiro.slice(inicio, fim)
+                });
+            } catch (erro) {
+                // Erros do pedido (4xx) não melhoram com nova tentativa; falhas de rede sim
+                if (erro.status && erro.status < 500 || tentativa >= TENTATIVAS_POR_BLOCO) throw erro;
+                await new Promise(resolver => setTimeout(resolver, 1000 * tentativa));
+            }
+        }
+    }
+
+    async function enviar(ficheiro, entradaId, aoProgredir) {
+        const chave = chaveRetoma(ficheiro, entradaId);
+        const envio = await abrirOuRetomar(ficheiro, entradaId);
+
+        // Os intervalos em falta são partidos em blocos do tamanho aceite pelo servidor
+        const blocos = [];
+        envio.em_falta.forEach(([inicio, fim]) => {
+            for (let posicao = inicio; posicao < fim; posicao += envio.bloco) {
+                blocos.push([posicao, Math.min(posicao + envio.bloco, fim)]);
+            }
+        });
+
+        let recebido = envio.recebido;
+        const avisar = () => aoProgredir && aoProgredir(Math.round(100 * recebido / ficheiro.size), ficheiro);
+        avisar();
+
+        const hash = sha256(ficheiro);
+        async function trabalhador() {
+            while (blocos.length) {
+                const [inicio, fim] = blocos.shift();
+                await enviarBloco(envio, ficheiro, inicio, fim);
+                recebido += fim - inicio;
+                avisar();
+            }
+        }
+        await Promise.all(Array.from({ length: BLOCOS_EM_PARALELO }, trabalhador));
+
+        try {
+            const resultado = await enviarJson(envio.url_concluir, 'POST', { sha256: await hash });
+            localStorage.removeItem(chave);
+            return resultado;
+        } catch (erro) {
+            // Conteúdo diferente do ficheiro (422): retomar não adianta, o envio é descartado
+            if (erro.status === 422) {
+                fetch(envio.url, { method: 'DELETE', credentials: 'same-origin' });
+                localStorage.removeItem(chave);
+            }
+            throw erro;
+        }
+    }
+
+    window.EnviosAnexos = { enviar };
+})();
@@ -0,0 +1,77 @@
+/**
+ * Exportações em segundo plano.
+ *
+ * Os links com data-exportacao="<tipo>" (e opcionalmente data-formato="csv") agendam a
+ * exportação em /exportacoes, mostram o progresso no próprio botão e iniciam o download
+ * quando o ficheiro fica pronto. Sem JavaScript, o link continua a apontar para a
+ * exportação direta em fluxo.
+ */
+(function() {
+    'use strict';
+
+    const INTERVALO_POLLING = 1000;
+
+    function atualizarBotao(botao, texto) {
+        botao.innerHTML = '<i class="fas fa-spinner fa-spin"></i> ' + texto;
+    }
+
+    function restaurarBotao(botao) {
+        botao.innerHTML = botao.dataset.htmlOriginal;
+        botao.classList.remove('disabled');
+        delete botao.dataset.emAndamento;
+    }
+
+    function acompanhar(botao, tarefa) {
+        if (tarefa.estado === 'concluida') {
+            restaurarBotao(botao);
+            window.location.href = tarefa.url_download;
+            return;
+        }
+        if (tarefa.estado === 'erro') {
+            restaurarBotao(botao);
+            alert('Erro na exportação: ' + (tarefa.mensagem || 'falha desconhecida'));
+            return;
+        }
+        atualizarBotao(botao, tarefa.percentual !== null ? `Exportando... ${tarefa.percentual}%` : 'Exportando...');
+        setTimeout(() => {
+            fetch(tarefa.url_estado, { credentials: 'same-origin' })
+                .then(resposta => resposta.json())
+                .then(dados => {
+                    if (!dados.success) throw new Error(dados.message);
+                    acompanhar(botao, dados.tarefa);
+                })
+                .catch(erro => {
+                    restaurarBotao(botao);
+                    alert('Erro na exportação: ' + erro.message);
+                });
+        }, INTERVALO_POLLING);
+    }
+
+    document.addEventListener('click', function(evento) {
+        const botao = evento.target.closest('[data-exportacao]');
+        if (!botao) return;
+        evento.preventDefault();
+        if (botao.dataset.emAndamento) return;
+
+        botao.dataset.emAndamento = '1';
+        botao.dataset.htmlOriginal = botao.dataset.htmlOriginal || botao.innerHTML;
+        botao.classList.add('disabled');
+        atualizarBotao(botao, 'Preparando...');
+
+        fetch(botao.dataset.urlTarefas, {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ tipo: botao.dataset.exportacao, formato: botao.dataset.formato || 'xlsx' })
+        })
+            .then(resposta => resposta.json())
+            .then(dados => {
+                if (!dados.success) throw new Error(dados.message);
+                acompanhar(botao, dados.tarefa);
+            })
+            .catch(erro => {
+                restaurarBotao(botao);
+                alert(erro.message);
+            });
+    });
+})();
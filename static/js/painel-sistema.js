@@ -227,6 +227,337 @@ window.PainelSistema = (function() {
         }
     };
     
+    // Tabelas virtualizadas do painel e aplicação incremental (delta)
+    const tableManager = {
+        // Cria uma tabela virtualizada: guarda os dados de todas as linhas carregadas, mas só
+        // as linhas visíveis (mais uma margem) existem no DOM. Espaçadores no topo e na base
+        // mantêm a altura total; as janelas seguintes são pedidas via options.fetchPage(cursor).
+        createVirtual: (options) => {
+            const tbody = options.tbody;
+            const colunas = options.columns || 11;
+            const margem = options.overscan || 10;
+            const idsSelecionados = new Set();
+            const adotadas = new Map();
+            let montadas = new Map();
+            let linhas = [];
+            let cursor = options.cursor === undefined ? null : options.cursor;
+            let alturaLinha = options.rowHeight || 45;
+            let alturaMedida = false;
+            let intervalo = [-1, -1];
+            let carregando = false;
+            let geracao = 0;
+            let agendado = false;
+            
+            const criarEspacador = () => {
+                const tr = document.createElement('tr');
+                tr.className = 'linha-espacadora';
+                tr.setAttribute('aria-hidden', 'true');
+                const td = document.createElement('td');
+                td.colSpan = colunas;
+                td.style.cssText = 'padding: 0; border: 0; height: 0;';
+                tr.appendChild(td);
+                return tr;
+            };
+            const espacadorTopo = criarEspacador();
+            const espacadorBase = criarEspacador();
+            
+            const posicaoDe = (entryId) => linhas.findIndex(linha => String(linha.id) === String(entryId));
+            
+            const montarLinha = (linha) => {
+                const chave = String(linha.id);
+                let row = montadas.get(chave) || adotadas.get(chave);
+                if (!row) {
+                    row = options.builder(linha);
+                }
+                const checkbox = row.querySelector(options.checkboxSelector);
+                if (checkbox) {
+                    checkbox.checked = idsSelecionados.has(chave);
+                }
+                return row;
+            };
+            
+            const render = (forcar = false) => {
+                if (linhas.length === 0) {
+                    intervalo = [0, 0];
+                    montadas = new Map();
+                    tbody.innerHTML = `<tr><td colspan="${colunas}" class="text-center">${options.emptyMessage || ''}</td></tr>`;
+                    if (typeof options.onRender === 'function') options.onRender();
+                    return;
+                }
+                
+                // Intervalo visível em coordenadas do tbody (a página rola, não a tabela)
+                const topo = tbody.getBoundingClientRect().top;
+                const inicioVisivel = Math.max(0, -topo);
+                const fimVisivel = Math.max(0, window.innerHeight - topo);
+                // Se a página está abaixo do fim da tabela (ex.: linhas removidas), mostra as últimas
+                const inicio = Math.max(0, Math.min(Math.floor(inicioVisivel / alturaLinha), linhas.length - 1) - margem);
+                const fim = Math.min(linhas.length, Math.max(inicio + 1, Math.ceil(fimVisivel / alturaLinha) + margem));
+                
+                if (forcar || inicio !== intervalo[0] || fim !== intervalo[1]) {
+                    const fragment = document.createDocumentFragment();
+                    const novas = new Map();
+                    espacadorTopo.firstChild.style.height = `${inicio * alturaLinha}px`;
+                    fragment.appendChild(espacadorTopo);
+                    for (let i = inicio; i < fim; i++) {
+                        try {
+                            const row = montarLinha(linhas[i]);
+                            novas.set(String(linhas[i].id), row);
+                            fragment.appendChild(row);
+                        } catch (error) {
+                            logger.error(`Erro ao montar a linha da entrada ${linhas[i].id}:`, error);
+                        }
+                    }
+                    espacadorBase.firstChild.style.height = `${(linhas.length - fim) * alturaLinha}px`;
+                    fragment.appendChild(espacadorBase);
+                    
+                    tbody.innerHTML = '';
+                    tbody.appendChild(fragment);
+                    montadas = novas;
+                    intervalo = [inicio, fim];
+                    
+                    // Na primeira montagem, troca a altura estimada pela média real das linhas
+                    if (!alturaMedida && novas.size > 0) {
+                        let soma = 0;
+                        novas.forEach(row => { soma += row.offsetHeight; });
+                        const media = soma / novas.size;
+                        if (media > 0) {
+                            alturaMedida = true;
+                            if (Math.abs(media - alturaLinha) > 1) {
+                                alturaLinha = media;
+                                agendarRender(true);
+                            }
+                        }
+                    }
+                    
+                    if (typeof options.onRender === 'function') options.onRender();
+                }
+                
+                // Perto do fim das linhas carregadas: pede a próxima janela
+                if (cursor !== null && fim >= linhas.length - margem) {
+                    carregarMais();
+                }
+            };
+            
+            const agendarRender = (forcar = false) => {
+                if (forcar) intervalo = [-1, -1];
+                if (agendado) return;
+                agendado = true;
+                window.requestAnimationFrame(() => {
+                    agendado = false;
+                    render();
+                });
+            };
+            
+            const carregarMais = () => {
+                if (carregando || cursor === null || typeof options.fetchPage !== 'function') return;
+                carregando = true;
+                const geracaoPedido = geracao;
+                if (options.loadingElement) options.loadingElement.style.display = 'block';
+                
+                Promise.resolve(options.fetchPage(cursor))
+                    .then(pagina => {
+                        // Descarta a resposta se as linhas foram recarregadas entretanto
+                        if (geracaoPedido !== geracao) return;
+                        const ultimo = linhas.length ? linhas[linhas.length - 1].numero_pedido : null;
+                        (pagina.linhas || []).forEach(linha => {
+                            if (posicaoDe(linha.id) === -1 && (ultimo === null || linha.numero_pedido > ultimo)) {
+                                linhas.push(linha);
+                            }
+                        });
+                        cursor = pagina.proximo_cursor === undefined ? null : pagina.proximo_cursor;
+                        agendarRender(true);
+                    })
+                    .catch(error => {
+                        logger.error('Erro ao carregar a próxima janela de linhas:', error);
+                    })
+                    .finally(() => {
+                        carregando = false;
+                        if (options.loadingElement) options.loadingElement.style.display = 'none';
+                    });
+            };
+            
+            const onScroll = () => agendarRender();
+            window.addEventListener('scroll', onScroll, { passive: true });
+            window.addEventListener('resize', onScroll, { passive: true });
+            
+            const onChange = (event) => {
+                if (event.target.matches && event.target.matches(options.checkboxSelector)) {
+                    if (event.target.checked) {
+                        idsSelecionados.add(String(event.target.value));
+                    } else {
+                        idsSelecionados.delete(String(event.target.value));
+                    }
+                }
+            };
+            // Fase de captura: a seleção é atualizada antes do onchange da própria checkbox
+            tbody.addEventListener('change', onChange, true);
+            
+            // Reaproveita as linhas já renderizadas pelo servidor para a primeira janela
+            tbody.querySelectorAll('tr[data-entrada-id]').forEach(row => {
+                adotadas.set(String(row.getAttribute('data-entrada-id')), row);
+            });
+            linhas = Array.isArray(options.rows) ? options.rows.slice() : [];
+            
+            return {
+                // Substitui todas as linhas (carga completa); mantém a seleção das que continuam
+                setData: (novasLinhas, novoCursor) => {
+                    geracao++;
+                    linhas = Array.isArray(novasLinhas) ? novasLinhas.slice() : [];
+                    cursor = novoCursor === undefined ? null : novoCursor;
+                    adotadas.clear();
+                    montadas = new Map();
+                    const presentes = new Set(linhas.map(linha => String(linha.id)));
+                    Array.from(idsSelecionados).forEach(id => {
+                        if (!presentes.has(id)) idsSelecionados.delete(id);
+                    });
+                    agendarRender(true);
+                },
+                
+                // Insere ou atualiza uma linha, mantendo a ordem por número do pedido.
+                // Linhas depois da última janela carregada chegam com a paginação.
+                upsert: (linha) => {
+                    const chave = String(linha.id);
+                    const posicao = posicaoDe(linha.id);
+                    if (posicao !== -1) linhas.splice(posicao, 1);
+                    adotadas.delete(chave);
+                    montadas.delete(chave);
+                    
+                    const numero = Number(linha.numero_pedido) || 0;
+                    const ultimo = linhas.length ? Number(linhas[linhas.length - 1].numero_pedido) || 0 : null;
+                    if (cursor !== null && ultimo !== null && numero > ultimo) {
+                        return posicao !== -1;
+                    }
+                    const destino = linhas.findIndex(existente => (Number(existente.numero_pedido) || 0) > numero);
+                    linhas.splice(destino === -1 ? linhas.length : destino, 0, linha);
+                    agendarRender(true);
+                    return true;
+                },
+                
+                remove: (entryId) => {
+                    const chave = String(entryId);
+                    adotadas.delete(chave);
+                    montadas.delete(chave);
+                    idsSelecionados.delete(chave);
+                    const posicao = posicaoDe(entryId);
+                    if (posicao === -1) return false;
+                    linhas.splice(posicao, 1);
+                    agendarRender(true);
+                    return true;
+                },
+                
+                // Seleção (inclui linhas fora do DOM)
+                getSelected: () => Array.from(idsSelecionados),
+                selectAll: (marcar) => {
+                    idsSelecionados.clear();
+                    if (marcar) linhas.forEach(linha => idsSelecionados.add(String(linha.id)));
+                    agendarRender(true);
+                },
+                selectedCount: () => idsSelecionados.size,
+                loadedCount: () => linhas.length,
+                hasMore: () => cursor !== null,
+                
+                render: () => render(true),
+                
+                destroy: () => {
+                    geracao++;
+                    window.removeEventListener('scroll', onScroll);
+                    window.removeEventListener('resize', onScroll);
+                    tbody.removeEventListener('change', onChange, true);
+                }
+            };
+        },
+        
+        // Aplica um delta ({pedidos_data, orcamentos_data, removidos}) às tabelas virtualizadas
+        // ({pedido, orcamento}) e retorna o número de linhas afetadas
+        applyDelta: (delta, tabelas) => {
+            const pedidos = Array.isArray(delta.pedidos_data) ? delta.pedidos_data : [];
+            const orcamentos = Array.isArray(delta.orcamentos_data) ? delta.orcamentos_data : [];
+            const removidos = Array.isArray(delta.removidos) ? delta.removidos : [];
+            
+            // Modais carregados sob demanda ficam desatualizados: serão pedidos de novo
+            const descartarModais = (entrada) => {
+                const ids = [`detalhesModal-${entrada.id}`, `galeriaAnexos-${entrada.id}`, `relatorioModal-${entrada.id}`];
+                if (entrada.cliente_id) ids.push(`clienteDetalhesModal-${entrada.cliente_id}`);
+                ids.forEach(id => {
+                    const modal = document.getElementById(id);
+                    if (modal && modal.parentNode && !modal.classList.contains('show')) {
+                        modal.parentNode.removeChild(modal);
+                    }
+                });
+            };
+            
+            removidos.forEach(entryId => {
+                tabelas.pedido.remove(entryId);
+                tabelas.orcamento.remove(entryId);
+                descartarModais({ id: entryId });
+            });
+            
+            // Uma conversão move a linha de tabela: remove primeiro da outra
+            pedidos.forEach(entrada => {
+                tabelas.orcamento.remove(entrada.id);
+                tabelas.pedido.upsert(entrada);
+                descartarModais(entrada);
+            });
+            orcamentos.forEach(entrada => {
+                tabelas.pedido.remove(entrada.id);
+                tabelas.orcamento.upsert(entrada);
+                descartarModais(entrada);
+            });
+            
+            const total = removidos.length + pedidos.length + orcamentos.length;
+            logger.info(`Delta aplicado: ${total} linha(s) afetada(s)`);
+            return total;
+        }
+    };
+    
+    // Canal de eventos em tempo real (Server-Sent Events)
+    const pushManager = {
+        source: null,
+        
+        // Abre o canal; handlers.onEvent recebe cada evento e handlers.onStatus o estado da ligação
+        connect: (url, handlers = {}) => {
+            if (typeof window.EventSource === 'undefined') {
+                logger.warn('EventSource não suportado; mantendo apenas a sondagem');
+                return false;
+            }
+            
+            pushManager.disconnect();
+            const source = new EventSource(url);
+            
+            source.addEventListener('painel', (event) => {
+                try {
+                    if (typeof handlers.onEvent === 'function') {
+                        handlers.onEvent(JSON.parse(event.data));
+                    }
+                } catch (error) {
+                    logger.error('Evento inválido recebido do servidor:', error);
+                }
+            });
+            source.onopen = () => {
+                logger.info('Canal de eventos ligado');
+                if (typeof handlers.onStatus === 'function') handlers.onStatus(true);
+            };
+            source.onerror = () => {
+                // O navegador volta a ligar sozinho; apenas informa o estado
+                if (typeof handlers.onStatus === 'function') handlers.onStatus(false);
+            };
+            
+            pushManager.source = source;
+            return true;
+        },
+        
+        disconnect: () => {
+            if (pushManager.source) {
+                pushManager.source.close();
+                pushManager.source = null;
+            }
+        },
+        
+        isConnected: () => {
+            return !!pushManager.source && pushManager.source.readyState === window.EventSource.OPEN;
+        }
+    };
+    
     // API pública do sistema
     return {
         // Inicialização do sistema
@@ -401,6 +732,9 @@ window.PainelSistema = (function() {
                     state.statusInterval = null;
                 }
                 
+                // Fecha o canal de eventos em tempo real
+                pushManager.disconnect();
+                
                 // Desconecta observers
                 state.observers.forEach(observer => {
                     if (observer && observer.disconnect) {
@@ -435,6 +769,8 @@ window.PainelSistema = (function() {
         status: statusManager,
         notifications: notificationManager,
         connection: connectionManager,
+        tables: tableManager,
+        push: pushManager,
         utils: utils,
         logger: logger
     };
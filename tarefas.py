@@ -0,0 +1,253 @@
+# tarefas.py
+"""Tarefas em segundo plano (exportações grandes) com progresso e ficheiro para download.
+
+Cada tarefa corre numa thread do pool do worker que a recebeu e grava o resultado numa
+pasta própria dentro de TAREFAS_PASTA. O estado fica num ficheiro tarefa.json nessa pasta,
+regravado de forma atómica, por isso qualquer worker responde ao polling e serve o ficheiro,
+não só o que executa a tarefa.
+
+- O id da tarefa deriva da sua chave (tipo, formato e versão dos dados): pedir de novo a
+  mesma exportação enquanto ela corre, ou depois de concluída e dentro do prazo de retenção,
+  devolve a tarefa existente em vez de a recalcular.
+- Cada utilizador tem no máximo `por_utilizador` tarefas ativas, e o pool de cada worker no
+  máximo `max_workers` threads, para que as exportações não ocupem os workers dos pedidos.
+- Uma tarefa em execução regista um sinal de vida periódico (numa thread própria, mesmo que
+  `executar` demore a chamar o progresso); se o worker que a corria morrer, a tarefa fica
+  parada e é considerada falhada passado `tempo_sem_sinal` segundos, podendo ser pedida de
+  novo. Uma tarefa ainda na fila do pool não emite sinal: só é dada como perdida se
+  continuar pendente para além do prazo de retenção.
+- A pasta de uma tarefa só é apagada (limpeza ou nova submissão) depois de a tarefa
+  terminar, nunca enquanto está na fila ou em execução.
+- Vários workers podem receber a mesma exportação ao mesmo tempo: quem cria, substitui ou
+  apaga a pasta de uma tarefa reclama-a antes com um ficheiro .<id>.trava criado com O_EXCL,
+  por isso só um deles a cria e os outros devolvem a tarefa que encontram.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PENDENTE, EM_EXECUCAO, CONCLUIDA, ERRO = 'pendente', 'em_execucao', 'concluida', 'erro'
+ATIVAS = (PENDENTE, EM_EXECUCAO)
+
+# Segundos ao fim dos quais a trava de uma tarefa é considerada abandonada (processo morto)
+TRAVA_EXPIRA = 30
+
+
+class LimiteTarefas(Exception):
+    """O utilizador já tem o número máximo de tarefas ativas."""
+
+
+class GestorTarefas:
+
+    def __init__(self, pasta, max_workers=2, por_utilizador=1, retencao=3600, tempo_sem_sinal=120):
+        self.pasta = pasta
+        self.por_utilizador = por_utilizador
+        self.retencao = retencao
+        self.tempo_sem_sinal = tempo_sem_sinal
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tarefa')
+        self._lock = threading.Lock()
+        os.makedirs(pasta, exist_ok=True)
+
+    # --- Estado persistente ---
+
+    def _pasta_tarefa(self, tarefa_id):
+        return os.path.join(self.pasta, tarefa_id)
+
+    def _gravar(self, tarefa):
+        tarefa['atualizado_em'] = time.time()
+        caminho = os.path.join(self._pasta_tarefa(tarefa['id']), 'tarefa.json')
+        temporario = f'{caminho}.{threading.get_ident()}.tmp'
+        with open(temporario, 'w', encoding='utf-8') as ficheiro:
+            # Cópia: a thread do sinal de vida grava enquanto a tarefa altera o dicionário
+            json.dump(dict(tarefa), ficheiro)
+        os.replace(temporario, caminho)
+
+    def obter(self, tarefa_id):
+        """Estado da tarefa (dicionário) ou None; tarefas ativas sem sinal de vida passam a erro."""
+        if not tarefa_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self._pasta_tarefa(tarefa_id), 'tarefa.json'), encoding='utf-8') as ficheiro:
+                tarefa = json.load(ficheiro)
+        except (OSError, ValueError):
+            return None
+        agora = time.time()
+        if tarefa['estado'] == EM_EXECUCAO:
+            parada = agora - tarefa['atualizado_em'] > self.tempo_sem_sinal
+        elif tarefa['estado'] == PENDENTE:
+            # Na fila o estado não é regravado: só o worker morto explica uma espera tão longa
+            parada = agora - tarefa['criado_em'] > self.retencao
+        else:
+            parada = False
+        if parada:
+            tarefa['estado'] = ERRO
+            tarefa['mensagem'] = 'A tarefa foi interrompida.'
+        return tarefa
+
+    def caminho_ficheiro(self, tarefa):
+        return os.path.join(self._pasta_tarefa(tarefa['id']), tarefa['nome_ficheiro'])
+
+    def _todas(self):
+        for nome in os.listdir(self.pasta):
+            tarefa = self.obter(nome)
+            if tarefa is not None:
+                yield tarefa
+
+    @contextmanager
+    def _trava(self, tarefa_id):
+        """Reclama a tarefa entre processos enquanto a sua pasta é criada, substituída ou apagada."""
+        caminho = os.path.join(self.pasta, f'.{tarefa_id}.trava')
+        while True:
+            try:
+                os.close(os.open(caminho, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(caminho) > TRAVA_EXPIRA:
+                        # Deixada por um processo que morreu a meio
+                        os.remove(caminho)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+
+    def _expirada(self, tarefa, agora):
+        return tarefa['estado'] not in ATIVAS and agora - tarefa['atualizado_em'] > self.retencao
+
+    def limpar(self):
+        """Remove as tarefas terminadas há mais do que o prazo de retenção."""
+        agora = time.time()
+        for tarefa in list(self._todas()):
+            if not self._expirada(tarefa, agora):
+                continue
+            with self._trava(tarefa['id']):
+                # Outro worker pode tê-la substituído entretanto
+                tarefa = self.obter(tarefa['id'])
+                if tarefa is not None and self._expirada(tarefa, agora):
+                    shutil.rmtree(self._pasta_tarefa(tarefa['id']), ignore_errors=True)
+
+    # --- Submissão e execução ---
+
+    def submeter(self, chave, utilizador_id, nome_ficheiro, mimetype, executar, total=None):
+        """Agenda `executar(caminho, progresso)` e retorna o estado da tarefa.
+
+        `executar` grava o ficheiro em `caminho` e chama `progresso(n)` com o número de itens
+        já processados; `total` é o número esperado de itens (para a percentagem), se conhecido.
+        Se houver uma tarefa com a mesma chave ativa ou concluída recentemente, é ela a devolvida.
+        """
+        tarefa_id = hashlib.sha256(json.dumps(chave).encode('utf-8')).hexdigest()[:32]
+        with self._lock:
+            self.limpar()
+            with self._trava(tarefa_id):
+                existente = self.obter(tarefa_id)
+                if existente is not None and existente['estado'] in ATIVAS + (CONCLUIDA,):
+                    existente['reutilizada'] = True
+                    return existente
+
+                ativas = sum(
+                    1 for tarefa in self._todas()
+                    if tarefa['utilizador_id'] == utilizador_id and tarefa['estado'] in ATIVAS
+                )
+                if ativas >= self.por_utilizador:
+                    raise LimiteTarefas('Já existe uma exportação em andamento. Aguarde que termine.')
+
+                tarefa = self._criar(tarefa_id, utilizador_id, nome_ficheiro, mimetype, total)
+        self._executor.submit(self._executar, tarefa, executar)
+        return tarefa
+
+    def guardar(self, chave, utilizador_id, nome_ficheiro, mimetype, executar):
+        """Executa `executar(caminho, progresso)` já, no pedido atual, e guarda o ficheiro como tarefa concluída.
+
+        Para ficheiros pequenos produzidos pelo próprio pedido (ex.: relatório de uma importação),
+        que passam a ter o mesmo download e a mesma retenção das exportações.
+        """
+        tarefa_id = hashlib.sha256(json.dumps(chave).encode('utf-8')).hexdigest()[:32]
+        with self._lock, self._trava(tarefa_id):
+            existente = self.obter(tarefa_id)
+            if existente is not None and existente['estado'] in ATIVAS:
+                existente['reutilizada'] = True
+                return existente
+            tarefa = self._criar(tarefa_id, utilizador_id, nome_ficheiro, mimetype, None)
+        self._executar(tarefa, executar)
+        return tarefa
+
+    def _criar(self, tarefa_id, utilizador_id, nome_ficheiro, mimetype, total):
+        # Chamar com a trava da tarefa (_trava): a pasta é apagada e criada de novo
+        existente = self.obter(tarefa_id)
+        if existente is not None and existente['estado'] in ATIVAS:
+            # Quem chama já devolve a tarefa ativa; apagar a pasta estragaria o que ela está a gravar
+            raise RuntimeError(f'A tarefa {tarefa_id} ainda está ativa.')
+        shutil.rmtree(self._pasta_tarefa(tarefa_id), ignore_errors=True)
+        os.makedirs(self._pasta_tarefa(tarefa_id))
+        tarefa = {
+            'id': tarefa_id,
+            'utilizador_id': utilizador_id,
+            'estado': PENDENTE,
+            'progresso': 0,
+            'total': total,
+            'nome_ficheiro': nome_ficheiro,
+            'mimetype': mimetype,
+            'mensagem': None,
+            'criado_em': time.time(),
+            'reutilizada': False,
+        }
+        self._gravar(tarefa)
+        return tarefa
+
+    def _sinal_de_vida(self, tarefa, terminada):
+        # Regrava o estado (e atualizado_em) várias vezes dentro de tempo_sem_sinal
+        while not terminada.wait(self.tempo_sem_sinal / 4):
+            try:
+                self._gravar(tarefa)
+            except OSError:
+                logger.exception('Não foi possível registar o sinal de vida da tarefa %s', tarefa['id'])
+
+    def _executar(self, tarefa, executar):
+        tarefa['estado'] = EM_EXECUCAO
+        tarefa['iniciado_em'] = time.time()
+        self._gravar(tarefa)
+        caminho = self.caminho_ficheiro(tarefa)
+        temporario = caminho + '.parcial'
+        ultimo_registo = [0.0]
+
+        def progresso(processados):
+            tarefa['progresso'] = processados
+            # Grava no máximo uma vez por segundo
+            if time.monotonic() - ultimo_registo[0] >= 1:
+                ultimo_registo[0] = time.monotonic()
+                self._gravar(tarefa)
+
+        terminada = threading.Event()
+        sinal = threading.Thread(target=self._sinal_de_vida, args=(tarefa, terminada), daemon=True,
+                                 name=f'tarefa-sinal-{tarefa["id"][:8]}')
+        sinal.start()
+        try:
+            executar(temporario, progresso)
+            os.replace(temporario, caminho)
+            tarefa['estado'] = CONCLUIDA
+            tarefa['tamanho'] = os.path.getsize(caminho)
+        except Exception as erro:
+            logger.exception('Falha na tarefa %s', tarefa['id'])
+            tarefa['estado'] = ERRO
+            tarefa['mensagem'] = str(erro)
+            if os.path.exists(temporario):
+                os.remove(temporario)
+        finally:
+            terminada.set()
+            sinal.join()
+        self._gravar(tarefa)
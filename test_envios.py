@@ -0,0 +1,98 @@
+# test_envios.py
+"""Envio de anexos em blocos (envios.GestorEnvios) numa pasta temporária.
+
+Executar com: python -m pytest test_envios.py
+"""
+import hashlib
+import io
+import os
+
+import pytest
+
+from envios import ErroEnvio, GestorEnvios, HashDiferente, TamanhoExcedido
+
+CONTEUDO = bytes(range(256)) * 40  # 10240 bytes
+
+
+@pytest.fixture
+def gestor(tmp_path):
+    return GestorEnvios(str(tmp_path / 'envios'), tamanho_maximo=len(CONTEUDO), bloco_maximo=4096)
+
+
+@pytest.fixture
+def envio(gestor):
+    return gestor.iniciar(1, 10, 'foto.jpg', len(CONTEUDO))
+
+
+def _bloco(gestor, envio, inicio, fim):
+    gestor.gravar_bloco(envio, inicio, io.BytesIO(CONTEUDO[inicio:fim]), fim - inicio)
+
+
+def test_blocos_fora_de_ordem_e_sobrepostos(gestor, envio):
+    _bloco(gestor, envio, 6000, 10000)
+    _bloco(gestor, envio, 0, 3000)
+    _bloco(gestor, envio, 2000, 5000)  # sobrepõe-se ao anterior
+    assert gestor.recebidos(envio) == [[0, 5000], [6000, 10000]]
+    assert gestor.progresso(envio) == (9000, [[5000, 6000], [10000, 10240]])
+
+    _bloco(gestor, envio, 4000, 8000)
+    _bloco(gestor, envio, 10000, 10240)
+    assert gestor.recebidos(envio) == [[0, 10240]]
+    assert gestor.progresso(envio) == (10240, [])
+
+    caminho, sha = gestor.concluir(envio, hashlib.sha256(CONTEUDO).hexdigest().upper())
+    assert sha == hashlib.sha256(CONTEUDO).hexdigest()
+    with open(caminho, 'rb') as ficheiro:
+        assert ficheiro.read() == CONTEUDO
+
+
+def test_bloco_cortado_a_meio_nao_fica_registado(gestor, envio):
+    # O corpo traz menos bytes do que o Content-Length anunciado (ligação cortada)
+    with pytest.raises(ErroEnvio):
+        gestor.gravar_bloco(envio, 0, io.BytesIO(CONTEUDO[:1000]), 4000)
+    assert gestor.recebidos(envio) == []
+    assert gestor.progresso(envio) == (0, [[0, len(CONTEUDO)]])
+    with pytest.raises(ErroEnvio):
+        gestor.concluir(envio, None)
+
+
+@pytest.mark.parametrize('inicio, comprimento', [(-1, 10), (10000, 241), (len(CONTEUDO), 1)])
+def test_bloco_fora_do_ficheiro(gestor, envio, inicio, comprimento):
+    with pytest.raises(ErroEnvio) as erro:
+        gestor.gravar_bloco(envio, inicio, io.BytesIO(b'x' * comprimento), comprimento)
+    assert not isinstance(erro.value, TamanhoExcedido)
+    assert gestor.recebidos(envio) == []
+
+
+def test_limites_de_tamanho(gestor, envio):
+    with pytest.raises(TamanhoExcedido):
+        gestor.gravar_bloco(envio, 0, io.BytesIO(b'x' * 4097), 4097)
+    with pytest.raises(TamanhoExcedido):
+        gestor.iniciar(1, 10, 'grande.jpg', len(CONTEUDO) + 1)
+    with pytest.raises(ErroEnvio) as erro:
+        gestor.iniciar(1, 10, 'vazio.jpg', 0)
+    assert not isinstance(erro.value, TamanhoExcedido)
+
+
+def test_hash_diferente_apaga_o_envio(gestor, envio):
+    for inicio in range(0, len(CONTEUDO), 4096):
+        _bloco(gestor, envio, inicio, min(inicio + 4096, len(CONTEUDO)))
+    with pytest.raises(HashDiferente):
+        gestor.concluir(envio, hashlib.sha256(b'outro ficheiro').hexdigest())
+    assert gestor.obter(envio['id']) is None
+
+
+def test_segunda_conclusao_falha_sem_excecao_inesperada(gestor, envio):
+    for inicio in range(0, len(CONTEUDO), 4096):
+        _bloco(gestor, envio, inicio, min(inicio + 4096, len(CONTEUDO)))
+    caminho, _ = gestor.concluir(envio, None)
+    # O primeiro pedido ainda não moveu o ficheiro nem apagou o envio
+    with pytest.raises(ErroEnvio):
+        gestor.concluir(envio, None)
+    os.remove(caminho)
+    with pytest.raises(ErroEnvio):
+        gestor.concluir(envio, None)
+    with pytest.raises(ErroEnvio):
+        _bloco(gestor, envio, 0, 100)
+    gestor.cancelar(envio)
+    assert gestor.obter(envio['id']) is None
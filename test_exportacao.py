@@ -0,0 +1,66 @@
+# test_exportacao.py
+"""O .xlsx escrito à mão por exportacao.gerar_xlsx tem de abrir no openpyxl com os mesmos valores.
+
+Executar com: python -m pytest test_exportacao.py
+"""
+import io
+import warnings
+
+import openpyxl
+
+from exportacao import BLOCO, gerar_csv, gerar_xlsx
+
+CABECALHOS = ['Texto', 'Vazio', 'Booleano', 'Inteiro', 'Decimal']
+LINHAS = [
+    ['Ação — ñ 中文 😀', None, True, 0, 1.5],
+    ['<&> "aspas" \'plicas\'', None, False, -42, -0.25],
+    ['  espaços nas pontas  ', None, True, 10 ** 15, 1234567.875],
+    ['controlo\x01\x08\x0b\x1f fim', None, False, 7, 3.0],
+    ['linha\nnova\ttab', None, None, None, None],
+]
+
+
+def _reabrir(blocos):
+    with warnings.catch_warnings(record=True) as avisos:
+        warnings.simplefilter('always')
+        livro = openpyxl.load_workbook(io.BytesIO(b''.join(blocos)))
+    assert [str(aviso.message) for aviso in avisos] == []
+    return livro
+
+
+def _esperado(valor):
+    # Os caracteres de controlo que o XML não aceita são removidos; \n e \t ficam
+    if isinstance(valor, str):
+        return ''.join(c for c in valor if c in '\n\t' or ord(c) >= 0x20)
+    return valor
+
+
+def test_xlsx_reabre_com_os_mesmos_valores():
+    livro = _reabrir(gerar_xlsx('Relatório <1> & "2"', CABECALHOS, iter(LINHAS)))
+    folha = livro.active
+    assert folha.title == 'Relatório <1> & "2"'
+    valores = [list(linha) for linha in folha.iter_rows(values_only=True)]
+    assert valores[0] == CABECALHOS
+    assert valores[1:] == [[_esperado(valor) for valor in linha] for linha in LINHAS]
+    assert isinstance(folha['C2'].value, bool) and isinstance(folha['D2'].value, int)
+    assert folha['A1'].font.b and not folha['A2'].font.b
+
+
+def test_xlsx_em_varios_blocos():
+    # Linhas suficientes para o ficheiro sair em vários blocos, sem perder nenhuma
+    linhas = [[f'pedido {numero} ' + 'x' * 40, numero, numero / 4] for numero in range(20000)]
+    blocos = list(gerar_xlsx('Grande', ['Nome', 'Número', 'Quarto'], iter(linhas)))
+    assert len(blocos) > 2 and sum(map(len, blocos)) > BLOCO
+    folha = _reabrir(blocos).active
+    assert folha.max_row == len(linhas) + 1
+    assert [list(linha) for linha in folha.iter_rows(min_row=2, values_only=True)] == linhas
+
+
+def test_xlsx_sem_linhas():
+    folha = _reabrir(gerar_xlsx('Vazio', CABECALHOS, iter([]))).active
+    assert [list(linha) for linha in folha.iter_rows(values_only=True)] == [CABECALHOS]
+
+
+def test_csv_com_bom_e_ponto_e_virgula():
+    texto = b''.join(gerar_csv(['a', 'b'], iter([[None, 'ç;x'], [1, 2.5]]))).decode('utf-8')
+    assert texto == '\ufeffa;b\r\n;"ç;x"\r\n1;2.5\r\n'
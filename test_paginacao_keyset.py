@@ -0,0 +1,134 @@
+# test_paginacao_keyset.py
+"""Cursores opacos e paginação por keyset (paginar_keyset em app.py) num SQLite temporário.
+
+Executar com: python -m pytest test_paginacao_keyset.py
+"""
+import base64
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+# O app lê DATABASE_URL ao ser importado: os testes nunca tocam no banco configurado
+_PASTA = tempfile.mkdtemp(prefix='teste_keyset_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_PASTA, 'teste.db')
+
+import pytest  # noqa: E402
+
+from app import (  # noqa: E402
+    app, bcrypt, db, Cliente, Entrada, User, _codificar_cursor, _decodificar_cursor, paginar_keyset
+)
+
+ORDEM_ARQUIVADOS = ((Entrada.data_registro, True), (Entrada.id, True))
+ORDEM_CLIENTES = ((Cliente.numero_cliente, False),)
+INICIO = datetime(2024, 5, 1, 8, 30)
+
+
+def _cursor(dados):
+    texto = dados if isinstance(dados, str) else json.dumps(dados)
+    return base64.urlsafe_b64encode(texto.encode()).decode().rstrip('=')
+
+
+@pytest.fixture(scope='module')
+def banco():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        # Grupos de 4 entradas com a mesma data: a ordem depende do desempate pelo id
+        for numero in range(1, 24):
+            db.session.add(Entrada(tipo='Pedido', numero_pedido=numero, descricao=f'pedido {numero}', arquivado=True,
+                                   data_registro=INICIO + timedelta(days=numero // 4)))
+        for numero in (5, 1, 9, 3, 7):
+            db.session.add(Cliente(numero_cliente=numero, nome=f'Cliente {numero}', tipo_pessoa='PF', telefone='1'))
+        db.session.add(User(username='teste', password_hash=bcrypt.generate_password_hash('teste').decode(),
+                            is_admin=True))
+        db.session.commit()
+        yield
+
+
+def _paginar(cursor, per_page=5):
+    consulta = db.select(Entrada).where(Entrada.arquivado == True)
+    total = db.session.execute(db.select(db.func.count()).select_from(Entrada)).scalar()
+    return paginar_keyset(consulta, ORDEM_ARQUIVADOS, cursor, per_page, total,
+                          lambda instrucao: db.session.execute(instrucao).scalars().all())
+
+
+def _esperado():
+    entradas = db.session.execute(db.select(Entrada)).scalars().all()
+    return [entrada.id for entrada in sorted(entradas, key=lambda e: (e.data_registro, e.id), reverse=True)]
+
+
+def test_cursor_ida_e_volta():
+    chave = [datetime(2024, 5, 3, 10, 15, 30, 123456), 42]
+    cursor = _codificar_cursor(chave, 'p', 31)
+    assert '=' not in cursor
+    assert _decodificar_cursor(cursor, ORDEM_ARQUIVADOS) == (chave, 'p', 31)
+    assert _decodificar_cursor(_codificar_cursor([7], 'n', 1), ORDEM_CLIENTES) == ([7], 'n', 1)
+
+
+@pytest.mark.parametrize('cursor', [
+    '',
+    '!!!não é base64!!!',
+    'AAAA',
+    _cursor('não é json'),
+    _cursor(b'\xff\xfe'.decode('latin-1')),
+    _cursor('null'),
+    _cursor([1, 2]),
+    _cursor({'k': ['2024-05-01T08:30:00', 1], 'd': 'n'}),
+    _cursor({'k': ['2024-05-01T08:30:00'], 'd': 'n', 'p': 1}),
+    _cursor({'k': ['2024-05-01T08:30:00', 1, 2], 'd': 'n', 'p': 1}),
+    _cursor({'k': ['ontem', 1], 'd': 'n', 'p': 1}),
+    _cursor({'k': [20240501, 1], 'd': 'n', 'p': 1}),
+    _cursor({'k': ['2024-05-01T08:30:00+02:00', 1], 'd': 'n', 'p': 1}),
+    _cursor({'k': ['2024-05-01T08:30:00', '1'], 'd': 'n', 'p': 1}),
+    _cursor({'k': ['2024-05-01T08:30:00', True], 'd': 'n', 'p': 1}),
+    _cursor({'k': ['2024-05-01T08:30:00', 1.5], 'd': 'n', 'p': 1}),
+    _cursor({'k': ['2024-05-01T08:30:00', 2 ** 70], 'd': 'n', 'p': 1}),
+    _cursor({'k': ['2024-05-01T08:30:00', {'id': 1}], 'd': 'n', 'p': 1}),
+    _cursor({'k': ['2024-05-01T08:30:00', None], 'd': 'n', 'p': 1}),
+    _cursor({'k': ['2024-05-01T08:30:00', 1], 'd': 'x', 'p': 1}),
+    _cursor({'k': ['2024-05-01T08:30:00', 1], 'd': 'n', 'p': '2'}),
+    _cursor('{"k": ["2024-05-01T08:30:00", 1], "d": "n", "p": 1e999}'),
+    _cursor({'k': 5, 'd': 'n', 'p': 1}),
+])
+def test_cursor_invalido(banco, cursor):
+    assert _decodificar_cursor(cursor, ORDEM_ARQUIVADOS) is None
+    # Um cursor inválido mostra a primeira página em vez de falhar
+    with app.app_context():
+        pagina = _paginar(cursor)
+        assert [entrada.id for entrada in pagina.items] == _esperado()[:5]
+        assert pagina.inicio == 1 and not pagina.has_prev
+
+
+@pytest.mark.parametrize('per_page', [1, 3, 4, 5, 23, 30])
+def test_paginas_sem_repetir_nem_saltar_linhas(banco, per_page):
+    with app.app_context():
+        esperado = _esperado()
+        paginas, cursor = [], None
+        while True:
+            pagina = _paginar(cursor, per_page)
+            paginas.append([entrada.id for entrada in pagina.items])
+            assert pagina.inicio == 1 + per_page * (len(paginas) - 1)
+            assert pagina.total == len(esperado)
+            if not pagina.has_next:
+                break
+            cursor = pagina.next_cursor
+        assert [entrada_id for ids in paginas for entrada_id in ids] == esperado
+        assert len(paginas) == pagina.pages
+
+        # Para trás, a partir da última página, as mesmas páginas pela ordem inversa
+        for anteriores in reversed(paginas[:-1]):
+            assert pagina.has_prev
+            pagina = _paginar(pagina.prev_cursor, per_page)
+            assert [entrada.id for entrada in pagina.items] == anteriores
+        assert not pagina.has_prev and pagina.inicio == 1
+
+
+def test_rotas_com_cursor_alterado(banco):
+    cliente = app.test_client()
+    cliente.post('/login', data={'username': 'teste', 'password': 'teste'})
+    alterado = _cursor({'k': ['2024-05-01T08:30:00', {'id': 1}], 'd': 'n', 'p': 1})
+    assert cliente.get('/arquivados', query_string={'pedidos_cursor': alterado}).status_code == 200
+    assert cliente.get('/arquivados', query_string={'pedidos_cursor': '%%%'}).status_code == 200
+    resposta = cliente.get('/cadastro-clientes', query_string={'cursor': _cursor({'k': ['5'], 'd': 'n', 'p': 1})})
+    assert resposta.status_code == 200